@@ -0,0 +1,184 @@
+"""
+Measures what a cold start costs the Lambda's process: importing each module in a fresh interpreter,
+and the handler's first invocation on the sample data file (the clients and connections, compiling the schema,
+empty converter caches) compared with the warm ones. boto3 and psycopg2 are replaced with stand-ins
+that count the sessions, clients, and connections the handler creates, which should all be reused when warm.
+
+Usage: ``python bench/bench_coldstart.py [runs]``
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+src_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'lambda_xml')
+
+modules = ['schemas_xml', 'stream_xml', 'expat_xml', 'xslt_xml', 'lambda_function_xml']
+heavy_modules = ['yaml', 'boto3', 'psycopg2', 'lxml']
+
+
+def child_import(module):
+    sys.path.append(src_dir)
+
+    start = time.perf_counter()
+    try:
+        __import__(module)
+    except Exception as ex:
+        print(json.dumps({'error': f'{type(ex).__name__}: {ex}'}))
+        return
+
+    print(json.dumps({'seconds': time.perf_counter() - start,
+                      'loaded': [name for name in heavy_modules if name in sys.modules]}))
+
+
+class FakeAWS:
+    """
+    A stand-in for boto3's session, with its clients: S3 serving the sample data file,
+    DynamoDB taking the items, and Lambda. Counts the sessions and clients created.
+    """
+    created = {'session': 0}
+
+    def __init__(self, contents):
+        FakeAWS.created['session'] += 1
+        self.contents = contents
+
+    def client(self, name, **kwargs):
+        FakeAWS.created[name] = FakeAWS.created.get(name, 0) + 1
+        return self
+
+    def get_object(self, Bucket, Key):
+        from io import BytesIO
+        return {'Body': BytesIO(self.contents), 'ETag': f'"{Key}"'}
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity='NONE'):
+        (table_name, requests), = RequestItems.items()
+        return {'ConsumedCapacity': [{'TableName': table_name, 'CapacityUnits': float(len(requests))}]}
+
+
+class FakeConnection:
+    """
+    A stand-in for a psycopg2 connection to a database with the sample schema, and nothing processed yet.
+    Counts the connections opened.
+    """
+    opened = 0
+
+    def __init__(self, pattern, version, processing):
+        from schemas_xml import file_pattern_field, proc_schema_field
+
+        FakeConnection.opened += 1
+        self.closed = 0
+        self.answers = [('SELECT max(', [(version, 1)]),
+                        (f'SELECT {file_pattern_field}', [(pattern, version)]),
+                        (f'SELECT {proc_schema_field}', [(processing,)])]
+        self.rows = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=None):
+        self.rows = next((rows for prefix, rows in self.answers if query.startswith(prefix)), [])
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+def stub_modules(contents, pattern, version, processing):
+    """
+    Puts stand-ins for boto3, botocore, and psycopg2 in place, before the handler is imported.
+    """
+    import types
+
+    modules = {name: types.ModuleType(name) for name in ['boto3', 'boto3.session', 'botocore', 'botocore.config',
+                                                          'botocore.exceptions', 'psycopg2', 'psycopg2.pool']}
+    modules['boto3'].session = modules['boto3.session']
+    modules['boto3.session'].Session = lambda: FakeAWS(contents)
+    modules['botocore.config'].Config = lambda **kwargs: kwargs
+    modules['botocore.exceptions'].ClientError = type('ClientError', (Exception,), {})
+    modules['psycopg2'].Error = type('Error', (Exception,), {})
+    modules['psycopg2'].connect = lambda dsn: FakeConnection(pattern, version, processing)
+    modules['psycopg2.pool'].PoolError = type('PoolError', (Exception,), {})
+    sys.modules.update(modules)
+
+
+def child_handler():
+    import tempfile
+    from datetime import datetime
+
+    import yaml
+    from sample import read_sample, sample_yml
+
+    sys.path.append(src_dir)
+
+    with open(sample_yml) as f:
+        schema = yaml.safe_load(f)
+    version = datetime.strptime(schema['meta']['version'], '%Y-%m-%dT%H:%M:%SZ')
+    stub_modules(read_sample(), schema['meta']['files'], version, schema['processing'])
+    os.environ['SCHEMA_CACHE_DIR'] = tempfile.mkdtemp()  # the schema isn't in the files of the cache either
+
+    start = time.perf_counter()
+    import lambda_function_xml
+    timings = {'import the handler': time.perf_counter() - start}
+
+    for invocation in ['first invocation, cold', 'second invocation, warm', 'third invocation, warm']:
+        event = {'Records': [{'s3': {'bucket': {'name': 'bench'}, 'object': {'key': f'{len(timings)}/Trafficspeed.xml'}}}]}
+
+        start = time.perf_counter()
+        response = lambda_function_xml.main(event, None)
+        timings[invocation] = time.perf_counter() - start
+        assert response['objects'][0]['status'] == 'succeeded', response
+
+    print(json.dumps({'timings': timings, 'created': dict(FakeAWS.created, connection=FakeConnection.opened)}))
+
+
+def run_child(*args):
+    output = subprocess.run([sys.executable, __file__, '--child'] + list(args),
+                            check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        if sys.argv[2] == 'import':
+            child_import(sys.argv[3])
+        else:
+            child_handler()
+        return
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    print('Import time, best of fresh interpreters:')
+    for module in modules:
+        results = [run_child('import', module) for _ in range(runs)]
+        if 'error' in results[0]:
+            print(f'    {module:<36} unavailable here ({results[0]["error"]})')
+            continue
+
+        seconds = min(result['seconds'] for result in results)
+        loaded = ', '.join(results[0]['loaded']) or 'none'
+        print(f'    {module:<36} {seconds * 1e3:8.1f} ms   also loads: {loaded}')
+
+    results = [run_child('handler') for _ in range(runs)]
+    print('The handler on the sample data file, an invocation per file, best of fresh interpreters:')
+    for name in results[0]['timings']:
+        seconds = min(result['timings'][name] for result in results)
+        print(f'    {name:<36} {seconds * 1e3:8.1f} ms')
+
+    created = ', '.join(f'{count} {name}' for name, count in results[0]['created'].items())
+    print(f'Created over the three invocations: {created}')
+
+
+if __name__ == '__main__':
+    main()
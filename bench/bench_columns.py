@@ -0,0 +1,57 @@
+"""
+Compares the memory held by the extracted records as a list of dicts and as column batches.
+
+Usage: ``python bench/bench_columns.py [copies]``
+"""
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+from sample import load_schema, make_copies
+
+import columnar_xml
+import schemas_xml
+import stream_xml
+
+
+def measure(name, extract, readings):
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    result = extract()
+
+    seconds = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f'{name:<20} {seconds:8.2f} s {size / 2 ** 20:10.1f} MiB {size / readings:10.1f} bytes per reading')
+    return result
+
+
+def main():
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    contents = make_copies(copies)
+
+    data_sch, pref = load_schema()
+    plan = schemas_xml.compile_schema(data_sch, pref)
+    layouts = columnar_xml.compile_columns(plan)
+
+    def log(_):
+        pass
+
+    records = list(stream_xml.stream_data(BytesIO(contents), plan, log))
+    readings = sum(len(record['ns1:measuredValue']) for record in records)
+    del records
+    print(f'{copies * 200} sites, {readings} readings')
+
+    measure('list of dicts', lambda: list(stream_xml.stream_data(BytesIO(contents), plan, log)), readings)
+    batches = measure('column batches',
+                      lambda: list(columnar_xml.stream_columns(BytesIO(contents), layouts, log)), readings)
+
+    size = sum(batch.nbytes() for batch in batches)
+    print(f'{"column buffers":<20} {"":10} {size / 2 ** 20:10.1f} MiB {size / readings:10.1f} bytes per reading')
+
+
+if __name__ == '__main__':
+    main()
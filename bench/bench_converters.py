@@ -0,0 +1,57 @@
+"""
+Compares the value converters with the original ``parse_val`` on the raw values found in the sample file.
+"""
+from datetime import datetime
+from decimal import Decimal
+from xml.etree.ElementTree import fromstring
+
+from sample import read_sample, best_of, report
+
+import schemas_xml
+
+ns = '{http://datex2.eu/schema/2/2_0}'
+xsi_type = '{http://www.w3.org/2001/XMLSchema-instance}type'
+
+
+def original_parse_val(raw_val, val_type):
+    if val_type == 'int':
+        return int(raw_val)
+    elif val_type == 'timestamp':
+        datetime.strptime(raw_val, '%Y-%m-%dT%H:%M:%SZ')  # Just for validating the format
+        return raw_val
+    elif val_type == 'float':
+        return Decimal(raw_val)
+    elif val_type == 'bool':
+        return bool(raw_val)
+    else:
+        return raw_val
+
+
+def main():
+    root = fromstring(read_sample())
+
+    samples = [
+        ('timestamp', [node.text for node in root.iter(ns + 'measurementTimeDefault')]),
+        ('float', [node.text for node in root.iter(ns + 'vehicleFlowRate')] +
+                  [node.text for node in root.iter(ns + 'speed')]),
+        ('int', [node.get('index') for node in root.iter(ns + 'measuredValue') if node.get('index')]),
+        ('text (types)', [node.get(xsi_type) for node in root.iter(ns + 'basicData')]),
+        ('str (site ids)', [node.get('id') for node in root.iter(ns + 'measurementSiteReference')]),
+    ]
+
+    for name, values in samples:
+        val_type = name.split()[0]
+        convert = schemas_xml.get_converter(val_type)
+
+        assert [original_parse_val(v, val_type) for v in values] == [convert(v) for v in values]
+
+        original = best_of(lambda: [original_parse_val(v, val_type) for v in values], number=20)
+        converted = best_of(lambda: [convert(v) for v in values], number=20)
+
+        print(f'{name}: {len(values)} values, {len(set(values))} distinct')
+        report('    parse_val (original), per value', original / len(values), unit='us')
+        report('    converter, per value', converted / len(values), original / len(values), unit='us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Loads the channel readings of a minute's data file into the day-partitioned `readings` table of a local Postgres:
+with the `readings` sink (`COPY` of CSV from memory),
+with `execute_values` (multi-row `INSERT`s of 1000 rows), and with `executemany` (an `INSERT` per row).
+The tables are created in a schema of their own, `bench_copy`, dropped at the end.
+
+Needs ``psycopg2``. The database is given by ``BENCH_DSN``, or by the ``PGHOST``, ``PGPORT``, ``PGUSER``, ...
+variables of libpq.
+
+Usage: ``python bench/bench_copy.py [copies]``
+"""
+import os
+import sys
+import time
+from io import BytesIO
+
+from sample import load_schema, make_copies
+
+import readings_xml
+import schemas_xml
+import stream_xml
+
+schema = 'bench_copy'
+
+
+def reset(connection):
+    cur = connection.cursor()
+    cur.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}; SET search_path TO {schema};')
+    connection.commit()
+    readings_xml.known_partitions.clear()
+    readings_xml.create_readings_table(connection)
+
+
+def count_rows(connection):
+    cur = connection.cursor()
+    cur.execute(f'SELECT count(*), count(DISTINCT tableoid) FROM {readings_xml.readings_table};')
+    rows, partitions = cur.fetchone()
+    connection.commit()
+    return rows, partitions
+
+
+def insert_rows(connection, rows, many):
+    from psycopg2.extras import execute_values
+
+    for day in sorted({row[1][:10] for row in rows}):
+        readings_xml.create_partition(connection, day)
+
+    cur = connection.cursor()
+    insert = f'INSERT INTO {readings_xml.readings_table} ({readings_xml.readings_columns}) '
+    if many:
+        cur.executemany(insert + 'VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING;', rows)
+    else:
+        execute_values(cur, insert + 'VALUES %s ON CONFLICT DO NOTHING;', rows, page_size=1000)
+    connection.commit()
+
+
+def main():
+    try:
+        import psycopg2
+    except ImportError:
+        print('psycopg2 is not installed, skipped')
+        return
+
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    data_sch, pref = load_schema()
+    plan = schemas_xml.compile_schema(data_sch, pref)
+    records = list(stream_xml.stream_data(BytesIO(make_copies(copies)), plan, lambda _: None))
+
+    # The copies repeat the sites, give each copy its own sites, all at the same time as in a data file
+    timestamp = records[0]['measurementTimeDefault']
+    for i, record in enumerate(records):
+        record['measurementSiteReference'] = f'{record["measurementSiteReference"]}/{i // 200}'
+        record['measurementTimeDefault'] = timestamp
+
+    rows = [row for record in records for row in readings_xml.reading_rows(record)[0]]
+    print(f'{len(records)} records of a minute, {len(rows)} readings')
+
+    connection = psycopg2.connect(os.environ.get('BENCH_DSN', ''))
+    try:
+        for name, load in [
+            ('COPY', None),
+            ('execute_values', lambda: insert_rows(connection, rows, many=False)),
+            ('executemany', lambda: insert_rows(connection, rows, many=True)),
+        ]:
+            reset(connection)
+            started = time.perf_counter()
+            if load is None:
+                with readings_xml.ReadingsSink(connection, batch_rows=len(rows) + 1) as sink:
+                    for chunk in stream_xml.chunks(records, 500):
+                        sink.put_records(chunk)
+                    buffered = time.perf_counter()
+                    sink.flush()
+                detail = (f'  {(buffered - started) * 1e3:.0f} ms flattening to CSV, '
+                          f'{(time.perf_counter() - buffered) * 1e3:.0f} ms in COPY')
+            else:
+                load()
+                detail = ''
+            elapsed = time.perf_counter() - started
+
+            assert count_rows(connection) == (len(rows), 1)
+            print(f'{name:<15} {elapsed * 1e3:7.0f} ms  {len(rows) / elapsed:9.0f} rows/s{detail}')
+
+        # The file sent again leaves the table as it is, its readings go through the staging table
+        reset(connection)
+        for attempt in ('first', 'again'):
+            started = time.perf_counter()
+            with readings_xml.ReadingsSink(connection, batch_rows=len(rows)) as sink:
+                sink.put_records(records)
+            elapsed = time.perf_counter() - started
+
+            assert count_rows(connection) == (len(rows), 1)
+            print(f'COPY, {attempt:<9} {elapsed * 1e3:7.0f} ms  {sink.report()}')
+    finally:
+        connection.rollback()
+        connection.cursor().execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE;')
+        connection.commit()
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
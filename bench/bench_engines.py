@@ -0,0 +1,42 @@
+"""
+Checks that the extraction engines produce the same records on the sample file, and compares their speed.
+"""
+from io import BytesIO
+
+from sample import load_schema, read_sample, best_of, report
+
+import expat_xml
+import schemas_xml
+import stream_xml
+import xslt_xml
+
+
+def main():
+    data_sch, pref = load_schema()
+    plan = schemas_xml.compile_schema(data_sch, pref)
+    contents = read_sample()
+
+    def log(_):
+        pass
+
+    engines = [
+        ('etree', stream_xml.stream_data),
+        ('expat', expat_xml.stream_data),
+    ]
+    if xslt_xml.etree is not None:
+        engines.append(('xslt', xslt_xml.stream_data))
+
+    reference = list(engines[0][1](BytesIO(contents), plan, log))
+
+    baseline = None
+    for name, engine in engines:
+        records = list(engine(BytesIO(contents), plan, log))
+        assert records == reference, f'{name} differs from {engines[0][0]}'
+
+        seconds = best_of(lambda: list(engine(BytesIO(contents), plan, log)))
+        report(f'{name} ({len(records)} records)', seconds, baseline)
+        baseline = baseline or seconds
+
+
+if __name__ == '__main__':
+    main()
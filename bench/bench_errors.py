@@ -0,0 +1,36 @@
+"""
+Compares the extraction time of the sample file with a clean schema
+and with a schema that fails on every flow reading, logging to the aggregating logger.
+"""
+import copy
+from xml.etree.ElementTree import fromstring
+
+from sample import load_schema, read_sample, best_of, report
+
+import logs
+import schemas_xml
+
+
+def main():
+    data_sch, pref = load_schema()
+    root = fromstring(read_sample())
+
+    broken_sch = copy.deepcopy(data_sch)
+    flow = broken_sch['ns1.siteMeasurements[]']['ns1.measuredValue[]'][0]['ns1.basicData'][0]
+    flow['ns1.vehicleFlowRate'] = 'text, timestamp, Flow'  # flows aren't timestamps
+
+    def run(sch):
+        logger, log = logs.get_logger()
+        schemas_xml.run_plan(schemas_xml.compile_schema(sch, pref), root, log)
+        return logs.render_errors(logger[2])
+
+    print(f'{len(run(broken_sch))} message(s) for the broken schema:')
+    print('\n'.join(run(broken_sch)))
+
+    clean = best_of(lambda: run(data_sch))
+    report('clean schema', clean)
+    report('schema failing on every flow', best_of(lambda: run(broken_sch)), clean)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Compares the minute and the hour layouts of the traffic items on a local stand-in for DynamoDB:
+the sample's sites are written for two hours of minutes, one data file per minute, in both layouts,
+the minute items are compacted into hour items, and a site's day is read back from the hour items.
+Reports the items, the requests, and the write units of each, and checks that the readings survive.
+
+Usage: ``python bench/bench_hourly.py [minutes]``
+"""
+import math
+import sys
+import threading
+from datetime import datetime, timedelta
+from io import BytesIO
+
+from sample import load_schema, read_sample
+
+import dynamo_xml
+import hourly_xml
+import packed_xml
+import schemas_xml
+import stream_xml
+
+minute_keys = ['measurementSiteReference', 'measurementTimeDefault']
+
+
+class LocalDynamoDB:
+    """
+    A stand-in for a DynamoDB client, counting the requests and the write units of each table:
+    a unit per started KiB of an item, for an update the larger of the item before and after it.
+    """
+    def __init__(self, tables, page_size=500):
+        self.key_fields = tables  # the key attributes keyed on the table names
+        self.page_size = page_size
+        self.items = {name: {} for name in tables}
+        self.requests = {name: 0 for name in tables}
+        self.units = {name: 0 for name in tables}
+        self.lock = threading.Lock()
+
+    def _key(self, table_name, item):
+        return tuple(item[field]['S'] for field in self.key_fields[table_name])
+
+    def _consume(self, table_name, *items):
+        units = max(math.ceil(dynamo_xml.item_size(item) / 1024) if item else 1 for item in items)
+        self.units[table_name] += units
+        return units
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity='NONE'):
+        (table_name, requests), = RequestItems.items()
+        items = self.items[table_name]
+        units = 0
+
+        with self.lock:
+            self.requests[table_name] += 1
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = request['PutRequest']['Item']
+                    items[self._key(table_name, item)] = item
+                    units += self._consume(table_name, item)
+                else:
+                    key = self._key(table_name, request['DeleteRequest']['Key'])
+                    units += self._consume(table_name, items.pop(key, None))
+
+        return {'ConsumedCapacity': [{'TableName': table_name, 'CapacityUnits': float(units)}]}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues,
+                    ReturnConsumedCapacity='NONE'):
+        assert UpdateExpression.startswith('SET ')
+        key = self._key(TableName, Key)
+
+        with self.lock:
+            self.requests[TableName] += 1
+            before = self.items[TableName].get(key)
+            after = dict(before or Key)
+            for assignment in UpdateExpression[4:].split(', '):
+                field, value = assignment.split(' = ')
+                after[field] = ExpressionAttributeValues[value]
+
+            self.items[TableName][key] = after
+            units = self._consume(TableName, before, after)
+
+        return {'ConsumedCapacity': {'TableName': TableName, 'CapacityUnits': float(units)}}
+
+    def scan(self, TableName, Segment=0, TotalSegments=1, ExclusiveStartKey=None):
+        with self.lock:
+            self.requests[TableName] += 1
+            items = self.items[TableName]
+            keys = sorted(items)
+            if ExclusiveStartKey is not None:
+                keys = [key for key in keys if key > self._key(TableName, ExclusiveStartKey)]
+
+            page = [items[key] for key in keys[:self.page_size]]
+
+        response = {'Items': page}
+        if len(keys) > self.page_size:
+            response['LastEvaluatedKey'] = {field: page[-1][field] for field in self.key_fields[TableName]}
+        return response
+
+    def batch_get_item(self, RequestItems):
+        (table_name, request), = RequestItems.items()
+        items = self.items[table_name]
+
+        with self.lock:
+            self.requests[table_name] += 1
+            keys = [self._key(table_name, key) for key in request['Keys']]
+            found = [items[key] for key in keys if key in items]
+
+        return {'Responses': {table_name: found}}
+
+
+def minute_files(records, minutes):
+    """
+    :return: the records of the data files of a number of minutes, in the form ``[(minute, records), ...]``
+    """
+    start = datetime(2017, 12, 31, 22)
+    for minute in range(minutes):
+        timestamp = (start + timedelta(minutes=minute)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        yield timestamp, [dict(record, measurementTimeDefault=timestamp) for record in records]
+
+
+def write_files(client, table_name, make_writer, files, encoder):
+    requests, units = client.requests[table_name], client.units[table_name]
+    for _, records in files:
+        with make_writer() as writer:
+            writer.put_items(map(encoder, records))
+
+    return client.requests[table_name] - requests, client.units[table_name] - units
+
+
+def main():
+    minutes = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+
+    data_sch, pref = load_schema()
+    plan = schemas_xml.compile_schema(data_sch, pref)
+    records = list(stream_xml.stream_data(BytesIO(read_sample()), plan, lambda _: None))
+    encoder = packed_xml.packed_encoder(dynamo_xml.compile_encoder(plan))
+    files = list(minute_files(records, minutes))
+
+    print(f'{len(records)} sites, {minutes} minutes, one data file per minute, packed readings')
+
+    # Written in the minute layout, and in the hour layout
+    client = LocalDynamoDB({'TrafficSpeed': minute_keys, 'TrafficSpeedHourly': hourly_xml.hour_keys})
+
+    requests, units = write_files(client, 'TrafficSpeed', lambda: dynamo_xml.ParallelWriter(
+        client, 'TrafficSpeed', minute_keys, streams=8), files, encoder)
+    print(f'minute layout       {len(client.items["TrafficSpeed"]):6} items, {requests:6} requests, {units:7} WCU')
+
+    requests, units = write_files(client, 'TrafficSpeedHourly', lambda: hourly_xml.HourlyWriter(
+        client, 'TrafficSpeedHourly', streams=8), files, encoder)
+    hour_items = client.items['TrafficSpeedHourly']
+    print(f'hour layout         {len(hour_items):6} items, {requests:6} requests, {units:7} WCU')
+
+    # The minute items compacted into a fresh hour table
+    client.items['TrafficSpeedHourly'] = {}
+    requests, units = sum(client.requests.values()), sum(client.units.values())
+
+    with hourly_xml.HourlyWriter(client, 'TrafficSpeedHourly', streams=8) as writer, \
+            dynamo_xml.ParallelWriter(client, 'TrafficSpeed', minute_keys, streams=8) as deleter:
+        assert writer.fold_minutes('TrafficSpeed', deleter=deleter) is None
+
+    assert client.items['TrafficSpeedHourly'] == hour_items, 'the compacted items differ from the written ones'
+    assert not client.items['TrafficSpeed'], 'minute items left after the compaction'
+    print(f'compaction          {len(hour_items):6} items, {sum(client.requests.values()) - requests:6} requests, '
+          f'{sum(client.units.values()) - units:7} WCU, deleting the minute items')
+
+    # A site's day
+    site = records[0]['measurementSiteReference']
+    requests = client.requests['TrafficSpeedHourly']
+    day = hourly_xml.read_hours(client, 'TrafficSpeedHourly', site, '2017-12-31T00', hours=24)
+
+    assert [record['measurementTimeDefault'] for record in day] == [timestamp for timestamp, _ in files
+                                                                       if timestamp < '2018-01-01']
+    assert all(record['ns1:measuredValue'] == records[0]['ns1:measuredValue'] for record in day)
+    print(f'one site, one day   {len(day):6} minutes read with {client.requests["TrafficSpeedHourly"] - requests} '
+          f'BatchGetItem request for 24 hour items, instead of a Query over {len(day)} minute items')
+
+
+if __name__ == '__main__':
+    main()
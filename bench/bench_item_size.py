@@ -0,0 +1,58 @@
+"""
+Compares the plain and the packed encodings of the DynamoDB items of the sample file:
+the item sizes as DynamoDB counts them, the write capacity units they take,
+and the CPU time of encoding them. Checks that the packed readings decode to the extracted ones.
+
+Usage: ``python bench/bench_item_size.py``
+"""
+import math
+from io import BytesIO
+
+from sample import load_schema, read_sample, best_of, report
+
+import dynamo_xml
+import packed_xml
+import schemas_xml
+import stream_xml
+
+
+def size_report(name, items):
+    sizes = [dynamo_xml.item_size(item) for item in items]
+    units = sum(math.ceil(size / 1024) for size in sizes)
+
+    print(f'{name:<10} {sum(sizes) / len(sizes):8.0f} B per item (max {max(sizes)} B), '
+          f'{units} WCU for {len(items)} items ({units / len(items):.2f} per item)')
+    return units
+
+
+def main():
+    data_sch, pref = load_schema()
+    plan = schemas_xml.compile_schema(data_sch, pref)
+    records = list(stream_xml.stream_data(BytesIO(read_sample()), plan, lambda _: None))
+
+    encoder = dynamo_xml.compile_encoder(plan)
+    packed_encoder = packed_xml.packed_encoder(encoder)
+
+    plain_items = [encoder(record) for record in records]
+    packed_items = [packed_encoder(record) for record in records]
+
+    packed = 0
+    for record, item in zip(records, packed_items):
+        if packed_xml.packed_field in item:
+            packed += 1
+            readings = packed_xml.unpack_readings(item[packed_xml.packed_field]['B'])
+            assert readings == record[packed_xml.readings_field], record['measurementSiteReference']
+
+    print(f'{len(records)} items, {packed} packed, {len(records) - packed} left in the plain encoding')
+    plain_units = size_report('plain', plain_items)
+    packed_units = size_report('packed', packed_items)
+    print(f'{plain_units / packed_units:.2f}x fewer write capacity units')
+
+    plain_time = best_of(lambda: [encoder(record) for record in records])
+    packed_time = best_of(lambda: [packed_encoder(record) for record in records])
+    report('encoding, plain', plain_time)
+    report('encoding, packed', packed_time, plain_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Compares the peak memory of the whole-file path (read, decompress, decode, build the tree, extract)
+with the streaming path on a GZIP file made of copies of the sample's site measurements.
+
+Usage: ``python bench/bench_memory.py [copies]``
+"""
+import gzip
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from sample import load_schema, make_copies
+
+import schemas_xml
+import stream_xml
+from xml.etree.ElementTree import fromstring
+
+
+def make_file(path, copies):
+    """
+    Writes a GZIP file with the sample's site measurements repeated ``copies`` times.
+    """
+    with gzip.open(path, 'wb') as f:
+        f.write(make_copies(copies))
+
+
+class Body:
+    """
+    Stands in for S3's ``StreamingBody``, which can only be read forward.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+
+    def read(self, amt=None):
+        return self.file.read(amt)
+
+
+def run_whole(path, plan, log):
+    stages = []
+
+    contents = Body(path).read()
+    stages.append(('read', len(contents)))
+    contents = gzip.decompress(contents)
+    stages.append(('decompress', len(contents)))
+    xml_data = fromstring(contents.decode('utf-8'))
+    stages.append(('parse', len(contents)))
+    data = schemas_xml.run_plan(plan, xml_data, log).popitem()[1]
+    stages.append(('extract', len(data)))
+
+    return stages
+
+
+def run_stream(path, plan, log):
+    stages = []
+    pipeline = stream_xml.Pipeline()
+
+    with stream_xml.PrefetchReader(Body(path), stats=pipeline.stage('download')) as downloaded:
+        source, raw = stream_xml.open_body(downloaded, True)
+        stream_xml.scan_header(source, '{http://datex2.eu/schema/2/2_0}publicationTime')
+        stages.append(('header', raw.bytes_read))
+        source.replay()
+
+        size = 0
+        with stream_xml.PrefetchReader(source, stats=pipeline.stage('decompress')) as prefetched:
+            records = stream_xml.chunks(stream_xml.stream_data(prefetched, plan, log), 500)
+
+            with stream_xml.PrefetchIterator(records, stats=pipeline.stage('parse')) as parsed:
+                with pipeline.stage('write').working():
+                    for chunk in parsed:
+                        size += len(chunk)
+
+    stages.append(('extract', size))
+    stages.append(('total', raw.bytes_read))
+
+    for line in pipeline.report():
+        print(f'    {line}')
+
+    return stages
+
+
+def child(mode, path):
+    data_sch, pref = load_schema()
+    plan = schemas_xml.compile_schema(data_sch, pref)
+    start = time.perf_counter()
+
+    stages = {'whole': run_whole, 'stream': run_stream}[mode](path, plan, lambda _: None)
+
+    print(f'{mode}: {time.perf_counter() - start:.2f} s, peak RSS {stream_xml.peak_rss():.1f} MiB')
+    for stage, count in stages:
+        print(f'    {stage:<12}{count:>14,}')
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        child(sys.argv[2], sys.argv[3])
+        return
+
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'Trafficspeed.gz')
+        make_file(path, copies)
+        print(f'{copies * 200} sites, {os.path.getsize(path):,} bytes compressed')
+
+        for mode in ('whole', 'stream'):
+            subprocess.run([sys.executable, __file__, '--child', mode, path], check=True)
+
+
+if __name__ == '__main__':
+    main()
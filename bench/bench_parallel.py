@@ -0,0 +1,56 @@
+"""
+Measures the parallel extraction with 1, 2, 4, and 8 worker processes, against the extraction in a single thread.
+
+The parent process reads the document and splits it into parts on expat's events, which takes a share of the
+serial extraction's time, the rest is spread over the workers. The speedup is bounded by that share,
+and only shows with as many CPUs as workers.
+
+Usage: ``python bench/bench_parallel.py [copies]``
+"""
+import os
+import sys
+import time
+from io import BytesIO
+
+from sample import load_schema, make_copies
+
+import parallel_xml
+import schemas_xml
+import stream_xml
+
+
+def main():
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    parallel_xml.start_workers(8)  # before any thread is started
+    contents = make_copies(copies)
+    data_sch, pref = load_schema()
+    plan = schemas_xml.compile_schema(data_sch, pref)
+    tag = stream_xml.array_entry(plan).tag
+
+    print(f'{copies * 200} sites, {len(contents):,} bytes, {os.cpu_count()} CPU(s)')
+
+    start = time.perf_counter()
+    count = sum(1 for _ in stream_xml.stream_data(BytesIO(contents), plan, lambda _: None))
+    serial = time.perf_counter() - start
+    print(f'single thread:  {count} records in {serial:.2f} s')
+
+    start = time.perf_counter()
+    parts = sum(1 for _ in parallel_xml.split_records(BytesIO(contents), tag))
+    split = time.perf_counter() - start
+    print(f'splitting only: {parts} parts in {split:.2f} s, the speedup is at most {serial / split:.1f}x')
+
+    for processes in (1, 2, 4, 8):
+        start = time.perf_counter()
+        parent = time.process_time()
+        records = parallel_xml.stream_parallel(BytesIO(contents), plan, (data_sch, pref), lambda _: None,
+                                               processes=processes)
+        count = sum(1 for _ in records)
+        seconds = time.perf_counter() - start
+        parent = time.process_time() - parent
+
+        print(f'{processes} process(es): {count} records in {seconds:.2f} s ({serial / seconds:.2f}x), '
+              f'{parent:.2f} s CPU in the parent')
+
+
+if __name__ == '__main__':
+    main()
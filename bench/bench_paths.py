@@ -0,0 +1,90 @@
+"""
+Compares descendant lookups (the sample schema) with explicit child paths (the same schema rewritten)
+by the number of nodes visited per record and by the extraction time.
+"""
+from xml.etree.ElementTree import fromstring
+
+import yaml
+
+from sample import load_schema, read_sample, best_of, report
+
+import schemas_xml
+
+explicit_schema = """
+ns1.siteMeasurements[]:
+  /ns1.measurementSiteReference: _.id, str, measurementSiteReference
+  /ns1.measurementTimeDefault: text, timestamp, measurementTimeDefault
+  /ns1.measuredValue[]:
+  - _: '.[@index]'
+    _.index: int, Channel
+    /ns1.measuredValue/ns1.basicData:
+    - _: '.[@xsi:type="TrafficFlow"]'
+      _.xsi.type: text, Type
+      /ns1.vehicleFlow/ns1.vehicleFlowRate: text, float, Flow
+    - _: '.[@xsi:type="TrafficSpeed"]'
+      _.xsi.type: text, Type
+      /ns1.averageVehicleSpeed:
+        _.numberOfInputValuesUsed: int, InputSize
+        /ns1.speed: text, float, Speed
+"""
+
+
+def count_visits(find_nodes, counter):
+    """
+    Wraps :func:`schemas_xml.find_nodes`, counting the nodes each lookup visits.
+    """
+    def walk(node, steps):
+        for child in node:
+            counter[0] += 1
+            if child.tag == steps[0]:
+                if steps[1:]:
+                    yield from walk(child, steps[1:])
+                else:
+                    yield child
+
+    def counting(entry, root):
+        if entry.axis == schemas_xml.DESCENDANT:
+            for node in root.iter():
+                counter[0] += 1
+                if node.tag == entry.tag:
+                    yield node
+        else:
+            yield from walk(root, entry.steps)
+
+    return counting
+
+
+def main():
+    data_sch, pref = load_schema()
+    root = fromstring(read_sample())
+
+    def log(_):
+        pass
+
+    plans = [
+        ('descendant (Traffic.yml)', schemas_xml.compile_schema(data_sch, pref)),
+        ('explicit paths', schemas_xml.compile_schema(yaml.safe_load(explicit_schema), pref)),
+    ]
+
+    records = [schemas_xml.run_plan(plan, root, log) for _, plan in plans]
+    assert records[0] == records[1]
+    count = len(records[0]['ns1:siteMeasurements'])
+
+    find_nodes = schemas_xml.find_nodes
+    for name, plan in plans:
+        counter = [0]
+        schemas_xml.find_nodes = count_visits(find_nodes, counter)
+        schemas_xml.run_plan(plan, root, log)
+        schemas_xml.find_nodes = find_nodes
+
+        print(f'{name:<40} {counter[0] / count:10.1f} nodes visited per record')
+
+    baseline = None
+    for name, plan in plans:
+        seconds = best_of(lambda: schemas_xml.run_plan(plan, root, log))
+        report(name, seconds, baseline)
+        baseline = baseline or seconds
+
+
+if __name__ == '__main__':
+    main()
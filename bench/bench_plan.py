@@ -0,0 +1,32 @@
+"""
+Compares the schema interpreter with the compiled extraction plan on the sample file.
+"""
+from xml.etree.ElementTree import fromstring
+
+from sample import load_schema, read_sample, best_of, report
+
+import schemas_xml
+
+
+def main():
+    data_sch, pref = load_schema()
+    root = fromstring(read_sample())
+
+    def log(_):
+        pass
+
+    assert schemas_xml.interpret_data(root, data_sch, pref, log) == schemas_xml.extract_data(root, data_sch, pref, log)
+
+    plan = schemas_xml.compile_schema(data_sch, pref)
+
+    interpreted = best_of(lambda: schemas_xml.interpret_data(root, data_sch, pref, log))
+    compiled = best_of(lambda: schemas_xml.run_plan(plan, root, log))
+    compile_time = best_of(lambda: schemas_xml.compile_schema(data_sch, pref), number=100)
+
+    report('interpret_data', interpreted)
+    report('run_plan (precompiled)', compiled, interpreted)
+    report('compile_schema', compile_time)
+
+
+if __name__ == '__main__':
+    main()
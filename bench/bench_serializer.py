@@ -0,0 +1,71 @@
+"""
+Compares the CPU time of encoding the records of the sample as DynamoDB items:
+boto3's ``TypeSerializer``, which a DynamoDB resource runs on every item it writes,
+with the encoder compiled from the schema, whose items are sent with a plain client.
+
+Usage: ``python bench/bench_serializer.py [items]``
+"""
+import sys
+import time
+from io import BytesIO
+
+from sample import load_schema, make_copies, report
+
+import dynamo_xml
+import schemas_xml
+import stream_xml
+
+try:
+    from boto3.dynamodb.types import TypeSerializer
+except ImportError:  # only the compiled encoder can be measured
+    TypeSerializer = None
+
+
+def cpu_time(func, repeat=3):
+    """
+    :return: the best CPU time of a call to ``func``, in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        func()
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    data_sch, pref = load_schema()
+    plan = schemas_xml.compile_schema(data_sch, pref)
+    sample = list(stream_xml.stream_data(BytesIO(make_copies(10)), plan, lambda _: None))
+    records = (sample * (count // len(sample) + 1))[:count]
+
+    encoder = dynamo_xml.compile_encoder(plan)
+    encoded = cpu_time(lambda: [encoder(record) for record in records])
+    generic = cpu_time(lambda: [dynamo_xml.encode_value(record)['M'] for record in records])
+
+    print(f'{count} items, CPU time per {count} items')
+
+    if TypeSerializer is not None:
+        serializer = TypeSerializer()
+
+        def serialize(record):
+            return {field: serializer.serialize(value) for field, value in record.items()}
+
+        assert [serialize(record) for record in sample] == [encoder(record) for record in sample]
+
+        serialized = cpu_time(lambda: [serialize(record) for record in records])
+        report('    TypeSerializer (resource)', serialized)
+        report('    encode_value (generic)', generic, serialized)
+        report('    compiled encoder (client)', encoded, serialized)
+    else:
+        print('    boto3 is not installed, TypeSerializer is not measured')
+        report('    encode_value (generic)', generic)
+        report('    compiled encoder (client)', encoded, generic)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Simulates the write burst of a data file against a table with an index keyed on the time,
+on a local stand-in for DynamoDB that limits the write units per second of each index partition.
+Compares the time key on its own with the sharded key schemes, and the fan-out query of a time over the shards
+with querying the shards one after another.
+
+Usage: ``python bench/bench_shards.py [copies]``
+"""
+import sys
+import threading
+import time
+from io import BytesIO
+
+from bench_writer import Throttled
+from sample import load_schema, make_copies
+
+import dynamo_xml
+import packed_xml
+import schemas_xml
+import shards_xml
+import stream_xml
+
+key_fields = ['measurementSiteReference', 'measurementTimeDefault']
+
+
+class PartitionedDynamoDB:
+    """
+    A stand-in for a DynamoDB client with a single table and an index keyed on ``index_field``,
+    where every value of the index key is a partition taking ``capacity`` write units per second
+    (an item is a unit, they're packed), with up to a second's worth of burst capacity.
+    Each request takes ``latency`` seconds.
+    """
+    def __init__(self, table_name, index_field, capacity, latency=0.005, page_size=100):
+        self.table_name = table_name
+        self.index_field = index_field
+        self.capacity = capacity
+        self.latency = latency
+        self.page_size = page_size
+        self.items = {}
+        self.partitions = {}  # the tokens and the last refill of each partition
+        self.lock = threading.Lock()
+
+    def _take(self, partition):
+        now = time.perf_counter()
+        tokens, refilled = self.partitions.get(partition, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - refilled) * self.capacity)
+
+        if tokens < 1:
+            self.partitions[partition] = (tokens, now)
+            return False
+
+        self.partitions[partition] = (tokens - 1, now)
+        return True
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity='NONE'):
+        time.sleep(self.latency)
+
+        written = []
+        unprocessed = []
+        with self.lock:
+            for request in RequestItems[self.table_name]:
+                item = request['PutRequest']['Item']
+                if self._take(item[self.index_field]['S']):
+                    self.items[tuple(item[field]['S'] for field in key_fields)] = item
+                    written.append(request)
+                else:
+                    unprocessed.append(request)
+
+        if not written:
+            raise Throttled('ProvisionedThroughputExceededException')
+
+        response = {'UnprocessedItems': {self.table_name: unprocessed} if unprocessed else {}}
+        if ReturnConsumedCapacity != 'NONE':
+            response['ConsumedCapacity'] = [{'TableName': self.table_name, 'CapacityUnits': float(len(written))}]
+        return response
+
+    def query(self, TableName, IndexName, KeyConditionExpression, ExpressionAttributeNames,
+              ExpressionAttributeValues, ExclusiveStartKey=None):
+        time.sleep(self.latency)
+
+        field = ExpressionAttributeNames['#shard']
+        value = ExpressionAttributeValues[':shard']['S']
+        with self.lock:
+            found = sorted((key for key, item in self.items.items() if item[field]['S'] == value))
+
+        if ExclusiveStartKey is not None:
+            found = [key for key in found if key > tuple(ExclusiveStartKey[name]['S'] for name in key_fields)]
+
+        page = [self.items[key] for key in found[:self.page_size]]
+        response = {'Items': page}
+        if len(found) > self.page_size:
+            response['LastEvaluatedKey'] = {name: page[-1][name] for name in key_fields}
+        return response
+
+
+def main():
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    data_sch, pref = load_schema()
+    plan = schemas_xml.compile_schema(data_sch, pref)
+    records = list(stream_xml.stream_data(BytesIO(make_copies(copies)), plan, lambda _: None))
+
+    # The copies repeat the sites, give each copy its own sites, all at the same time as in a data file
+    timestamp = records[0]['measurementTimeDefault']
+    for i, record in enumerate(records):
+        record['measurementSiteReference'] = f'{record["measurementSiteReference"]}/{i // 200}'
+        record['measurementTimeDefault'] = timestamp
+    encoder = packed_xml.packed_encoder(dynamo_xml.compile_encoder(plan))
+
+    capacity = 1000
+    print(f'{len(records)} items of a minute, index partitions of {capacity} WCU/s')
+
+    for name, spec in [('time key', ''), ('hash:4', 'hash:4'), ('hash:16', 'hash:16'), ('prefix:5', 'prefix:5')]:
+        scheme = shards_xml.parse_scheme(spec, prefixes=sorted({record['measurementSiteReference'][:5]
+                                                                for record in records}))
+        if scheme is None:
+            scheme = shards_xml.HashShards(1)  # a single shard, the index is keyed on the time alone
+        table = PartitionedDynamoDB('TrafficSpeed', shards_xml.shard_field, capacity)
+
+        items = list(map(shards_xml.shard_encoder(encoder, scheme), records))
+        with dynamo_xml.ParallelWriter(table, 'TrafficSpeed', key_fields, streams=8) as writer:
+            for chunk in stream_xml.chunks(items, 500):
+                writer.put_items(chunk)
+
+        keys = scheme.shard_keys(timestamp)
+        started = time.perf_counter()
+        found = shards_xml.query_shards(table, 'TrafficSpeed', 'timeShard-index', keys)
+        fan_out = time.perf_counter() - started
+
+        started = time.perf_counter()
+        one_by_one = shards_xml.query_shards(table, 'TrafficSpeed', 'timeShard-index', keys, workers=1)
+        sequential = time.perf_counter() - started
+
+        assert len(found) == len(records) and found == one_by_one
+        print(f'{name:<10} {len(keys):3} shards  {writer.report()}')
+        print(f'{"":<10} query of the minute: {fan_out * 1e3:.0f} ms fanned out, {sequential * 1e3:.0f} ms sequential')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Runs the parallel DynamoDB writer against a local stand-in for DynamoDB,
+that takes a while to answer each request, and throttles the writes beyond its provisioned capacity.
+Checks that every record of the sample ends up in the table, and compares the writer's throughput
+with a single stream of requests.
+
+Usage: ``python bench/bench_writer.py [copies]``
+"""
+import json
+import math
+import sys
+import threading
+import time
+from io import BytesIO
+
+from sample import load_schema, make_copies
+
+import dynamo_xml
+import schemas_xml
+import stream_xml
+
+key_fields = ['measurementSiteReference', 'measurementTimeDefault']
+
+
+class Throttled(Exception):
+    """
+    Stands in for botocore's ``ClientError``.
+    """
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class LocalDynamoDB:
+    """
+    A stand-in for a DynamoDB client with a single table.
+    Each request takes ``latency`` seconds, and the table accepts ``capacity`` write units per second
+    (a unit per started KiB of an item), with up to a second's worth of burst capacity.
+    Beyond that, a request is rejected with a throttling error if no item fits,
+    and the items that don't fit are returned as unprocessed otherwise.
+    """
+    def __init__(self, table_name, latency=0.01, capacity=None):
+        self.table_name = table_name
+        self.latency = latency
+        self.capacity = capacity
+        self.items = {}
+        self.tokens = capacity or 0.0
+        self.refilled = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def _take(self, units):
+        if self.capacity is None:
+            return True
+
+        now = time.perf_counter()
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled) * self.capacity)
+        self.refilled = now
+
+        if self.tokens < units:
+            return False
+        self.tokens -= units
+        return True
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity='NONE'):
+        time.sleep(self.latency)
+
+        requests = RequestItems[self.table_name]
+        assert len(requests) <= dynamo_xml.max_batch
+
+        keys = [tuple(dynamo_xml.key_value(request['PutRequest']['Item'][field]) for field in key_fields)
+                for request in requests]
+        assert len(set(keys)) == len(keys), 'duplicate keys in a batch'
+
+        written = []
+        unprocessed = []
+        consumed = 0
+
+        with self.lock:
+            for key, request in zip(keys, requests):
+                units = math.ceil(len(json.dumps(request['PutRequest']['Item'])) / 1024)
+
+                if not unprocessed and self._take(units):
+                    self.items[key] = request['PutRequest']['Item']
+                    written.append(request)
+                    consumed += units
+                else:
+                    unprocessed.append(request)
+
+        if not written:
+            raise Throttled('ProvisionedThroughputExceededException')
+
+        response = {'UnprocessedItems': {self.table_name: unprocessed} if unprocessed else {}}
+        if ReturnConsumedCapacity != 'NONE':
+            response['ConsumedCapacity'] = [{'TableName': self.table_name, 'CapacityUnits': float(consumed)}]
+
+        return response
+
+
+def main():
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    data_sch, pref = load_schema()
+    plan = schemas_xml.compile_schema(data_sch, pref)
+    records = list(stream_xml.stream_data(BytesIO(make_copies(copies)), plan, lambda _: None))
+
+    # The copies repeat the sites, give each copy its own time so the keys differ
+    for i, record in enumerate(records):
+        record['measurementTimeDefault'] = f'{i // 200}/{record["measurementTimeDefault"]}'
+    expected = {tuple(record[field] for field in key_fields) for record in records}
+    items = list(map(dynamo_xml.compile_encoder(plan), records))
+
+    print(f'{len(records)} records')
+
+    for name, streams, capacity in [('1 stream', 1, None), ('8 streams', 8, None),
+                                    ('8 streams, throttled', 8, 2000), ('16 streams, throttled', 16, 2000)]:
+        table = LocalDynamoDB('TrafficSpeed', capacity=capacity)
+        writer = dynamo_xml.ParallelWriter(table, 'TrafficSpeed', key_fields, streams=streams)
+
+        with writer:
+            for chunk in stream_xml.chunks(items, 500):
+                writer.put_items(chunk)
+
+        assert set(table.items) == expected, f'{name}: {len(expected - set(table.items))} records missing'
+        print(f'{name:<24} {writer.report()}')
+
+
+if __name__ == '__main__':
+    main()
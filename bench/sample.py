@@ -0,0 +1,56 @@
+"""
+Shared helpers for the benchmarks: loads the sample data file and its schema from `test/`.
+Run the benchmarks from the repository root, e.g., ``python bench/bench_plan.py``.
+"""
+import os
+import sys
+import timeit
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(root_dir, 'src', 'lambda_xml'))
+
+import yaml  # noqa: E402
+
+sample_xml = os.path.join(root_dir, 'test', 'sample_Trafficspeed.xml')
+sample_yml = os.path.join(root_dir, 'test', 'Traffic.yml')
+
+
+def load_schema():
+    """
+    :return: the data schema and the namespace prefixes from the sample schema file
+    """
+    with open(sample_yml) as f:
+        schema = yaml.safe_load(f)
+
+    return schema['processing']['data'], schema['processing']['prefixes']
+
+
+def read_sample():
+    with open(sample_xml, 'rb') as f:
+        return f.read()
+
+
+def make_copies(copies):
+    """
+    :return: the sample document with its site measurements repeated ``copies`` times
+    """
+    contents = read_sample()
+    start = contents.index(b'<ns1:siteMeasurements>')
+    end = contents.rindex(b'</ns1:siteMeasurements>') + len(b'</ns1:siteMeasurements>')
+
+    return contents[:start] + contents[start:end] * copies + contents[end:]
+
+
+def best_of(func, repeat=5, number=1):
+    """
+    :return: the best time of a single call to ``func``, in seconds
+    """
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def report(name, seconds, baseline=None, unit='ms'):
+    scale = {'s': 1, 'ms': 1e3, 'us': 1e6}[unit]
+    line = f'{name:<40} {seconds * scale:10.2f} {unit}'
+    if baseline is not None:
+        line += f'  ({baseline / seconds:.2f}x)'
+    print(line)
@@ -17,14 +17,16 @@ colors = {
     -1: 'lightgray',
     0: 'green',
     1: 'red',
-    2: 'orange'
+    2: 'orange',
+    3: 'lightblue'
 }
 
 status = {
     -1: 'No Traffic Data Received',
     0: 'Processing Finished',
     1: 'Processing Failed',
-    2: 'Currently Processing'
+    2: 'Currently Processing',
+    3: 'Skipped (Duplicate)'
 }
 
 # Initializing the plot
@@ -61,7 +63,7 @@ def table_plot():
                     'color': colors[i]
                 },
                 name=status[i]
-            ) for i in range(-1, 3, 1)
+            ) for i in range(-1, 4, 1)
         ],
         'layout': go.Layout(
             # width=1200,
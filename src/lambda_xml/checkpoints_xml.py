@@ -0,0 +1,77 @@
+#
+# The table for the progress of the data files that didn't fit into a single invocation
+#
+
+xml_checkpoints_table = 'xml_checkpoints'
+key_field, key_props = 'file', 'text'
+etag_field, etag_props = 'etag', 'text'
+records_field, records_props = 'records_written', 'bigint NOT NULL'
+time_field, time_props = 'date_time_utc', 'timestamp without time zone'
+xml_checkpoints_pk = f'{key_field}'
+
+
+def create_checkpoints_table(connection):
+    cur = connection.cursor()
+    cur.execute(
+        f"CREATE TABLE IF NOT EXISTS {xml_checkpoints_table} ("
+        f"{key_field} {key_props},"
+        f"{etag_field} {etag_props},"
+        f"{records_field} {records_props},"
+        f"{time_field} {time_props},"
+        f"PRIMARY KEY ({xml_checkpoints_pk}));")
+
+    connection.commit()
+
+
+def save_checkpoint(connection, object_key, etag, records):
+    """
+    Records how far the processing of a file got.
+
+    :param connection: a connection to the database
+    :param object_key: the file's key in S3
+    :type object_key: str
+    :param etag: the file's ETag, a checkpoint is only used for the same version of the file
+    :type etag: str
+    :param records: the number of records written so far, in the file's order
+    :type records: int
+    """
+    create_checkpoints_table(connection)
+
+    cur = connection.cursor()
+    cur.execute(
+        f"INSERT INTO {xml_checkpoints_table} ({key_field}, {etag_field}, {records_field}, {time_field}) "
+        f"VALUES (%s, %s, %s, now() at time zone 'utc') "
+        f"ON CONFLICT ({key_field}) DO UPDATE SET "
+        f"{etag_field} = EXCLUDED.{etag_field}, "
+        f"{records_field} = EXCLUDED.{records_field}, "
+        f"{time_field} = EXCLUDED.{time_field};",
+        (object_key, etag, records))
+
+    connection.commit()
+
+
+def load_checkpoint(connection, object_key, etag):
+    """
+    :return: the number of records of the file already written, 0 if there's no checkpoint for this version
+    :type: int
+    """
+    create_checkpoints_table(connection)
+
+    cur = connection.cursor()
+    cur.execute(f"SELECT {records_field} FROM {xml_checkpoints_table} "
+                f"WHERE {key_field} = %s AND {etag_field} = %s;", (object_key, etag))
+
+    row = cur.fetchone()
+    connection.commit()
+
+    return row[0] if row is not None else 0
+
+
+def clear_checkpoint(connection, object_key):
+    """
+    Removes a file's checkpoint once the file is processed.
+    """
+    cur = connection.cursor()
+    cur.execute(f"DELETE FROM {xml_checkpoints_table} WHERE {key_field} = %s;", (object_key,))
+
+    connection.commit()
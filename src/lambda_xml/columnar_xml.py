@@ -0,0 +1,310 @@
+from array import array
+from collections import OrderedDict, namedtuple
+
+from logs import ExtractionError, no_node
+from schemas_xml import AttribEntry, MapEntry, ListEntry, convert_val, find_nodes, get_converter, select_option
+from stream_xml import array_entry, stream_nodes
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, the columns are plain arrays without it
+    numpy = None
+
+#
+# Columnar extraction: instead of a dict per record, the values go into flat typed columns.
+# Every array entry of the schema becomes a table, with a row per matching node,
+# and the nested tables refer to their parent rows by index. E.g., for the traffic schema,
+# the `ns1:siteMeasurements` table holds the sites and their measurement times,
+# and the `ns1:measuredValue` table holds the channels with their types, flows, and speeds.
+#
+
+missing_int = -2 ** 63  # stands for missing and broken values in integer columns, floats use NaN
+missing_bool = -1
+
+# The compiled layout of a table: the array entry that fills its rows,
+# and the column kinds keyed on the field names
+TableLayout = namedtuple('TableLayout', 'name parent entry kinds')
+
+
+def column_kind(convert):
+    """
+    :return: the array type code for a value converter, or ``str`` for values stored as strings
+    """
+    if convert is get_converter('int'):
+        return 'q'
+    elif convert is get_converter('float'):
+        return 'd'
+    elif convert is get_converter('bool'):
+        return 'b'
+    return 'str'
+
+
+class Column:
+    """
+    A column of values of one field.
+    Numbers are kept in an ``array``, strings are dictionary-encoded:
+    an ``array`` of codes indexing into the list of distinct strings.
+    """
+    def __init__(self, kind):
+        self.kind = kind
+
+        if kind == 'str':
+            self.codes = array('l')
+            self.categories = []
+            self.index = {}
+        else:
+            self.values = array(kind)
+
+    def __len__(self):
+        return len(self.codes if self.kind == 'str' else self.values)
+
+    def append(self, value):
+        if self.kind == 'str':
+            code = self.index.get(value)
+            if code is None:
+                code = self.index[value] = len(self.categories)
+                self.categories.append(value)
+            self.codes.append(code)
+
+        # Placeholders of broken values (and `None`) are strings, so they become missing numbers
+        elif self.kind == 'd':
+            self.values.append(float(value) if value is not None and not isinstance(value, str) else float('nan'))
+        elif self.kind == 'q':
+            self.values.append(value if isinstance(value, int) else missing_int)
+        else:
+            self.values.append(value if isinstance(value, bool) else missing_bool)
+
+    def pad(self, size):
+        """
+        Appends missing values up to the given length.
+        """
+        while len(self) < size:
+            self.append(None)
+
+    def to_list(self):
+        """
+        :return: the column's values as a list, with the strings decoded
+        """
+        if self.kind == 'str':
+            return [self.categories[code] for code in self.codes]
+        return self.values.tolist()
+
+    def to_numpy(self):
+        """
+        :return: the column as a NumPy array sharing the column's buffer,
+                the codes for the string columns (the strings are in ``categories``)
+        """
+        if numpy is None:
+            raise ImportError('NumPy is not installed')
+
+        return numpy.frombuffer(self.codes if self.kind == 'str' else self.values,
+                                dtype={'l': numpy.int_, 'q': numpy.int64, 'd': numpy.float64, 'b': numpy.int8}
+                                ['l' if self.kind == 'str' else self.kind])
+
+
+class Table:
+    """
+    The rows extracted for an array entry.
+    ``parent`` holds the index of each row's parent row in the enclosing table.
+    """
+    def __init__(self, layout):
+        self.layout = layout
+        self.rows = 0
+        self.parent = array('q')
+        self.columns = OrderedDict((field, Column(kind)) for field, kind in layout.kinds.items())
+
+    def start_row(self, parent):
+        self.rows += 1
+        self.parent.append(parent)
+        return self.rows - 1
+
+    def end_row(self):
+        for column in self.columns.values():
+            if len(column) < self.rows:
+                column.pad(self.rows)
+
+    def nbytes(self):
+        """
+        :return: the size of the column buffers, in bytes
+        """
+        size = self.parent.itemsize * len(self.parent)
+        for column in self.columns.values():
+            buffer = column.codes if column.kind == 'str' else column.values
+            size += buffer.itemsize * len(buffer)
+        return size
+
+
+def compile_columns(plan):
+    """
+    Lays out the tables for columnar extraction with a compiled schema.
+    The schema must have a single top-level array entry,
+    and the entries of a table can hold at most one array entry on each level.
+
+    :param plan: the compiled schema, see :func:`schemas_xml.compile_schema`
+    :type plan: tuple
+    :return: the table layouts, the outermost table first
+    :type: tuple
+    """
+    layouts = []
+
+    def add_table(entry, parent):
+        kinds = OrderedDict()
+        nested = []
+
+        def collect(entries):
+            for sub_entry in entries:
+                if isinstance(sub_entry, AttribEntry):
+                    kinds.setdefault(sub_entry.field, column_kind(sub_entry.convert))
+                elif sub_entry.is_array:
+                    nested.append(sub_entry)
+                elif isinstance(sub_entry, MapEntry):
+                    collect(sub_entry.entries)
+                elif isinstance(sub_entry, ListEntry):
+                    for option in sub_entry.options:
+                        collect(option.entries)
+                else:
+                    kinds.setdefault(sub_entry.field, column_kind(sub_entry.convert))
+
+        if isinstance(entry, MapEntry):
+            collect(entry.entries)
+        elif isinstance(entry, ListEntry):
+            for option in entry.options:
+                collect(option.entries)
+        else:
+            kinds[entry.field] = column_kind(entry.convert)
+
+        if len({sub_entry.field for sub_entry in nested}) > 1:
+            raise ValueError(f'Columnar extraction allows one array entry per level, `{entry.entry}` has more')
+
+        layouts.append(TableLayout(name=entry.field, parent=parent, entry=entry, kinds=kinds))
+        for sub_entry in nested:
+            if sub_entry.field not in {layout.name for layout in layouts}:
+                add_table(sub_entry, entry.field)
+
+    add_table(array_entry(plan), None)
+    return tuple(layouts)
+
+
+class ColumnBatch:
+    """
+    A batch of records extracted into columns, with a :class:`Table` per array entry of the schema.
+    """
+    def __init__(self, layouts):
+        self.tables = OrderedDict((layout.name, Table(layout)) for layout in layouts)
+
+    def __len__(self):
+        """
+        :return: the number of top-level records in the batch
+        """
+        return next(iter(self.tables.values())).rows
+
+    def nbytes(self):
+        return sum(table.nbytes() for table in self.tables.values())
+
+
+def fill_row(entries, node, batch, table, log):
+    """
+    Extracts the values for the current row of a table from a node, following compiled entries.
+    """
+    row = table.rows - 1
+
+    for entry in entries:
+        if isinstance(entry, AttribEntry):
+            table.columns[entry.field].append(convert_val(node.get(entry.attrib), entry, node, log))
+            continue
+
+        # Array entries fill the rows of a nested table
+        if entry.is_array:
+            sub_table = batch.tables[entry.field]
+
+            for sub_node in find_nodes(entry, node):
+                fill_node(entry, sub_node, batch, sub_table, row, log)
+
+            continue
+
+        # Other entries add to the current row
+        for sub_node in find_nodes(entry, node):
+            if isinstance(entry, MapEntry):
+                fill_row(entry.entries, sub_node, batch, table, log)
+                break
+            elif isinstance(entry, ListEntry):
+                option, match = select_option(entry, sub_node)
+                if option is not None:
+                    fill_row(option.entries, match, batch, table, log)
+                    break
+            else:
+                raw_val = sub_node.get(entry.attrib) if entry.attrib is not None else sub_node.text
+                table.columns[entry.field].append(convert_val(raw_val, entry, sub_node, log))
+                break
+        else:
+            log(ExtractionError(entry.entry, no_node, node))
+
+
+def fill_node(entry, node, batch, table, parent, log):
+    """
+    Extracts a row of a table from a node matching the table's array entry.
+    Nodes matching none of a list entry's alternatives are skipped.
+    """
+    if isinstance(entry, MapEntry):
+        table.start_row(parent)
+        fill_row(entry.entries, node, batch, table, log)
+    elif isinstance(entry, ListEntry):
+        option, match = select_option(entry, node)
+        if option is None:
+            return
+        table.start_row(parent)
+        fill_row(option.entries, match, batch, table, log)
+    else:
+        table.start_row(parent)
+        raw_val = node.get(entry.attrib) if entry.attrib is not None else node.text
+        table.columns[entry.field].append(convert_val(raw_val, entry, node, log))
+
+    table.end_row()
+
+
+def extract_columns(nodes, layouts, log):
+    """
+    Extracts the records from the nodes matching the top-level array entry into a column batch.
+
+    :param nodes: the nodes to extract the records from
+    :param layouts: the table layouts, see :func:`compile_columns`
+    :type layouts: tuple
+    :param log: a logger function that takes a string as a single argument
+    :return: the extracted records
+    :type: ColumnBatch
+    """
+    batch = ColumnBatch(layouts)
+    top = next(iter(batch.tables.values()))
+
+    for node in nodes:
+        fill_node(layouts[0].entry, node, batch, top, -1, log)
+
+    return batch
+
+
+def stream_columns(source, layouts, log, batch_size=10000):
+    """
+    Parses an XML document incrementally, see :func:`stream_xml.stream_nodes`,
+    yielding the extracted records in column batches.
+
+    :param source: a file name or a binary file object with the XML document
+    :param layouts: the table layouts, see :func:`compile_columns`
+    :type layouts: tuple
+    :param log: a logger function that takes a string as a single argument
+    :param batch_size: the maximum number of top-level records in a batch
+    :type batch_size: int
+    :return: an iterator over the batches
+    """
+    batch = ColumnBatch(layouts)
+    top = next(iter(batch.tables.values()))
+
+    for node in stream_nodes(source, layouts[0].entry.tag):
+        fill_node(layouts[0].entry, node, batch, top, -1, log)
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = ColumnBatch(layouts)
+            top = next(iter(batch.tables.values()))
+
+    if len(batch) > 0:
+        yield batch
@@ -0,0 +1,52 @@
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
+#
+# Converters for the raw values of the schema types.
+# A data file repeats a handful of timestamps and type names over and over,
+# so the converters memoize their results in bounded caches,
+# and equal strings share a single object.
+#
+
+cache_size = 1024
+
+
+@lru_cache(maxsize=cache_size)
+def validate_timestamp(raw_val):
+    """
+    Checks the format of a timestamp, each distinct timestamp is only parsed once.
+
+    :return: the timestamp as is
+    """
+    datetime.strptime(raw_val, '%Y-%m-%dT%H:%M:%SZ')  # Just for validating the format
+    return raw_val
+
+
+@lru_cache(maxsize=cache_size)
+def share_string(raw_val):
+    """
+    Interns a string, so that equal strings in the extracted records are the same object.
+    The interned strings are kept in a bounded cache and are dropped when they aren't seen for a while.
+
+    :return: the string equal to ``raw_val``, that was seen first
+    """
+    return raw_val
+
+
+@lru_cache(maxsize=cache_size)
+def to_number(raw_val):
+    """
+    Converts a decimal number, integer-valued readings become ``int``, others ``Decimal``.
+    Both are immutable, so the records can share them.
+
+    :return: the number
+    :raises ValueError: if the value isn't a number, like the other converters
+    """
+    if raw_val.__class__ is str and raw_val.isdecimal():
+        return int(raw_val)
+
+    try:
+        return Decimal(raw_val)
+    except InvalidOperation:
+        raise ValueError(f'not a number: {raw_val!r}')
@@ -0,0 +1,493 @@
+import queue
+import random
+import threading
+import time
+from decimal import Decimal
+from functools import lru_cache
+
+from converters_xml import cache_size
+from schemas_xml import AttribEntry, MapEntry, ListEntry, get_converter
+from stream_xml import array_entry
+
+#
+# Writing to DynamoDB with several ``BatchWriteItem`` requests in flight.
+# The number of concurrent requests adapts to the table's capacity:
+# it's halved when DynamoDB throttles the writes (an error, or items returned as unprocessed),
+# and grows by one after as many clean requests as there are streams.
+# The throttled items are retried after a jittered exponential backoff.
+#
+
+max_batch = 25  # the most items a `BatchWriteItem` request takes
+
+# The errors DynamoDB throttles with, anything else fails the writes
+throttling_codes = {'ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded',
+                    'LimitExceededException'}
+
+
+#
+# The items can be sent in DynamoDB's wire format (`{'N': '12'}`, `{'M': {...}}`, etc.) with a plain client,
+# instead of letting a boto3 resource's serializer find out the type of every value of every item.
+# The encoders are compiled from the extraction plan, which tells the type of each field,
+# only the placeholders of the broken values (strings in number fields) need checking.
+# Like the converters, they memoize the scalar values, so the items share them: they must not be modified.
+#
+
+
+def encode_value(value):
+    """
+    Encodes a value of any type as a DynamoDB ``AttributeValue``.
+    """
+    cls = value.__class__
+
+    if cls is str:
+        return {'S': value}
+    elif cls is int or cls is Decimal:
+        return {'N': str(value)}
+    elif cls is bool:
+        return {'BOOL': value}
+    elif cls is dict:
+        return {'M': {key: encode_value(val) for key, val in value.items()}}
+    elif cls is list:
+        return {'L': [encode_value(val) for val in value]}
+    elif value is None:
+        return {'NULL': True}
+    elif cls is float:
+        return {'N': repr(value)}
+
+    raise TypeError(f'Unsupported type for DynamoDB: {cls.__name__}')
+
+
+@lru_cache(maxsize=cache_size, typed=True)
+def encode_number(value):
+    return {'N': str(value)} if value.__class__ is not str else {'S': value}
+
+
+@lru_cache(maxsize=cache_size)
+def encode_string(value):
+    return {'S': value}
+
+
+@lru_cache(maxsize=cache_size, typed=True)
+def encode_bool(value):
+    return {'BOOL': value} if value.__class__ is bool else {'S': value}
+
+
+def value_encoder(convert):
+    """
+    :return: the encoder for the values of a converter, see :func:`schemas_xml.get_converter`
+    """
+    if convert is get_converter('int') or convert is get_converter('float'):
+        return encode_number
+    elif convert is get_converter('bool'):
+        return encode_bool
+    elif convert is get_converter('str') or convert is get_converter('timestamp'):
+        return encode_string
+    return encode_value
+
+
+def fields_encoder(entries):
+    """
+    :return: the encoder for the records extracted with compiled entries, it returns the attributes of a map
+    """
+    encoders = {}
+    for entry in entries:
+        encoder = entry_encoder(entry)
+        if encoders.setdefault(entry.field, encoder) is not encoder:
+            encoders[entry.field] = encode_value  # the alternatives give the field different types
+
+    get = encoders.get
+
+    def encode(record):
+        return {field: get(field, encode_value)(value) for field, value in record.items()}
+
+    return encode
+
+
+def entry_encoder(entry):
+    """
+    :return: the encoder for the values extracted with a compiled entry
+    """
+    if isinstance(entry, AttribEntry):
+        return value_encoder(entry.convert)
+
+    if isinstance(entry, MapEntry):
+        encode_fields = fields_encoder(entry.entries)
+    elif isinstance(entry, ListEntry):
+        encode_fields = fields_encoder([sub_entry for option in entry.options for sub_entry in option.entries])
+    else:
+        encode_fields = None
+
+    if encode_fields is not None:
+        def encode_item(value):
+            return {'M': encode_fields(value)} if value.__class__ is dict else {'S': value}
+    else:
+        encode_item = value_encoder(entry.convert)
+
+    if entry.is_array:
+        return lambda values: {'L': [encode_item(value) for value in values]}
+    return encode_item
+
+
+def compile_encoder(plan):
+    """
+    Compiles a function encoding the records extracted with a plan as DynamoDB items in the wire format,
+    which can be sent with a plain client's ``batch_write_item``.
+
+    :param plan: the compiled schema with a single top-level array entry, see :func:`schemas_xml.compile_schema`
+    :type plan: tuple
+    :return: a function taking a record, and returning the item
+    """
+    entry = array_entry(plan)
+
+    if isinstance(entry, MapEntry):
+        return fields_encoder(entry.entries)
+    elif isinstance(entry, ListEntry):
+        return fields_encoder([sub_entry for option in entry.options for sub_entry in option.entries])
+
+    raise ValueError('The records must be maps to be written to DynamoDB')
+
+
+def decode_value(value):
+    """
+    Decodes a DynamoDB ``AttributeValue``, the numbers become ``int`` or ``Decimal`` as in the extracted records.
+    """
+    kind, data = next(iter(value.items()))
+
+    if kind == 'S' or kind == 'B' or kind == 'BOOL':
+        return data
+    elif kind == 'N':
+        return int(data) if data.lstrip('-').isdecimal() else Decimal(data)
+    elif kind == 'M':
+        return {key: decode_value(val) for key, val in data.items()}
+    elif kind == 'L':
+        return [decode_value(val) for val in data]
+    elif kind == 'NULL':
+        return None
+    elif kind in ('SS', 'NS', 'BS'):
+        return {decode_value({kind[0]: val}) for val in data}
+
+    raise TypeError(f'Unsupported DynamoDB type: {kind}')
+
+
+def value_size(value):
+    """
+    :return: the size of an ``AttributeValue`` in bytes, as DynamoDB counts it for the write capacity
+    """
+    kind, data = next(iter(value.items()))
+
+    if kind == 'S':
+        return len(data.encode())
+    elif kind == 'N':
+        digits = data.lstrip('-').replace('.', '').strip('0')
+        return (len(digits) + 1) // 2 + 1
+    elif kind == 'B':
+        return len(data)
+    elif kind == 'M':
+        return 3 + sum(len(field.encode()) + value_size(val) + 1 for field, val in data.items())
+    elif kind == 'L':
+        return 3 + sum(value_size(val) + 1 for val in data)
+    elif kind in ('SS', 'NS', 'BS'):
+        return sum(value_size({kind[0]: val}) for val in data)
+
+    return 1  # BOOL, NULL
+
+
+def item_size(item):
+    """
+    :param item: an item in the wire format
+    :type item: dict
+    :return: the item's size in bytes, each started KiB of it takes a write capacity unit
+    :type: int
+    """
+    return sum(len(field.encode()) + value_size(value) for field, value in item.items())
+
+
+class WriteError(Exception):
+    """
+    Some of the items couldn't be written.
+    """
+
+
+def key_value(value):
+    """
+    :return: a key attribute's value, of an ``AttributeValue`` if the item is in the wire format
+    """
+    return next(iter(value.values())) if value.__class__ is dict else value
+
+
+def error_code(ex):
+    """
+    :return: the error code of a botocore ``ClientError`` (or anything that looks like one), or ``None``
+    """
+    response = getattr(ex, 'response', None)
+    if not isinstance(response, dict):
+        return None
+
+    return response.get('Error', {}).get('Code')
+
+
+class WriterStats:
+    """
+    The counters of a :class:`ParallelWriter`.
+    """
+    def __init__(self):
+        self.items = 0  # the items written
+        self.requests = 0
+        self.retries = 0  # the requests resending throttled or unprocessed items
+        self.throttled = 0  # the requests rejected with a throttling error
+        self.unprocessed = 0  # the items DynamoDB returned as unprocessed
+        self.capacity = 0.0  # the consumed write capacity units
+        self.started = None
+        self.finished = None
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    def report(self, streams):
+        elapsed = self.elapsed()
+        return (f'Wrote {self.items} items in {elapsed:.2f} s ({self.items / max(elapsed, 1e-9):.0f} items/s), '
+                f'{self.requests} requests, {self.retries} retries, {self.throttled} throttled requests, '
+                f'{self.unprocessed} unprocessed items, {self.capacity:.1f} WCU consumed, '
+                f'{streams} concurrent requests at the end')
+
+
+class ParallelWriter:
+    """
+    Writes items to a DynamoDB table with up to ``streams`` concurrent ``BatchWriteItem`` requests.
+
+    Use as a context manager: the items passed to :meth:`put_items` are only guaranteed to be written
+    after :meth:`flush`, or at the end of the ``with`` block.
+
+    :param client: a DynamoDB client, or a stand-in with the same ``batch_write_item`` method,
+            it takes the items in the wire format, see :func:`compile_encoder`,
+            the client of a boto3 DynamoDB resource takes them as plain Python values
+    :param table_name: the table's name
+    :type table_name: str
+    :param key_fields: the key attributes, of the items with the same key, only the last one is written
+    :type key_fields: list
+    :param streams: the most requests in flight
+    :type streams: int
+    :param max_retries: how many times a batch is retried before giving up
+    :type max_retries: int
+    :param base_delay: the backoff before the first retry, in seconds, it doubles with every retry
+    :type base_delay: float
+    :param max_delay: the longest backoff, in seconds
+    :type max_delay: float
+    """
+    def __init__(self, client, table_name, key_fields, streams=8, max_retries=10, base_delay=0.05, max_delay=5.0):
+        self.client = client
+        self.table_name = table_name
+        self.key_fields = key_fields
+        self.max_streams = streams
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.stats = WriterStats()
+        self.error = None
+
+        self.limit = streams  # the allowed number of requests in flight
+        self.active = 0
+        self.clean = 0  # the requests without throttling since the limit last changed
+        self.decreased = 0.0  # when the limit was last decreased
+        self.condition = threading.Condition()
+
+        self.batch = {}  # the next batch, keyed on the items' keys
+        self.batches = queue.Queue(maxsize=2 * streams)
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(streams)]
+        for thread in self.threads:
+            thread.start()
+
+    def put_items(self, items):
+        """
+        Queues items for writing, blocks while all the streams are busy and the queue is full.
+        Raises :class:`WriteError` if some of the earlier items couldn't be written.
+        """
+        if self.stats.started is None:
+            self.stats.started = time.perf_counter()
+
+        for item in items:
+            self._add_request(item, {'PutRequest': {'Item': item}})
+
+    def delete_keys(self, keys):
+        """
+        Queues the deletion of items, like :meth:`put_items`.
+
+        :param keys: the keys of the items, with the key attributes only
+        """
+        if self.stats.started is None:
+            self.stats.started = time.perf_counter()
+
+        for key in keys:
+            self._add_request(key, {'DeleteRequest': {'Key': key}})
+
+    def flush(self):
+        """
+        Waits until all the queued items are written.
+        Raises :class:`WriteError` if some of them couldn't be written.
+        """
+        if self.batch:
+            self._send_batch()
+
+        self.batches.join()
+        self._check()
+
+    def close(self):
+        for _ in self.threads:
+            self.batches.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        self.stats.finished = time.perf_counter()
+
+    def report(self):
+        """
+        :return: a log message with the throughput, the retries, and the consumed capacity
+        :type: str
+        """
+        return self.stats.report(self.limit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            if exc_type is not None:
+                self.error = self.error or WriteError('The writes were abandoned')  # drop the queued items
+            self.close()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _add_request(self, item, request):
+        self.batch[tuple(key_value(item[field]) for field in self.key_fields)] = request
+
+        if len(self.batch) == max_batch:
+            self._send_batch()
+
+    def _send_batch(self):
+        self._check()
+
+        batch = list(self.batch.values())
+        self.batch = {}
+
+        self.batches.put(batch)
+
+    def _work(self):
+        while True:
+            batch = self.batches.get()
+            try:
+                if batch is None:
+                    return
+
+                if self.error is None:
+                    self._write(batch)
+            except Exception as ex:
+                if self.error is None:
+                    self.error = ex if isinstance(ex, WriteError) else WriteError(f'{type(ex).__name__}: {ex}')
+            finally:
+                self.batches.task_done()
+
+    def _write(self, batch):
+        requests = batch
+        attempt = 0
+
+        while True:
+            self._acquire()
+            try:
+                response = self.client.batch_write_item(RequestItems={self.table_name: requests},
+                                                        ReturnConsumedCapacity='TOTAL')
+            except Exception as ex:
+                if error_code(ex) not in throttling_codes:
+                    self._release(throttled=False)
+                    raise
+
+                self._release(throttled=True)
+                with self.condition:
+                    self.stats.requests += 1
+                    self.stats.throttled += 1
+            else:
+                unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+                self._release(throttled=bool(unprocessed))
+
+                with self.condition:
+                    self.stats.requests += 1
+                    self.stats.items += len(requests) - len(unprocessed)
+                    self.stats.unprocessed += len(unprocessed)
+                    for consumed in response.get('ConsumedCapacity', []):
+                        self.stats.capacity += consumed.get('CapacityUnits', 0.0)
+
+                if not unprocessed:
+                    return
+                requests = unprocessed
+
+            attempt += 1
+            self._backoff(attempt, len(requests))
+
+    def _call(self, method, **kwargs):
+        """
+        Sends a single request, such as an ``UpdateItem``, within the limit of the requests in flight,
+        and retries it while it's throttled.
+
+        :return: the response
+        """
+        attempt = 0
+
+        while True:
+            self._acquire()
+            try:
+                response = method(**kwargs)
+            except Exception as ex:
+                if error_code(ex) not in throttling_codes:
+                    self._release(throttled=False)
+                    raise
+
+                self._release(throttled=True)
+                with self.condition:
+                    self.stats.requests += 1
+                    self.stats.throttled += 1
+            else:
+                self._release(throttled=False)
+                return response
+
+            attempt += 1
+            self._backoff(attempt, 1)
+
+    def _backoff(self, attempt, count):
+        if attempt > self.max_retries:
+            raise WriteError(f'{count} items were still throttled after {self.max_retries} retries')
+
+        with self.condition:
+            self.stats.retries += 1
+        time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+    def _acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def _release(self, throttled):
+        with self.condition:
+            self.active -= 1
+
+            if throttled:
+                # Several requests in flight get throttled at once, that's one decrease
+                now = time.perf_counter()
+                if now - self.decreased > self.base_delay:
+                    self.limit = max(1, self.limit // 2)
+                    self.decreased = now
+                self.clean = 0
+            else:
+                self.clean += 1
+                if self.clean >= self.limit and self.limit < self.max_streams:
+                    self.limit += 1
+                    self.clean = 0
+
+            self.condition.notify_all()
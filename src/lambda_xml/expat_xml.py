@@ -0,0 +1,201 @@
+from xml.etree.ElementTree import Element, SubElement, ParseError
+from xml.parsers.expat import ParserCreate, ExpatError
+
+from schemas_xml import AttribEntry, MapEntry, ListEntry, extract_node, yields_record
+from stream_xml import array_entry
+
+#
+# An extraction engine driven by the compiled schema, built directly on expat's events.
+# Nothing is built for the nodes outside the records, e.g., the envelope, `exchange`, and `headerInformation`.
+# Inside a record, only the nodes with the tags the schema mentions are built.
+# A run of skipped nodes is replaced with a single placeholder node with an empty tag,
+# so that descendant lookups still find the nodes inside it, and child lookups don't see through it.
+#
+
+placeholder_tag = ''
+read_size = 64 * 1024
+
+
+def referenced_tags(plan):
+    """
+    Collects the tags the compiled schema looks up.
+
+    :param plan: the compiled schema
+    :type plan: tuple
+    :return: the tags, or ``None`` if some alternative's pattern is an arbitrary XPath query,
+            which can look at any node
+    :type: set
+    """
+    tags = set()
+    queries = []
+
+    def collect(entries):
+        for entry in entries:
+            if isinstance(entry, AttribEntry):
+                continue
+
+            tags.update(entry.steps)
+
+            if isinstance(entry, ListEntry):
+                for option in entry.options:
+                    if option.test is None:
+                        queries.append(option.pattern)
+                    collect(option.entries)
+            elif isinstance(entry, MapEntry):
+                collect(entry.entries)
+
+    collect(plan)
+    return tags if not queries else None
+
+
+class RecordBuilder:
+    """
+    Handles expat's events, building a node for each record of the top-level array entry,
+    and extracting the record when the node is complete.
+    """
+    def __init__(self, plan, log, skip=0):
+        self.entry = array_entry(plan)
+        self.tags = referenced_tags(plan)
+        self.log = log
+        self.skip = skip  # the records still to pass over without extracting them
+        self.passing = 0  # the depth of the open nodes inside a record passed over without building it
+
+        self.names = {}  # expat's names to the Clark notation
+        self.records = []  # the records extracted since the last time they were taken
+
+        self.depth = 0  # the depth of the open nodes inside the current record, 0 outside the records
+        self.stack = []  # for each open node in a record, the node it's built into
+        self.runs = []  # for each open node in a record, the run of skipped nodes it belongs to, or `None`
+        self.text = None  # the text pieces of the innermost open node, if it is built and has no children yet
+
+    def clark(self, name):
+        clark = self.names.get(name)
+        if clark is None:
+            clark = self.names[name] = '{' + name if '}' in name else name
+        return clark
+
+    def finish_text(self):
+        if self.text is not None:
+            if self.text:
+                self.stack[-1].text = ''.join(self.text)
+            self.text = None
+
+    def start(self, name, attrs):
+        if self.passing:
+            self.passing += 1
+            return
+
+        tag = self.names.get(name) or self.clark(name)
+
+        if self.depth == 0:
+            if tag != self.entry.tag:
+                return
+
+            # Every node is a record, unless the entry has alternatives, which need the node to match
+            if self.skip > 0 and not isinstance(self.entry, ListEntry):
+                self.skip -= 1
+                self.passing = 1
+                return
+
+            # A new record
+            node = Element(tag, {self.clark(k): v for k, v in attrs.items()} if attrs else {})
+            self.stack.append(node)
+            self.runs.append(None)
+            self.depth = 1
+            self.text = []
+            return
+
+        if self.text is not None:
+            self.finish_text()
+
+        self.depth += 1
+        parent = self.stack[-1]
+        run = self.runs[-1]
+
+        # A node the schema doesn't mention: join (or start) the run of skipped nodes
+        if self.tags is not None and tag not in self.tags:
+            self.stack.append(parent)
+            self.runs.append(run if run is not None else [parent, None])
+            return
+
+        # A node the schema mentions, inside a run of skipped nodes: it goes into the run's placeholder
+        if run is not None:
+            if run[1] is None:
+                run[1] = SubElement(run[0], placeholder_tag)
+            parent = run[1]
+
+        node = SubElement(parent, tag, {self.clark(k): v for k, v in attrs.items()} if attrs else {})
+        self.stack.append(node)
+        self.runs.append(None)
+        self.text = []
+
+    def end(self, name):
+        if self.passing:
+            self.passing -= 1
+            return
+
+        if self.depth == 0:
+            return
+
+        if self.text is not None:
+            self.finish_text()
+
+        self.depth -= 1
+        node = self.stack.pop()
+        self.runs.pop()
+
+        if self.depth == 0:
+            if self.skip > 0:
+                if yields_record(self.entry, node):
+                    self.skip -= 1
+                return
+
+            record = extract_node(self.entry, node, self.log)
+            if record is not None:
+                self.records.append(record)
+
+    def data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+
+def stream_data(source, plan, log, skip=0):
+    """
+    Parses an XML document with expat, yielding one record per node that matches
+    the schema's top-level array entry.
+    Produces the same records as :func:`stream_xml.stream_data`.
+
+    :param source: a file name or a binary file object with the XML document
+    :param plan: the compiled schema with a single top-level array entry, see :func:`schemas_xml.compile_schema`
+    :type plan: tuple
+    :param log: a logger function that takes a string as a single argument
+    :param skip: the number of records to pass over without extracting them, e.g., those written before a checkpoint
+    :type skip: int
+
+    :return: an iterator over the extracted records
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            yield from stream_data(f, plan, log, skip)
+        return
+
+    builder = RecordBuilder(plan, log, skip)
+
+    parser = ParserCreate(namespace_separator='}')
+    parser.buffer_text = True
+    parser.StartElementHandler = builder.start
+    parser.EndElementHandler = builder.end
+    parser.CharacterDataHandler = builder.data
+
+    try:
+        while True:
+            data = source.read(read_size)
+            parser.Parse(data, not data)
+
+            records, builder.records = builder.records, []
+            yield from records
+
+            if not data:
+                return
+    except ExpatError as ex:
+        raise ParseError(str(ex)) from ex
@@ -0,0 +1,202 @@
+import random
+import time
+from datetime import datetime, timedelta
+
+import packed_xml
+from dynamo_xml import ParallelWriter, decode_value, max_batch
+
+#
+# An alternative storage layout with an item per site and hour, instead of an item per site and minute.
+# An hour item has a slot attribute per minute, `m00` to `m59`, holding the minute's readings:
+# packed (see `packed_xml`), or as a plain list for the readings that don't fit the packed layout.
+# The minutes are added with `UpdateItem`, so the data files of an hour can arrive in any order, or again.
+#
+# An hour item is up to 60 times larger than a minute item, and an update is billed for the whole item,
+# so this layout takes fewer items, and fewer reads, at the cost of more write capacity.
+#
+
+site_field = 'measurementSiteReference'
+time_field = 'measurementTimeDefault'
+hour_field = 'hour'  # the sort key of the hour items, e.g., `2017-12-31T22`
+hour_keys = [site_field, hour_field]
+
+max_keys = 100  # the most keys a `BatchGetItem` request takes
+max_reads = 10  # how many times the unprocessed keys of a `BatchGetItem` are retried
+
+
+class ReadError(Exception):
+    """
+    Some of the hour items couldn't be read.
+    """
+
+
+def hour_slot(timestamp):
+    """
+    :param timestamp: a measurement time, e.g., ``2017-12-31T22:59:00Z``
+    :type timestamp: str
+    :return: the hour of the timestamp and the slot attribute of its minute, e.g., ``('2017-12-31T22', 'm59')``
+    :type: tuple
+    """
+    measured = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
+    return measured.strftime('%Y-%m-%dT%H'), f'm{measured.minute:02d}'
+
+
+def slot_time(hour, slot):
+    """
+    :return: the measurement time of a slot, the inverse of :func:`hour_slot`
+    """
+    return f'{hour}:{slot[1:]}:00Z'
+
+
+class HourlyWriter(ParallelWriter):
+    """
+    Writes the minute items of the traffic table into hour items, with up to ``streams`` concurrent ``UpdateItem``
+    requests. The minutes of the same site and hour that are queued together are written with a single request.
+
+    The items are in the wire format, as for :class:`dynamo_xml.ParallelWriter`,
+    and their readings packed or plain. Only the site, the time, and the readings of an item are kept.
+    The items with a broken measurement time can't be put into an hour, they're counted in ``unbucketed``.
+
+    :param client: a DynamoDB client
+    :param table_name: the table of the hour items, keyed on the site and the hour
+    :type table_name: str
+    """
+    def __init__(self, client, table_name, **kwargs):
+        super().__init__(client, table_name, hour_keys, **kwargs)
+        self.unbucketed = 0
+
+    def put_items(self, items):
+        if self.stats.started is None:
+            self.stats.started = time.perf_counter()
+
+        for item in items:
+            try:
+                hour, slot = hour_slot(item[time_field]['S'])
+            except (KeyError, ValueError):
+                self.unbucketed += 1
+                continue
+
+            site = item[site_field]
+            readings = item.get(packed_xml.packed_field) or item.get(packed_xml.readings_field) or {'L': []}
+
+            update = self.batch.get((site['S'], hour))
+            if update is None:
+                update = self.batch[(site['S'], hour)] = ({site_field: site, hour_field: {'S': hour}}, {})
+            update[1][slot] = readings  # the last reading of a minute wins, as with the minute items
+
+            if len(self.batch) == max_batch:
+                self._send_batch()
+
+    def report(self):
+        return super().report() + f', {self.unbucketed} items without an hour'
+
+    def _write(self, batch):
+        for key, slots in batch:
+            names = sorted(slots)
+
+            response = self._call(self.client.update_item, TableName=self.table_name, Key=key,
+                                  UpdateExpression='SET ' + ', '.join(f'{slot} = :{slot}' for slot in names),
+                                  ExpressionAttributeValues={f':{slot}': slots[slot] for slot in names},
+                                  ReturnConsumedCapacity='TOTAL')
+
+            with self.condition:
+                self.stats.requests += 1
+                self.stats.items += len(names)
+                self.stats.capacity += response.get('ConsumedCapacity', {}).get('CapacityUnits', 0.0)
+
+    def fold_minutes(self, source_table, start_key=None, stop=None, deleter=None, segment=0, total_segments=1):
+        """
+        Compacts the minute items of a table into hour items, a page of a ``Scan`` at a time.
+
+        :param source_table: the table of the minute items
+        :type source_table: str
+        :param start_key: where to continue an earlier compaction, the key it returned
+        :type start_key: dict
+        :param stop: called after each page, the compaction stops if it returns true
+        :param deleter: a :class:`dynamo_xml.ParallelWriter` for the minute table,
+                to delete the minute items once their hour items are written, they're kept if ``None``
+        :param segment: the segment of a parallel scan
+        :type segment: int
+        :param total_segments: the number of segments of a parallel scan
+        :type total_segments: int
+        :return: the key to continue from, or ``None`` if the whole table (or segment) is compacted
+        :type: dict
+        """
+        while True:
+            request = {'TableName': source_table, 'Segment': segment, 'TotalSegments': total_segments}
+            if start_key is not None:
+                request['ExclusiveStartKey'] = start_key
+
+            page = self._call(self.client.scan, **request)
+            items = page.get('Items', [])
+
+            self.put_items(items)
+            self.flush()
+
+            if deleter is not None:
+                deleter.delete_keys({field: item[field] for field in deleter.key_fields} for item in items)
+                deleter.flush()
+
+            start_key = page.get('LastEvaluatedKey')
+            if start_key is None or (stop is not None and stop()):
+                return start_key
+
+
+def decode_slot(value):
+    """
+    :return: the readings of a slot of an hour item, as they were extracted
+    :type: list
+    """
+    if 'B' in value:
+        return packed_xml.unpack_readings(value['B'])
+
+    return decode_value(value)
+
+
+def read_hours(client, table_name, site, start, hours=24):
+    """
+    Reads the readings of a site for a range of hours, with ``BatchGetItem`` requests for the hour items.
+
+    :param client: a DynamoDB client
+    :param table_name: the table of the hour items
+    :type table_name: str
+    :param site: the measurement site
+    :type site: str
+    :param start: the first hour, e.g., ``2017-12-31T00``
+    :type start: str
+    :param hours: the number of hours, 24 for a day
+    :type hours: int
+    :return: the records of the minutes found, in the order of their times, as extracted from the data files
+            (in the plain encoding)
+    :type: list
+    """
+    first = datetime.strptime(start, '%Y-%m-%dT%H')
+    keys = [{site_field: {'S': site}, hour_field: {'S': (first + timedelta(hours=i)).strftime('%Y-%m-%dT%H')}}
+            for i in range(hours)]
+
+    items = []
+    for i in range(0, len(keys), max_keys):
+        request = {table_name: {'Keys': keys[i:i + max_keys]}}
+
+        for attempt in range(max_reads):
+            if attempt > 0:
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+            response = client.batch_get_item(RequestItems=request)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+        else:
+            raise ReadError(f'Some of the hour items of {site} were still unprocessed after {max_reads} requests')
+
+    records = []
+    for item in sorted(items, key=lambda item: item[hour_field]['S']):
+        hour = item[hour_field]['S']
+
+        for slot in sorted(field for field in item if field not in hour_keys):
+            records.append({site_field: site, time_field: slot_time(hour, slot),
+                            packed_xml.readings_field: decode_slot(item[slot])})
+
+    return records
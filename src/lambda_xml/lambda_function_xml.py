@@ -1,21 +1,171 @@
 import os
-import boto3
 from botocore.exceptions import ClientError
 import psycopg2
+from psycopg2.pool import PoolError
 import json
-import yaml
 import decimal
-from xml.etree.ElementTree import fromstring, ParseError
-import gzip
+from collections import namedtuple
+from contextlib import contextmanager
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus, unquote_plus
+from xml.etree.ElementTree import ParseError
+import zlib
+from importlib.util import find_spec
 import schemas_xml
-from logs import get_logger, commit_log, succeeded, failed, processing
+import stream_xml
+from schema_cache_xml import SchemaCache
+import checkpoints_xml
+import registry_xml
+import dynamo_xml
+import packed_xml
+import hourly_xml
+import shards_xml
+import sinks_xml
+import readings_xml
+import expat_xml
+from logs import get_logger, commit_log, succeeded, failed, processing, skipped
+
+#
+# Nothing is created or connected at import time, so that a cold start only pays for the imports.
+# The clients and connections are created on first use, and reused by the warm invocations.
+#
 
 ############
 # AWS stuff
 ############
 
-s3 = boto3.resource('s3')
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+# The objects of an event are processed concurrently, on at most this many threads
+max_workers = int(os.environ.get('MAX_WORKERS', 4))
+
+# Each file is written to DynamoDB with up to this many concurrent requests
+write_streams = int(os.environ.get('WRITE_STREAMS', 8))
+
+traffic_table = 'TrafficSpeed'
+traffic_keys = ['measurementSiteReference', 'measurementTimeDefault']
+
+# With `ITEM_LAYOUT=hour`, the records go into an item per site and hour in this table, see `hourly_xml`
+item_layout = os.environ.get('ITEM_LAYOUT', 'minute')
+hourly_table = os.environ.get('HOURLY_TABLE', 'TrafficSpeedHourly')
+
+# The AWS clients, created on first use from a single session, and shared by the worker threads,
+# the sinks' threads, and the warm invocations (unlike the resources, boto3 clients are thread-safe)
+aws_clients = {}
+aws_lock = threading.Lock()
+
+
+def aws_client(name):
+    """
+    :param name: the service, ``s3``, ``dynamodb``, or ``lambda``
+    :type name: str
+    :return: the service's client, the DynamoDB client has enough connections for all the write streams
+            of all the threads, and it takes the items in the wire format, see :func:`dynamo_xml.compile_encoder`
+    """
+    client = aws_clients.get(name)
+    if client is not None:
+        return client
+
+    with aws_lock:
+        if name not in aws_clients:
+            import boto3  # takes a while to import, and is only needed once a file is processed
+            from botocore.config import Config
+
+            if 'session' not in aws_clients:
+                aws_clients['session'] = boto3.session.Session()
+
+            if name == 'dynamodb':
+                # The writer retries the throttled requests itself, adapting the number of requests in flight,
+                # and the items are encoded from the schema, they don't need validating again
+                config = Config(max_pool_connections=max_workers * write_streams, retries={'max_attempts': 0},
+                                parameter_validation=False)
+                client = aws_clients['session'].client('dynamodb', region_name='us-east-1', config=config)
+            else:
+                # The files are downloaded and the archive parts uploaded by all the threads at once
+                client = aws_clients['session'].client(name, config=Config(max_pool_connections=2 * max_workers))
+
+            aws_clients[name] = client
+
+    return aws_clients[name]
+
+
+def invoke_again(context, event):
+    """
+    Invokes this Lambda again, asynchronously, with an event.
+    """
+    aws_client('lambda').invoke(FunctionName=context.invoked_function_arn, InvocationType='Event',
+                                Payload=json.dumps(event).encode())
+
+
+def requeue(context, bucket_name, object_key):
+    """
+    Invokes this Lambda again for an object, with an S3 notification for the object.
+    """
+    invoke_again(context, {'Records': [{'eventSource': 'aws:s3',
+                                        's3': {'bucket': {'name': bucket_name},
+                                               'object': {'key': quote_plus(object_key)}}}]})
+
+
+def make_writer(client):
+    """
+    :return: the writer of the traffic items, for the layout set with ``ITEM_LAYOUT``
+    """
+    if item_layout == 'hour':
+        return hourly_xml.HourlyWriter(client, hourly_table, streams=write_streams)
+
+    return dynamo_xml.ParallelWriter(client, traffic_table, traffic_keys, streams=write_streams)
+
+
+def make_sink(config, encoder, bucket_name, object_key, offset):
+    """
+    :param config: the sink's configuration from the schema, see :func:`sinks_xml.sink_configs`
+    :type config: dict
+    :param encoder: the encoder of the records as DynamoDB items
+    :param offset: the index of the first record, when continuing from a checkpoint
+    :type offset: int
+    :return: the sink
+    :type: sinks_xml.Sink
+    """
+    kind = config['type']
+
+    if kind == 'dynamodb':
+        return sinks_xml.DynamoDBSink(make_writer(aws_client('dynamodb')), encoder)
+
+    elif kind == 'ndjson':
+        archive_bucket = config.get('bucket', bucket_name)
+        prefix = config.get('prefix', 'archive/')
+
+        def upload(path, name):
+            aws_client('s3').upload_file(path, archive_bucket, prefix + name)
+
+        return sinks_xml.NDJSONSink(upload, object_key, offset, max_bytes=config.get('max_bytes', 64 * 2 ** 20))
+
+    elif kind == 'postgres':
+        return sinks_xml.PostgresSink(checkout_connection(), object_key, offset, release=checkin_connection)
+
+    elif kind == 'readings':
+        return readings_xml.ReadingsSink(checkout_connection(), batch_rows=config.get('batch_rows', 50000),
+                                         release=checkin_connection)
+
+    raise ValueError(f'Unknown sink `{kind}`')
+
+
+def open_sinks(configs, encoder, bucket_name, object_key, offset):
+    """
+    :return: the sink of the records of a file, writing to all the schema's sinks at once if there are several
+    :type: sinks_xml.Sink
+    """
+    sinks = []
+    try:
+        for config in configs:
+            sinks.append(make_sink(config, encoder, bucket_name, object_key, offset))
+    except:
+        for sink in sinks:
+            sink.close()
+        raise
+
+    return sinks[0] if len(sinks) == 1 else sinks_xml.FanOut(sinks)
+
 
 #################
 # Database stuff
@@ -26,13 +176,207 @@ rds_db_user = "'arsegorovDB'"
 rds_host = "'metainstance.cagix2mfixd1.us-east-1.rds.amazonaws.com'"
 password = os.environ.get('PGPASSWORD')
 
-connection = psycopg2.connect(f'connect_timeout=5 '  # Will break out of the lambda early if it can't connect to RDS
-                              f"dbname={meta_db} "
-                              f"user={rds_db_user} "
-                              f"host={rds_host} "
-                              f"password='{password}'")
+dsn = (f'connect_timeout=5 '  # Will break out of the lambda early if it can't connect to RDS
+       f"dbname={meta_db} "
+       f"user={rds_db_user} "
+       f"host={rds_host} "
+       f"password='{password}'")
+
+# A connection is checked with a query before reuse if it has been idle for longer than this, in seconds,
+# e.g., while the Lambda was frozen between invocations
+liveness_interval = 60
+
+# A connection per worker thread, and one more for each of its file's `postgres` and `readings` sinks
+max_connections = 3 * max_workers
+
+
+class ConnectionPool:
+    """
+    The connections to the database, opened on demand, up to ``maxconn``, and kept open when they're returned,
+    for the next files and the warm invocations.
+    (psycopg2's pools open ``minconn`` connections upfront, and close the returned ones beyond ``minconn``.)
+    """
+    def __init__(self, maxconn, dsn):
+        self.maxconn = maxconn
+        self.dsn = dsn
+        self.idle = []  # the idle connections and when they were returned, the most recent last
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        """
+        :return: an idle connection and the time it was returned (``time.monotonic()``),
+                or a new connection and ``None``
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            if self.opened >= self.maxconn:
+                raise PoolError('connection pool exhausted')
+            self.opened += 1
 
-traffic_table = dynamodb.Table('TrafficSpeed')
+        try:
+            return psycopg2.connect(self.dsn), None
+        except:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def putconn(self, connection, close=False):
+        if not close and not connection.closed:
+            try:
+                connection.rollback()  # don't keep the connection in the middle of a transaction
+            except psycopg2.Error:
+                close = True
+
+        if close or connection.closed:
+            if not connection.closed:
+                connection.close()
+            with self.lock:
+                self.opened -= 1
+            return
+
+        with self.lock:
+            self.idle.append((connection, time.monotonic()))
+
+
+# Shared by the invocations of a warm Lambda, created on first use
+db_pool = None
+db_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global db_pool
+
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = ConnectionPool(max_connections, dsn)
+
+    return db_pool
+
+
+def is_alive(connection):
+    """
+    :return: whether the connection still works, with a round trip to the database
+    """
+    try:
+        cur = connection.cursor()
+        cur.execute('SELECT 1;')
+        cur.close()
+        connection.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def checkout_connection():
+    """
+    Takes a working connection from the pool, the broken ones are closed and replaced.
+    """
+    pool = get_pool()
+
+    while True:
+        connection, idle_since = pool.getconn()
+
+        if not connection.closed and (idle_since is None
+                                      or time.monotonic() - idle_since < liveness_interval
+                                      or is_alive(connection)):
+            return connection
+
+        pool.putconn(connection, close=True)
+
+
+def checkin_connection(connection):
+    """
+    Returns a connection to the pool, see :func:`checkout_connection`.
+    """
+    get_pool().putconn(connection)
+
+
+# With `EXTRACT_PROCESSES` over 1, the records of the data files are extracted in this many worker processes,
+# see `parallel_xml`. It pays off with the vCPUs of a Lambda with more memory, e.g., 2 from 1769 MB.
+# The workers are shared by the files of an event, a file that finds them all busy is extracted in its own thread
+extract_processes = int(os.environ.get('EXTRACT_PROCESSES', 1))
+if extract_processes > 1:
+    import parallel_xml  # imports multiprocessing, only needed when it's enabled
+
+    parallel_xml.start_workers(extract_processes)  # at the cold start, before any thread is started
+
+# The extraction engines a processing schema can choose with its `engine` key
+engines = {
+    'etree': stream_xml.stream_data,
+    'expat': expat_xml.stream_data,
+}
+
+
+def xslt_engine(source, plan, log, skip=0):
+    import xslt_xml  # imports lxml, which would slow down the cold start for the schemas that don't use it
+
+    return xslt_xml.stream_data(source, plan, log, skip)
+
+
+if find_spec('lxml') is not None:
+    engines['xslt'] = xslt_engine
+
+# The encodings of the DynamoDB items, each wraps the encoder of the plain items
+item_encodings = {
+    'plain': lambda encoder: encoder,
+    'packed': packed_xml.packed_encoder,
+}
+
+
+# A processing schema ready to use: the compiled extraction plan, the extraction engine,
+# the encoder of the records as DynamoDB items, and the configurations of the sinks
+CompiledSchema = namedtuple('CompiledSchema', 'plan engine encoder sinks')
+
+
+def load_plan(processing_schema):
+    """
+    Compiles a processing schema found in the database.
+
+    :param processing_schema: the schema's ``processing`` section, with the ``sinks`` of its ``meta`` section
+    :type processing_schema: dict
+    :return: the compiled schema
+    :type: CompiledSchema
+    """
+    xml_prefixes = processing_schema['prefixes']
+    data_schema = processing_schema['data']
+    plan = schemas_xml.compile_schema(data_schema, xml_prefixes)
+    item_encoding = processing_schema.get('item_encoding', 'plain')
+    sinks = sinks_xml.sink_configs(processing_schema.get('sinks'))
+
+    # The packed encoding and the readings sink rely on the fields of the traffic schema
+    layouts = []
+    if item_encoding == 'packed':
+        layouts.append(('The packed item encoding', packed_xml.missing_fields))
+    if any(config['type'] == 'readings' for config in sinks):
+        layouts.append(('The readings sink', readings_xml.missing_fields))
+    for name, missing_fields in layouts:
+        missing = missing_fields(schemas_xml.record_fields(stream_xml.array_entry(plan)))
+        if missing:
+            raise ValueError(f'{name} requires the fields of the traffic schema, '
+                             f'the records have no {", ".join(f"`{field}`" for field in missing)}')
+
+    encoder = item_encodings[item_encoding](dynamo_xml.compile_encoder(plan))
+
+    engine_name = processing_schema.get('engine', 'etree')
+    engine = engines[engine_name]
+    if extract_processes > 1:
+        engine = parallel_xml.parallel_engine(engine_name, extract_processes, (data_schema, xml_prefixes))
+
+    return CompiledSchema(plan, engine, encoder, sinks)
+
+
+# The records are written in chunks, and at most `chunks_ahead` chunks are extracted ahead of the writes
+chunk_size = 500
+chunks_ahead = 4
+
+# When less time than this is left in the invocation, in milliseconds,
+# a data file is checkpointed after the current chunk, and continued in a new invocation
+time_reserve = int(os.environ.get('TIME_RESERVE_MS', 30000))
+
+# The compiled schemas, shared by the worker threads and the warm invocations
+schema_cache = SchemaCache(load_plan)
 
 
 # Helper class to convert a DynamoDB item to JSON.
@@ -46,140 +390,468 @@ class DecimalEncoder(json.JSONEncoder):
         return super(DecimalEncoder, self).default(o)
 
 
+def object_records(event):
+    """
+    Lists the S3 objects of an event, either an S3 notification or a batch of SQS messages carrying S3 notifications.
+
+    :param event: the event received by the Lambda
+    :type event: dict
+    :return: the objects in the form ``[(message id, bucket name, object key), ...]``,
+            the message id is ``None`` for S3 notifications
+    :type: list
+    """
+    objects = []
+
+    for record in event.get('Records', []):
+        if 'body' in record:  # an SQS message
+            for s3_record in json.loads(record['body']).get('Records', []):
+                objects.append((record['messageId'],
+                                s3_record['s3']['bucket']['name'],
+                                unquote_plus(s3_record['s3']['object']['key'])))
+        else:
+            objects.append((None,
+                            record['s3']['bucket']['name'],
+                            unquote_plus(record['s3']['object']['key'])))
+
+    return objects
+
+
 def main(event, context):
     """
-    This Lambda's entry point
+    This Lambda's entry point, processes all the objects of the event concurrently
 
-    :param event: the event received from the s3 bucket
+    :param event: the event received from the s3 bucket, directly or through SQS
     :param context: the runtime environment information
+    :return: the status of each object, in the form
+            ``{'objects': [{'bucket': ..., 'key': ..., 'status': 'succeeded'|'failed'|'requeued'|'skipped'|'ignored'},
+            ...]}``,
+            and for SQS events, the messages to retry in ``batchItemFailures``
+    :type: dict
     """
-    logger, log = get_logger()
+    objects = object_records(event)
+    statuses = {succeeded: 'succeeded', failed: 'failed', processing: 'requeued', skipped: 'skipped', None: 'ignored'}
 
-    bucket_name = event['Records'][0]['s3']['bucket']['name']
-    object_key = event['Records'][0]['s3']['object']['key']
+    def run(obj_record):
+        message_id, bucket_name, object_key = obj_record
+        if file_kind(object_key) is None:
+            return None
 
-    obj = s3.Object(bucket_name, object_key)
+        connection = checkout_connection()
+        try:
+            return process_object(bucket_name, object_key, connection, context)
+        finally:
+            checkin_connection(connection)
 
-    # If the uploaded file is a schema, add it to the Postgres
-    if object_key[-3:] == 'yml':
-        log(f'Requesting file `{object_key}` from S3')
+    results = {}
 
-        try:
-            body = obj.get()['Body']
-            contents = body.read()
-        except ClientError as ex:
-            log(f'Error while retrieving `{object_key}`: {ex.response["Error"]["Code"]}')
-            commit_log(logger, connection, object_key, failed)
-            return
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(objects)))) as executor:
+        # The schemas go first, so that the data files of the same event can use them
+        schema_files = [obj_record for obj_record in objects if file_kind(obj_record[2]) == 'schema']
+        data_files = [obj_record for obj_record in objects if file_kind(obj_record[2]) != 'schema']
 
-        log(f'Read `{object_key}` from S3')
+        for wave in (schema_files, data_files):
+            futures = [executor.submit(run, obj_record) for obj_record in wave]
 
-        try:
-            schema = yaml.load(contents.decode('utf-8'))
-            log(f'Read the schema from `{object_key}`')
+            for obj_record, future in zip(wave, futures):
+                try:
+                    results[obj_record] = (statuses[future.result()], None)
+                except Exception as ex:
+                    results[obj_record] = ('failed', f'{type(ex).__name__}: {ex}')
 
-            schemas_xml.add_schema(schema, connection)
-            log(f'Put the schema from `{object_key}` into the database')
-        except:
-            log(f"Couldn''t process `{object_key}`")
-            commit_log(logger, connection, object_key, failed)
-            return
+    summary = []
+    retry = []
+
+    for obj_record in objects:
+        message_id, bucket_name, object_key = obj_record
+        status, error = results[obj_record]
+
+        result = {'bucket': bucket_name, 'key': object_key, 'status': status}
+        if error is not None:
+            result['error'] = error
+        summary.append(result)
+
+        if status == 'failed' and message_id is not None and message_id not in retry:
+            retry.append(message_id)
+
+    response = {'objects': summary}
+    if any(message_id is not None for message_id, _, _ in objects):
+        response['batchItemFailures'] = [{'itemIdentifier': message_id} for message_id in retry]
+
+    return response
+
+
+def compact(event, context):
+    """
+    The entry point for compacting the minute items of the traffic table into hour items, see `hourly_xml`,
+    e.g., on a schedule. It continues in a new invocation when it runs out of time.
+
+    :param event: the options, in the form ``{'delete': false, 'segment': 0, 'total_segments': 1}``,
+            ``delete`` removes the minute items that were compacted,
+            and the segments split the table between concurrent compactions
+    :param context: the runtime environment information
+    :return: the writer's report, and whether the compaction went through the whole table (or segment)
+    :type: dict
+    """
+    client = aws_client('dynamodb')
+    writer = hourly_xml.HourlyWriter(client, hourly_table, streams=write_streams)
+    deleter = None
+    if event.get('delete', False):
+        deleter = dynamo_xml.ParallelWriter(client, traffic_table, traffic_keys, streams=write_streams)
+
+    def out_of_time():
+        return context is not None and context.get_remaining_time_in_millis() < time_reserve
 
-        log(f'Finished processing schema from `{object_key}`')
-        commit_log(logger, connection, object_key, succeeded)
+    try:
+        with writer:
+            start_key = writer.fold_minutes(traffic_table, event.get('start_key'), out_of_time, deleter,
+                                            event.get('segment', 0), event.get('total_segments', 1))
+    finally:
+        if deleter is not None:
+            deleter.close()
 
-    # If the uploaded file is the actual data
+    if start_key is not None:
+        invoke_again(context, dict(event, start_key=start_key))
+
+    return {'report': writer.report(), 'finished': start_key is None}
+
+
+def file_kind(object_key):
+    """
+    :return: ``'schema'`` for YAML schemas, ``'data'`` for XML data files (possibly compressed),
+            ``None`` for other files
+    """
+    if object_key[-3:] == 'yml':
+        return 'schema'
     elif object_key[-3:] == 'xml' or object_key[-2:] == 'gz':
-        log(f'Requesting a traffic data file, `{object_key}`, from S3')
-        commit_log(logger, connection, object_key, processing)
+        return 'data'
+    return None
+
+
+class ObjectError(Exception):
+    """
+    Fails the processing of an object, the message goes to the object's log.
+    """
+
+
+def process_object(bucket_name, object_key, connection, context=None):
+    """
+    Processes an object uploaded to S3: saves a schema, or extracts a data file into DynamoDB
+
+    :param bucket_name: the bucket's name
+    :type bucket_name: str
+    :param object_key: the object's key
+    :type object_key: str
+    :param connection: a connection to the database, used by the calling thread only
+    :param context: the runtime environment information, if given, a data file that doesn't fit
+            into the remaining time is checkpointed and continued in a new invocation
+    :return: ``succeeded`` or ``failed``, see :mod:`logs`, ``processing`` if the file is continued
+            in a new invocation, ``skipped`` for duplicates, or ``None`` for files of other types
+    """
+    kind = file_kind(object_key)
+    if kind is None:
+        return None
+
+    logger, log = get_logger()
+    process = process_schema if kind == 'schema' else process_data
+
+    try:
+        status = process(bucket_name, object_key, connection, context, logger, log)
+    except ObjectError as ex:
+        log(str(ex))
+        status = failed
+
+    commit_log(logger, connection, object_key, status)
+    return status
+
+
+def process_schema(bucket_name, object_key, connection, context, logger, log):
+    """
+    Adds the schema of a schema file to the Postgres.
+
+    :return: ``succeeded``
+    :raise ObjectError: if the schema can't be read or added
+    """
+    log(f'Requesting file `{object_key}` from S3')
+
+    try:
+        body = aws_client('s3').get_object(Bucket=bucket_name, Key=object_key)['Body']
+        contents = body.read()
+    except ClientError as ex:
+        raise ObjectError(f'Error while retrieving `{object_key}`: {ex.response["Error"]["Code"]}')
 
-        # Read the contents of the file
+    log(f'Read `{object_key}` from S3')
+
+    try:
+        import yaml  # only the schema files need it, the data files don't pay for importing it
+
+        schema = yaml.load(contents.decode('utf-8'))
+        log(f'Read the schema from `{object_key}`')
+
+        schemas_xml.add_schema(schema, connection)
+        schema_cache.invalidate()
+        log(f'Put the schema from `{object_key}` into the database')
+    except:
+        raise ObjectError(f"Couldn''t process `{object_key}`")
+
+    log(f'Finished processing schema from `{object_key}`')
+    return succeeded
+
+
+def process_data(bucket_name, object_key, connection, context, logger, log):
+    """
+    Extracts the records of a data file and writes them to the schema's sinks.
+    The file flows through a pipeline of stages, each in its own thread, connected with bounded queues:
+    download -> decompress -> parse and extract -> write to the sinks (in this thread).
+
+    :return: ``succeeded``, ``processing`` if the file is continued in a new invocation, or ``skipped``
+    :raise ObjectError: if the file fails
+    """
+    log(f'Requesting a traffic data file, `{object_key}`, from S3')
+    commit_log(logger, connection, object_key, processing)
+
+    # With e.g. `SHARD_SCHEME=hash:16`, the items get a sharded time attribute for the indexes keyed on the time,
+    # see `shards_xml`. It's read for each file, so that a bad setting is logged with the file
+    try:
+        key_scheme = shards_xml.configured_scheme()
+    except ValueError as ex:
+        raise ObjectError('Invalid key scheme: ' + str(ex).replace("'", "''"))
+
+    # Open the file as a stream, it is downloaded and decompressed while being parsed
+    try:
+        response = aws_client('s3').get_object(Bucket=bucket_name, Key=object_key)
+        body, etag = response['Body'], response['ETag']
+    except ClientError as ex:
+        raise ObjectError(f'Error while retrieving `{object_key}`: {ex.response["Error"]["Code"]}')
+
+    # for gzip-compressed files, decompress on the fly
+    is_gzip = object_key[-2:] == 'gz'
+    if is_gzip:
+        log('Found GZIP extension')
+
+    duplicate = find_duplicate(connection, object_key, etag)
+    if duplicate is not None:
+        body.close()
+        log(duplicate)
+        return skipped
+
+    pipeline = stream_xml.Pipeline()
+
+    with open_pipeline(body, is_gzip, pipeline, object_key, log) as (xml, date, source, raw):
+        # Find the matching schema while the rest of the file is downloaded and decompressed
+        started = time.perf_counter()
+        plan, engine, encoder, sink_configs = resolve_schema(object_key, date, connection, log)
+        if key_scheme is not None:
+            encoder = shards_xml.shard_encoder(encoder, key_scheme)
+
+        log(f'Resolved the schema in {(time.perf_counter() - started) * 1000:.0f} ms, '
+            f'{xml.bytes_read} bytes of XML prefetched meanwhile')
+        # An earlier invocation could have run out of time with this file, the records it wrote are skipped
+        offset = checkpoints_xml.load_checkpoint(connection, object_key, etag)
+        if offset > 0:
+            log(f'Resuming after the {offset} items sent by an earlier invocation')
+
+        sink_names = ', '.join(config['type'] for config in sink_configs)
         try:
-            body = obj.get()['Body']
-            contents = body.read()
-        except ClientError as ex:
-            log(f'Error while retrieving `{object_key}`: {ex.response["Error"]["Code"]}')
-            commit_log(logger, connection, object_key, failed)
-            return
+            sink = open_sinks(sink_configs, encoder, bucket_name, object_key, offset)
+        except Exception as ex:
+            raise ObjectError(f"Couldn''t open the outputs ({sink_names}): {type(ex).__name__}")
 
-        log(f'Read `{object_key}` from S3')
-        commit_log(logger, connection, object_key, processing)  # committing often because the process takes minutes
+        log(f'Started extracting data from the datafile and writing to {sink_names}')
+        commit_log(logger, connection, object_key, processing)
 
-        # for gzip-compressed files, decompress first
-        if object_key[-2:] == 'gz':
-            log('Found GZIP extension')
-            try:
-                contents = gzip.decompress(contents)
-            except:
-                log("Couldn''t decompress the GZIP data")
-                commit_log(logger, connection, object_key, failed)
-                return
+        # The records are extracted while the XML is being parsed, in reasonably sized chunks,
+        # and at most a few chunks wait to be written. The records written before a checkpoint
+        # are only parsed, not extracted
+        records = stream_xml.chunks(engine(xml, plan, log, skip=offset), chunk_size)
+        size, out_of_time = write_records(records, sink, sink_names, offset, pipeline, context, object_key)
+
+    log(sink.report())
+    for line in pipeline.report():
+        log(line)
 
-        log('Decompressed the GZIP data')
+    status = finish_object(bucket_name, object_key, etag, connection, context, log, offset, size, out_of_time)
+    if status == succeeded:
+        log(f'Extracted data from `{object_key}`, found readings for {size} locations')
+        log(f'Read {raw.bytes_read} bytes of the downloaded file, {source.bytes_read} bytes of XML, '
+            f'peak RSS {stream_xml.peak_rss():.1f} MiB')
+        log(f'Finished processing traffic data from `{object_key}`')
+
+    return status
+
+
+def find_duplicate(connection, object_key, etag):
+    """
+    :return: why a data file is skipped, if it was already processed, or ``None``
+    :type: str
+    """
+    # The same version of the file was processed before, e.g., the event was delivered again
+    if registry_xml.is_processed(connection, object_key, etag):
+        return f'Skipping `{object_key}`, this version of it was already processed'
+
+    # The same object was processed under another key, e.g., the file was republished as it was
+    duplicate = registry_xml.find_etag(connection, etag)
+    if duplicate is not None:
+        registry_xml.register_processed(connection, object_key, etag)
+        return f'Skipping `{object_key}`, it is the same object as `{duplicate}`, which was already processed'
+
+    return None
+
+
+@contextmanager
+def open_pipeline(body, is_gzip, pipeline, object_key, log):
+    """
+    Starts downloading (and decompressing) a data file in the background, and reads its publication time.
+
+    :param body: the streaming body of the file
+    :param is_gzip: whether the file is gzip-compressed
+    :type is_gzip: bool
+    :param pipeline: the pipeline the download and decompression stages are added to
+    :type pipeline: stream_xml.Pipeline
+    :return: a context manager giving the XML from its start, the publication time,
+            and the readers counting the bytes of the XML and of the downloaded file, ``(xml, date, source, raw)``
+    :raise ObjectError: if the header can't be read
+    """
+    with stream_xml.PrefetchReader(body, stats=pipeline.stage('download')) as downloaded:
+        source, raw = stream_xml.open_body(downloaded, is_gzip)
 
+        # Find the publication time in the head of the file
         try:
-            xml_data = fromstring(contents.decode('utf-8'))
-            log('Read the XML data')
+            date = stream_xml.scan_header(source,
+                                          '{http://datex2.eu/schema/2/2_0}publicationTime')
         except ParseError:
-            log(f"Couldn''t parse XML data from \"{object_key.split('.')[0]}\"")
-            commit_log(logger, connection, object_key, failed)
-            return
+            raise ObjectError(f"Couldn''t parse XML data from \"{object_key.split('.')[0]}\"")
+        except (OSError, EOFError, zlib.error):
+            raise ObjectError("Couldn''t decompress the GZIP data")
 
-        log('Read the XML data')  # The next step is quick, so not committing here
+        if date is None:
+            raise ObjectError(f"Couldn''t find the publication time in the header of `{object_key.split('.')[0]}`")
 
-        # Find the matching schema in the Postgres
-        date = next(
-            xml_data.iter('{http://datex2.eu/schema/2/2_0}publicationTime')
-        ).text
-        schema = schemas_xml.find_schema(object_key, date,
-                                         connection)
+        log(f'Read the header of `{object_key}`: '
+            f'{raw.bytes_read} bytes of the downloaded file, {source.bytes_read} bytes of XML, '
+            f'peak RSS {stream_xml.peak_rss():.1f} MiB')
+        source.replay()
+
+        # Keep downloading and decompressing the rest of the file, e.g., while the schema is being resolved
+        with stream_xml.PrefetchReader(source, stats=pipeline.stage('decompress' if is_gzip else 'read ahead')) \
+                as prefetched:
+            yield prefetched, date, source, raw
 
-        if schema is None:
-            log(f"Couldn''t find a matching schema for"
-                f' `{object_key.split(".")[0]}`'
-                f' in the database')
-            commit_log(logger, connection, object_key, failed)
-            return
 
-        log(f'Found a matching schema in the database')
+def resolve_schema(object_key, date, connection, log):
+    """
+    Finds the schema of a data file, the database is only checked for new schemas once in a while,
+    and loads it, compiled once per version for all the threads.
+
+    :return: the compiled schema
+    :type: CompiledSchema
+    :raise ObjectError: if no schema matches, or it can't be compiled
+    """
+    schema = schema_cache.find(object_key, date, connection)
 
-        # Load the schema
+    if schema is None:
+        raise ObjectError(f"Couldn''t find a matching schema for"
+                          f' `{object_key.split(".")[0]}`'
+                          f' in the database')
+
+    log(f'Found a matching schema from {schema[1]}')
+
+    try:
+        return schema_cache.load(schema, connection)
+    except ValueError as ex:
+        raise ObjectError(f'Unexpected schema format: {ex}')
+    except:
+        raise ObjectError('Unexpected schema format')
+
+
+def write_records(records, sink, sink_names, offset, pipeline, context, object_key):
+    """
+    Writes the chunks of records to the sinks, until they run out, or the invocation is running out of time.
+
+    :param records: an iterator over the chunks of records
+    :param sink: the sinks, see :func:`open_sinks`
+    :param sink_names: the sinks' names, for the log
+    :type sink_names: str
+    :param offset: the number of records written by earlier invocations, and skipped by ``records``
+    :type offset: int
+    :param pipeline: the pipeline the parsing and writing stages are added to
+    :type pipeline: stream_xml.Pipeline
+    :param context: the runtime environment information, or ``None``
+    :return: the number of records written, including the earlier ones, and whether the time ran out before the end,
+            in the form ``(size, out_of_time)``
+    :type: tuple
+    :raise ObjectError: if the records can't be parsed or written
+    """
+    def sent():
+        """
+        :return: a log message about what each sink wrote before an error
+        """
+        earlier = f'{offset} items sent by earlier invocations, ' if offset > 0 else ''
+        return earlier + 'sent so far: ' + sink.report().replace("'", "''")
+
+    # Leave enough time to save the progress before the Lambda times out,
+    # it's also checked while waiting for the parser, e.g., while it skips the records written before
+    def running_out():
+        return context is not None and context.get_remaining_time_in_millis() < time_reserve
+
+    size = offset
+    out_of_time = False
+
+    with stream_xml.PrefetchIterator(records, depth=chunks_ahead, stats=pipeline.stage('parse'),
+                                     give_up=running_out) as parsed:
         try:
-            xml_prefixes = schema[3]['prefixes']
-            data_schema = schema[3]['data']
-        except:
-            log(f'Unexpected schema format')
-            commit_log(logger, connection, object_key, failed)
-            return
+            # The records go to all the sinks at once, e.g., DynamoDB with several requests in flight,
+            # all the queued records are written by the end of the `with` block
+            with pipeline.stage('write').working(), sink:
+                try:
+                    for chunk in parsed:
+                        sink.put_records(chunk)
+                        size += len(chunk)
+
+                        if running_out():
+                            out_of_time = not parsed.exhausted()
+                            break
+                except stream_xml.PrefetchTimeout:
+                    out_of_time = True
+        except ParseError:
+            raise ObjectError(f"Couldn''t parse XML data from \"{object_key.split('.')[0]}\", {sent()}")
+        except (OSError, EOFError, zlib.error):
+            raise ObjectError(f"Couldn''t decompress the GZIP data, {sent()}")
+        except (dynamo_xml.WriteError, sinks_xml.SinkError) as ex:
+            raise ObjectError(f"Couldn''t write to {sink_names}: " + str(ex).replace("'", "''") + f', {sent()}')
+        except Exception as ex:
+            # Anything else, e.g., lxml's parsing errors, or a record the encoder can't take,
+            # still fails the file, rather than leaving it in processing
+            raise ObjectError(f"Couldn''t process `{object_key}`: {type(ex).__name__}: "
+                              + str(ex).replace("'", "''") + f', {sent()}')
 
-        log(f'Started extracting data from the datafile')
-        commit_log(logger, connection, object_key, processing)
+    return size, out_of_time
 
-        # Form the data to upload to Dynamo
-        data = schemas_xml \
-            .extract_data(xml_data,
-                          data_schema,
-                          xml_prefixes,
-                          log) \
-            .popitem()[1]
 
-        size = len(data)
-        log(f'Extracted data from `{object_key}`, found readings for {size} locations')
-        log(f'Started writing to DynamoDB')
-        commit_log(logger, connection, object_key, processing)
+def finish_object(bucket_name, object_key, etag, connection, context, log, offset, size, out_of_time):
+    """
+    Records the outcome of writing a data file: registers a file written in full,
+    or saves a checkpoint and continues the file in a new invocation.
+
+    :return: ``succeeded``, or ``processing`` if the file is continued in a new invocation
+    :raise ObjectError: if the time ran out before anything new was written, or the file can't be continued
+    """
+    if out_of_time and size == offset:
+        # Another invocation would run out of time in the same place
+        raise ObjectError(f'Ran out of time before sending any items after the {offset} sent by earlier invocations')
 
-        # Break the batch into reasonably sized chunks
-        chunk_size = 500
-        for i in range(0, size, chunk_size):
-            j = min(size, i + chunk_size)
+    if out_of_time:
+        checkpoints_xml.save_checkpoint(connection, object_key, etag, size)
+        log(f'Ran out of time after sending {size} items, saved a checkpoint')
 
-            with traffic_table.batch_writer(
-                    overwrite_by_pkeys=['measurementSiteReference', 'measurementTimeDefault']
-            ) as batch:
-                for item in data[i:j]:
-                    batch.put_item(Item=item)
+        try:
+            requeue(context, bucket_name, object_key)
+        except Exception as ex:
+            raise ObjectError(f"Couldn''t continue processing `{object_key}` in a new invocation: {type(ex).__name__}")
 
-            log(f'Sent data for items {i}-{j}')
+        log(f'Continuing processing `{object_key}` in a new invocation')
+        return processing
 
-        log(f'Finished processing traffic data from `{object_key}`')
-        commit_log(logger, connection, object_key, succeeded)
+    checkpoints_xml.clear_checkpoint(connection, object_key)
+
+    registry_xml.register_processed(connection, object_key, etag)
+    return succeeded
@@ -1,14 +1,17 @@
+import json
+from collections import namedtuple, OrderedDict
 from datetime import datetime
 
 missing = -1
 succeeded = 0
 failed = 1
 processing = 2
+skipped = 3
 
 xml_log_table = 'xml_log'
 time_field, time_props = 'date_time_utc', 'timestamp without time zone'
 file_field, file_props = 'file', 'text'
-status_field, status_props = 'status', 'smallint'  # possible values: succeeded, failed, processing, other = -1
+status_field, status_props = 'status', 'smallint'  # possible values: succeeded, failed, processing, skipped, other = -1
 msgs_field, msgs_props = 'messages', 'text[] NOT NULL'
 xml_log_pk = f'{time_field}'
 
@@ -26,20 +29,63 @@ def create_xml_log_table(connection):
     connection.commit()
 
 
+# A problem with extracting a value, e.g., `ExtractionError('ns1.speed', wrong_format, node)`.
+# Instead of adding a message per problem, the logger counts the problems of each kind for each entry,
+# and keeps a few of the nodes as examples
+ExtractionError = namedtuple('ExtractionError', 'entry kind node')
+
+wrong_format = 'wrong value format'
+missing_value = 'missing value'
+no_node = 'no matching node'
+
+error_samples = 3  # the number of example nodes kept for each entry and kind of problem
+
+
 def get_logger():
-    logger = [datetime.utcnow(), []]
+    logger = [datetime.utcnow(), [], OrderedDict()]
+
+    def push_message(message):
+        if isinstance(message, ExtractionError):
+            key = (message.entry, message.kind)
+
+            counter = logger[2].get(key)
+            if counter is None:
+                counter = logger[2][key] = [0, []]
 
-    def push_message(string):
-        logger[1].append(f'{datetime.utcnow()}: {string}')
+            counter[0] += 1
+            if len(counter[1]) < error_samples:
+                counter[1].append((message.node.tag, dict(message.node.attrib), message.node.text))
+            return
+
+        logger[1].append(f'{datetime.utcnow()}: {message}')
 
     return logger, push_message
 
 
+def render_errors(errors):
+    """
+    Turns the counted extraction problems into log messages, one per entry and kind of problem.
+
+    :param errors: the counters, in the format ``{(entry, kind): [count, [(tag, attributes, text), ...]]}``
+    :type errors: dict
+    :return: the messages
+    :type: list
+    """
+    messages = []
+
+    for (entry, kind), (count, samples) in errors.items():
+        examples = '; '.join(f'{tag} {json.dumps(attrib)} {json.dumps(text)}' for tag, attrib, text in samples)
+        messages.append(f'{datetime.utcnow()}: extract_data: [error] {kind} for `{entry}`, {count} time(s), '
+                        f"e.g., in {examples}".replace("'", "''"))
+
+    return messages
+
+
 def commit_log(logger, connection, filename=None, status=-1):
     create_xml_log_table(connection)
 
     cur = connection.cursor()
-    log_lines = "ARRAY['" + "','".join(logger[1]) + "']"
+    log_lines = "ARRAY['" + "','".join(logger[1] + render_errors(logger[2])) + "']"
     cur.execute(
         f"INSERT INTO {xml_log_table} ("
         f"{time_field}, {file_field}, {status_field}, {msgs_field}) "
@@ -51,4 +97,5 @@ def commit_log(logger, connection, filename=None, status=-1):
 
     # Empty the local log after committing to the database
     logger[1] = []
+    logger[2] = OrderedDict()
     logger[0] = datetime.utcnow()
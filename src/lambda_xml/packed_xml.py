@@ -0,0 +1,236 @@
+import struct
+from decimal import Decimal
+
+from logs import no_node
+
+#
+# A compact encoding of the traffic items: instead of a list of maps repeating the attribute names
+# (`Channel`, `Type`, `Flow`, ...) for every channel, the channel readings are packed into a binary attribute.
+#
+# The layout is a header (the format version and the number of readings, see `header`), then for each reading:
+#   * a byte: the reading type's code in the low 4 bits, and a bit per value that is missing in the high 4 bits
+#   * the channel index, a varint
+#   * the values of the reading type, in the order of `reading_types`, as zigzag varints of the values times `scale`
+#
+# The items whose readings don't fit the layout, e.g., an unknown reading type, a value that couldn't be parsed,
+# a value without a node, or a value with more decimals than `scale` allows, are written in the plain encoding.
+#
+# The fields below are those of the traffic schema, the schemas with the packed encoding are checked for them
+# when they're loaded, see `missing_fields`.
+#
+
+version = 1
+header = struct.Struct('<BH')
+scale = 100  # the values are stored with two decimals
+
+packed_field = 'packedReadings'  # the binary attribute of the packed items
+
+readings_field = 'ns1:measuredValue'  # the readings of the plain items, as in the traffic schema
+channel_field = 'Channel'
+data_field = 'ns1:basicData'
+type_field = 'Type'
+
+# The reading types, in the order of their codes (starting at 1),
+# and the paths of their values in the plain readings' `data_field`
+reading_types = (
+    ('TrafficFlow', (('Flow',),)),
+    ('TrafficSpeed', (('ns1:averageVehicleSpeed', 'InputSize'), ('ns1:averageVehicleSpeed', 'Speed'))),
+)
+type_codes = {name: code for code, (name, _) in enumerate(reading_types, 1)}
+
+
+def missing_fields(fields):
+    """
+    Checks that the records of a schema have their readings where the packed layout expects them.
+
+    :param fields: the compiled entries by the paths of the records' fields, see :func:`schemas_xml.record_fields`
+    :type fields: dict
+    :return: the fields the records don't have, e.g., ``['ns1:measuredValue[].Channel']``
+    :type: list
+    """
+    readings = fields.get((readings_field,))
+    if readings is None or not getattr(readings, 'is_array', False):
+        return [f'{readings_field}[]']
+
+    paths = [(channel_field,), (data_field, type_field)]
+    paths.extend((data_field,) + path for _, value_paths in reading_types for path in value_paths)
+
+    return ['.'.join((f'{readings_field}[]',) + path) for path in paths if (readings_field,) + path not in fields]
+
+
+class PackingError(ValueError):
+    """
+    A reading doesn't fit the packed layout.
+    """
+
+
+def write_varint(out, value):
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    """
+    :return: the varint starting at ``pos`` and the position after it, in the form ``(value, pos)``
+    """
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def scale_value(value):
+    """
+    :return: a number from a reading as an integer, in hundredths
+    """
+    cls = value.__class__
+    if cls is int:
+        return value * scale
+    elif cls is Decimal and value.is_finite():
+        scaled = value * scale
+        if scaled == scaled.to_integral_value():
+            return int(scaled)
+
+    raise PackingError(f'Cannot pack the value {value!r}')
+
+
+def unscale_value(scaled):
+    """
+    :return: a number read from the packed readings, an ``int`` if it's integer-valued, a ``Decimal`` otherwise
+    """
+    if scaled % scale == 0:
+        return scaled // scale
+
+    return Decimal(scaled).scaleb(-2)
+
+
+def get_path(data, path):
+    for field in path:
+        if data.__class__ is not dict:
+            return no_node
+        data = data.get(field, no_node)
+
+    return data
+
+
+def pack_readings(readings):
+    """
+    Packs the readings of a record.
+
+    :param readings: the plain readings,
+            e.g., ``[{'Channel': 1, 'ns1:basicData': {'Type': 'TrafficFlow', 'Flow': 60}}]``
+    :type readings: list
+    :return: the packed readings
+    :type: bytes
+    """
+    if readings.__class__ is not list or len(readings) > 0xffff:
+        raise PackingError('The readings are not a list, or there are too many of them')
+
+    out = bytearray(header.pack(version, len(readings)))
+
+    for reading in readings:
+        data = get_path(reading, (data_field,))
+        code = type_codes.get(get_path(data, (type_field,)))
+        channel = get_path(reading, (channel_field,))
+        if code is None or channel.__class__ is not int or channel < 0:
+            raise PackingError(f'Cannot pack the reading {reading!r}')
+
+        flags_pos = len(out)
+        out.append(code)
+        write_varint(out, channel)
+
+        for i, path in enumerate(reading_types[code - 1][1]):
+            value = get_path(data, path)
+            if value == '<missing>':
+                out[flags_pos] |= 0x10 << i
+                continue
+
+            scaled = scale_value(value)
+            write_varint(out, scaled << 1 if scaled >= 0 else (-scaled << 1) - 1)  # zigzag
+
+    return bytes(out)
+
+
+def unpack_readings(data):
+    """
+    Decodes the packed readings of an item.
+
+    :param data: the packed readings, boto3's ``Binary`` values are also accepted
+    :type data: bytes
+    :return: the readings as they were extracted, the missing values are ``'<missing>'``
+    :type: list
+    """
+    data = getattr(data, 'value', data)
+    packed_version, count = header.unpack_from(data)
+    if packed_version != version:
+        raise ValueError(f'Unsupported packed readings version {packed_version}')
+
+    pos = header.size
+    readings = []
+
+    for _ in range(count):
+        flags = data[pos]
+        name, paths = reading_types[(flags & 0x0f) - 1]
+        channel, pos = read_varint(data, pos + 1)
+
+        values = {type_field: name}
+        for i, path in enumerate(paths):
+            if flags & (0x10 << i):
+                value = '<missing>'
+            else:
+                zigzag, pos = read_varint(data, pos)
+                value = unscale_value(zigzag >> 1 if not zigzag & 1 else -((zigzag + 1) >> 1))
+
+            target = values
+            for field in path[:-1]:
+                target = target.setdefault(field, {})
+            target[path[-1]] = value
+
+        readings.append({channel_field: channel, data_field: values})
+
+    return readings
+
+
+def unpack_item(item):
+    """
+    Restores the readings of an item read from DynamoDB, e.g., with a boto3 resource.
+
+    :param item: the item, with its values deserialized
+    :type item: dict
+    :return: the item with the plain readings, the items in the plain encoding are returned as they are
+    :type: dict
+    """
+    if packed_field not in item:
+        return item
+
+    plain = {field: value for field, value in item.items() if field != packed_field}
+    plain[readings_field] = unpack_readings(item[packed_field])
+
+    return plain
+
+
+def packed_encoder(encode):
+    """
+    Wraps an encoder of the records as DynamoDB items, to pack their readings.
+
+    :param encode: the encoder of the plain items, see :func:`dynamo_xml.compile_encoder`
+    :return: a function taking a record, and returning the item, packed if its readings fit the layout
+    """
+    def encode_packed(record):
+        try:
+            packed = pack_readings(record.get(readings_field))
+        except PackingError:
+            return encode(record)
+
+        item = encode({field: value for field, value in record.items() if field != readings_field})
+        item[packed_field] = {'B': packed}
+
+        return item
+
+    return encode_packed
@@ -0,0 +1,522 @@
+import json
+import threading
+from collections import deque
+from importlib import import_module
+from io import BytesIO
+from itertools import chain
+from multiprocessing import get_context
+from xml.etree.ElementTree import Element, ParseError
+from xml.parsers.expat import ParserCreate, ExpatError
+from xml.sax.saxutils import quoteattr
+
+from logs import ExtractionError
+from schemas_xml import ListEntry, compile_schema
+from stream_xml import array_entry
+
+#
+# Parallel extraction: the decompressed document is split into parts made of whole records
+# (the outermost nodes matching the schema's top-level array entry), and the parts are extracted
+# by one of the extraction engines in worker processes, while the rest of the document is still being read.
+#
+# The records are found with expat's events, so a record nested in another one, or a `>` in an attribute value,
+# doesn't throw the split off. Each part is a standalone document: the records wrapped into a root node
+# with the namespace declarations in effect for them.
+#
+# AWS Lambda doesn't provide the shared memory (`/dev/shm`) that `multiprocessing`'s pools and queues need,
+# so the workers are plain processes, each talking to the parent over a pipe, with a single part in flight.
+#
+# The workers are forked once, before any thread is started (see `start_workers`), and shared by the documents:
+# by the time a document is parsed, the process runs the threads of the pipelines, the writers and the sinks,
+# and a lock held by any of them at a fork, e.g., the import lock or a logging lock, would never be released
+# in the child. The workers get the engine by its name and the schema to compile, once per schema,
+# since the compiled plans hold functions that can't be pickled.
+#
+
+read_size = 64 * 1024
+part_size = 2 ** 20  # the records' bytes in a part
+
+# The modules of the extraction engines, by the engines' names in the processing schemas
+engine_modules = {
+    'etree': 'stream_xml',
+    'expat': 'expat_xml',
+    'xslt': 'xslt_xml',
+}
+
+# The idle worker processes, `(process, connection, schemas)` with the keys of the schemas the worker compiled,
+# see `start_workers`
+idle_workers = []
+idle_workers_lock = threading.Lock()
+
+
+def find_engine(name):
+    """
+    :param name: the engine's name, e.g., ``etree``
+    :type name: str
+    :return: the extraction engine, e.g., :func:`stream_xml.stream_data`
+    """
+    return import_module(engine_modules[name]).stream_data
+
+
+def start_workers(processes):
+    """
+    Forks the worker processes. Call it once, before any thread is started, e.g., at the cold start.
+
+    :param processes: the number of worker processes, shared by all the documents
+    :type processes: int
+    """
+    context = get_context('fork')
+
+    for _ in range(processes):
+        connection, child = context.Pipe()
+        inherited = [worker[1] for worker in idle_workers]  # the other workers' pipes, closed in the new one
+        process = context.Process(target=extract_parts, args=(child, inherited), daemon=True)
+        process.start()
+        child.close()
+        idle_workers.append((process, connection, set()))
+
+
+def checkout_workers(count):
+    """
+    :return: up to ``count`` idle workers, return them with :func:`checkin_workers`
+    :type: list
+    """
+    with idle_workers_lock:
+        workers = idle_workers[:count]
+        del idle_workers[:count]
+
+    return workers
+
+
+def checkin_workers(workers):
+    with idle_workers_lock:
+        idle_workers.extend(workers)
+
+
+def start_tag_end(data, start):
+    """
+    Finds the end of a start tag, passing over the quoted attribute values, which may contain ``>``.
+
+    :param data: the XML data
+    :type data: bytearray
+    :param start: the position of the tag's ``<``
+    :type start: int
+    :return: the position of the tag's ``>``
+    :type: int
+    """
+    quote = None
+    for i in range(start, len(data)):
+        char = data[i]
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char == 34 or char == 39:  # `"` or `'`
+            quote = char
+        elif char == 62:  # `>`
+            return i
+
+    raise ParseError('unterminated start tag')
+
+
+class RecordSplitter:
+    """
+    Handles expat's events, finding the positions of the records in the document.
+    Nested nodes with the same tag are a part of the outermost one, as with :func:`stream_xml.stream_nodes`.
+
+    :param parser: the expat parser, created with ``namespace_separator='}'``
+    :param tag: the records' tag in the Clark notation
+    :type tag: str
+    """
+    def __init__(self, parser, tag):
+        self.parser = parser
+        self.name = tag[1:] if tag.startswith('{') else tag  # as expat reports it, `uri}local`
+
+        self.buffer = bytearray()  # the document from `base` on
+        self.base = 0
+        self.records = []  # the records found since the last time they were taken, `(start, end, namespaces)`
+
+        self.depth = 0  # how many nodes with the tag are currently open
+        self.start = None  # the position of the current record
+        self.last_event = 0  # the position of the last event outside the records, what comes after isn't parsed yet
+
+        self.encoding = 'utf-8'
+        self.declaration = b''
+        self.scope = {}  # the namespace declarations outside the records, `prefix: [uri, ...]`
+        self.namespaces = None  # the declarations in effect, as XML attributes, `None` when they changed
+        self.start_tags = []  # the ways the records' start tags can begin, with the declarations in effect
+        self.redeclared = False  # whether the current record declares namespaces inside it
+
+        parser.XmlDeclHandler = self.xml_declaration
+        parser.StartNamespaceDeclHandler = self.start_namespace
+        parser.EndNamespaceDeclHandler = self.end_namespace
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+
+    def feed(self, data):
+        """
+        Parses the next piece of the document, ``b''`` at its end.
+        The records found are taken from ``records``, before feeding the next piece.
+        """
+        self.buffer += data
+        self.parser.Parse(data, not data)
+
+    def record(self, start, end):
+        return bytes(self.buffer[start - self.base:end - self.base])
+
+    def trim(self):
+        """
+        Drops the data up to the current record, or to where the parser is, after the records were taken.
+        """
+        keep = self.start if self.depth > 0 else self.last_event
+        del self.buffer[:keep - self.base]
+        self.base = keep
+
+    def xml_declaration(self, version, encoding, standalone):
+        if encoding:
+            self.encoding = encoding
+            self.declaration = f'<?xml version="1.0" encoding="{encoding}"?>'.encode('ascii')
+
+    def start_namespace(self, prefix, uri):
+        if self.depth == 0:
+            self.scope.setdefault(prefix, []).append(uri)
+            self.namespaces = None
+        else:
+            self.redeclared = True
+
+    def end_namespace(self, prefix):
+        if self.depth == 0:
+            self.scope[prefix].pop()
+            self.namespaces = None
+
+    def start_element(self, name, attrs):
+        if name != self.name:
+            self.last_event = self.parser.CurrentByteIndex
+            return
+
+        # A new record, only the end events of the nodes inside it are handled, to find where it ends
+        self.depth = 1
+        self.start = self.parser.CurrentByteIndex
+        self.parser.StartElementHandler = None
+        self.parser.EndElementHandler = self.end_inner
+
+        if self.namespaces is None:
+            self.namespaces = ' '.join(f'xmlns{":" + prefix if prefix else ""}={quoteattr(uris[-1])}'
+                                       for prefix, uris in self.scope.items() if uris).encode(self.encoding)
+
+            # The ways the records' start tags can begin, e.g., `<ns1:siteMeasurements`
+            uri, _, local = self.name.rpartition('}')
+            prefixes = [prefix for prefix, uris in self.scope.items() if uris and uris[-1] == uri] if uri else [None]
+            self.start_tags = [f'<{prefix + ":" if prefix else ""}{local}'.encode(self.encoding) for prefix in prefixes]
+
+    def end_element(self, name):
+        self.last_event = self.parser.CurrentByteIndex
+
+    def start_inner(self, name, attrs):
+        if name == self.name:
+            self.depth += 1
+
+    def end_inner(self, name):
+        if name != self.name:
+            return
+
+        # Without a handler of the start events, the position of an end event is where the end tag,
+        # or the empty node, starts
+        position = self.parser.CurrentByteIndex
+
+        if self.parser.StartElementHandler is not None:
+            self.depth -= 1
+            if self.depth > 0:
+                return
+        elif self.redeclared or any(self.buffer.find(start_tag, self.start - self.base + 1,
+                                                     position - self.base + len(start_tag)) >= 0
+                                    for start_tag in self.start_tags):
+            # There may be nodes with the same tag inside the record, count the open ones, and follow them from now on
+            self.depth = self.open_nodes(position) - 1
+            self.parser.StartElementHandler = self.start_inner
+            if self.depth > 0:
+                return
+
+        if self.buffer[start_tag_end(self.buffer, self.start - self.base) - 1] == 47:  # `/`, an empty record
+            end = start_tag_end(self.buffer, self.start - self.base) + 1 + self.base
+        else:
+            end = self.buffer.index(b'>', position - self.base) + 1 + self.base
+
+        self.records.append((self.start, end, self.namespaces))
+        self.last_event = end
+        self.depth = 0
+        self.redeclared = False
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+
+    def open_nodes(self, position):
+        """
+        Parses the current record up to an end event of a node with the records' tag, with another parser.
+
+        :param position: the position of the end event, where the end tag or the empty node starts
+        :type position: int
+        :return: the number of the nodes with the tag open before the event, including the record
+        :type: int
+        """
+        opened = [0]
+
+        def start(name, attrs):
+            if name == self.name:
+                opened[0] += 1
+
+        def end(name):
+            if name == self.name:
+                opened[0] -= 1
+
+        parser = ParserCreate(namespace_separator='}')
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+
+        stop = position - self.base
+        if self.buffer[stop + 1] != 47:  # `/`, an empty node, the event is its end
+            stop = start_tag_end(self.buffer, stop) + 1
+            opened[0] += 1
+
+        parser.Parse(self.declaration + b'<part ' + self.namespaces + b'>' + self.buffer[self.start - self.base:stop],
+                     False)
+
+        return opened[0]
+
+
+def split_records(source, tag, size=part_size, skip=0):
+    """
+    Reads an XML document, yielding its records in parts of about ``size`` bytes.
+
+    :param source: a binary file object with the XML document
+    :param tag: the records' tag in the Clark notation
+    :type tag: str
+    :param size: the records' bytes in a part
+    :type size: int
+    :param skip: the number of records to leave out from the start
+    :type skip: int
+    :return: an iterator over the parts, each a standalone XML document
+    """
+    splitter = RecordSplitter(ParserCreate(namespace_separator='}'), tag)
+
+    part = []
+    part_bytes = 0
+    part_namespaces = None
+
+    def cut():
+        document = (splitter.declaration + b'<part ' + part_namespaces + b'>' + b''.join(part) + b'</part>')
+        part.clear()
+        return document
+
+    try:
+        while True:
+            data = source.read(read_size)
+            splitter.feed(data)
+
+            for start, end, namespaces in splitter.records:
+                if skip > 0:
+                    skip -= 1
+                    continue
+
+                # The records of a part share the namespace declarations of its root node
+                if part and (part_bytes >= size or namespaces != part_namespaces):
+                    yield cut()
+                    part_bytes = 0
+
+                part.append(splitter.record(start, end))
+                part_bytes += end - start
+                part_namespaces = namespaces
+
+            splitter.records.clear()
+            splitter.trim()
+
+            if not data:
+                break
+    except ExpatError as ex:
+        raise ParseError(str(ex)) from ex
+
+    if part:
+        yield cut()
+
+
+def portable(message):
+    """
+    :return: a logged message that can be sent to the parent process,
+            the node of an :class:`logs.ExtractionError` is replaced with a copy without its subtree
+    """
+    if isinstance(message, ExtractionError):
+        node = Element(message.node.tag, dict(message.node.attrib))
+        node.text = message.node.text
+        return message._replace(node=node)
+
+    return message
+
+
+def extract_parts(connection, inherited):
+    """
+    The loop of a worker process: extracts the records of each part received, until the pipe is closed.
+    Receives the parts in the form ``(key, schema, part)``, ``schema`` being ``None`` when it was sent before,
+    and sends back the records and the logged messages, in the form ``(records, messages, error)``.
+
+    :param inherited: the connections of the other workers, inherited with the fork
+    """
+    for other in inherited:
+        other.close()
+
+    schemas = {}  # the engines and the compiled plans, by the keys of the schemas
+
+    while True:
+        try:
+            key, schema, part = connection.recv()
+        except EOFError:
+            break
+
+        messages = []
+        try:
+            if schema is not None:
+                engine, data_sch, pref = schema
+                schemas[key] = find_engine(engine), compile_schema(data_sch, pref)
+
+            stream_data, plan = schemas[key]
+            records = list(stream_data(BytesIO(part), plan, lambda message: messages.append(portable(message))))
+        except Exception as ex:
+            if isinstance(ex, SyntaxError):  # e.g., lxml's errors, which can't be sent as they are
+                ex = ParseError(str(ex))
+            try:
+                connection.send(([], messages, ex))
+            except Exception:
+                connection.send(([], messages, RuntimeError(f'{type(ex).__name__}: {ex}')))
+            continue
+
+        connection.send((records, messages, None))
+
+    connection.close()
+
+
+def parallel_engine(engine, processes, schema):
+    """
+    Makes an extraction engine that extracts the records in up to ``processes`` worker processes.
+
+    :param engine: the name of the extraction engine run on the parts, e.g., ``etree``
+    :type engine: str
+    :param processes: the number of worker processes for each document
+    :type processes: int
+    :param schema: the schema the plans passed to the engine are compiled from, ``(data_sch, pref)``,
+            the workers compile it again
+    :type schema: tuple
+    :return: the extraction engine, with the same signature as :func:`stream_xml.stream_data`
+    """
+    def stream_data(source, plan, log, skip=0):
+        return stream_parallel(source, plan, schema, log, skip, engine=engine, processes=processes)
+
+    return stream_data
+
+
+def stream_parallel(source, plan, schema, log, skip=0, engine='etree', processes=2, size=part_size):
+    """
+    Extracts the records of an XML document in worker processes, yielding them in the document order.
+    A document of a single part, or one that finds no idle worker, is extracted in this process.
+
+    :param source: a binary file object with the XML document
+    :param plan: the compiled schema with a single top-level array entry, see :func:`schemas_xml.compile_schema`
+    :type plan: tuple
+    :param schema: the schema the plan is compiled from and the mapping of namespace prefixes, ``(data_sch, pref)``
+    :type schema: tuple
+    :param log: a logger function that takes a string as a single argument
+    :param skip: the number of records to pass over without extracting them, e.g., those written before a checkpoint
+    :type skip: int
+    :param engine: the name of the extraction engine run on each part, see ``engine_modules``
+    :type engine: str
+    :param processes: the most worker processes to use, out of those started with :func:`start_workers`
+    :type processes: int
+    :param size: the records' bytes in a part
+    :type size: int
+    :return: an iterator over the extracted records
+    """
+    workers = checkout_workers(processes)
+    if not workers:
+        yield from find_engine(engine)(source, plan, log, skip)
+        return
+
+    try:
+        entry = array_entry(plan)
+
+        # Every node is a record, unless the entry has alternatives, which need the node to be extracted first
+        if isinstance(entry, ListEntry):
+            parts = split_records(source, entry.tag, size)
+        else:
+            parts, skip = split_records(source, entry.tag, size, skip), 0
+
+        key = json.dumps([engine, schema], sort_keys=True)
+        records = extract_ordered(parts, plan, (key, (engine,) + tuple(schema)), log, workers)
+        try:
+            for record in records:
+                if skip > 0:
+                    skip -= 1
+                    continue
+                yield record
+        finally:
+            records.close()
+    finally:
+        checkin_workers(workers)
+
+
+def extract_ordered(parts, plan, schema, log, workers):
+    """
+    Sends the parts to the worker processes, each in turn, and yields their records in the order of the parts.
+    The workers that break down are dropped from ``workers``.
+
+    :param schema: the key of the schema, and the engine's name and the schema, ``(key, (engine, data_sch, pref))``
+    """
+    key, source = schema
+
+    first = next(parts, None)
+    second = next(parts, None) if first is not None else None
+    if second is None:
+        if first is not None:
+            yield from find_engine(source[0])(BytesIO(first), plan, log)
+        return
+
+    in_flight = deque()  # the workers with a part, in the order of the parts
+    used = 0
+
+    try:
+        for part in chain((first, second), parts):
+            if used < len(workers):
+                worker = workers[used]
+                used += 1
+            else:
+                worker = in_flight.popleft()
+                yield from receive(worker, log, workers)
+
+            _, connection, schemas = worker
+            connection.send((key, source if key not in schemas else None, part))
+            schemas.add(key)
+            in_flight.append(worker)
+
+        while in_flight:
+            yield from receive(in_flight.popleft(), log, workers)
+    finally:
+        # When the consumer stopped early, the parts in flight are still received, so that the workers can be reused
+        while in_flight:
+            worker = in_flight.popleft()
+            try:
+                worker[1].recv()
+            except (EOFError, OSError):
+                workers.remove(worker)
+
+
+def receive(worker, log, workers):
+    """
+    :return: the records of a part extracted by a worker process, its messages go to ``log``
+    :type: list
+    """
+    try:
+        records, messages, error = worker[1].recv()
+    except (EOFError, OSError):
+        workers.remove(worker)
+        raise RuntimeError(f'The worker process {worker[0].pid} stopped')
+
+    for message in messages:
+        log(message)
+    if error is not None:
+        raise error
+
+    return records
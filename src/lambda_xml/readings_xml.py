@@ -0,0 +1,331 @@
+import io
+import threading
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+import packed_xml
+from packed_xml import channel_field, data_field, reading_types, readings_field, type_field
+from sinks_xml import Sink, SinkError
+
+#
+# The `readings` sink: the channel readings of the traffic records, a row per channel,
+# loaded with `COPY` into a table partitioned by day, e.g., `readings_20171231` for 2017-12-31.
+# The partitions are created as the days come up. The rows are buffered as CSV in memory,
+# and copied straight into the table, without an `INSERT` per row.
+# The readings are keyed on the site, the time, and the channel. If some of them were written before,
+# e.g., the file was sent again, the rows are copied into a temporary table instead,
+# and moved into the partitions with an `INSERT ... SELECT` skipping the readings already there.
+# That's when the first reading of the batch is in the table, or when the `COPY` fails on the key,
+# and from then on for the rest of the file.
+# The records are read with the fields of the traffic schema, the schemas with the sink are checked for them
+# when they're loaded, see `missing_fields`.
+#
+
+readings_table = 'readings'
+site_field, site_props = 'site', 'text NOT NULL'
+time_field, time_props = 'measured_at', 'timestamp without time zone NOT NULL'
+channel_column, channel_props = 'channel', 'integer NOT NULL'
+type_column, type_props = 'reading_type', 'text'
+flow_field, flow_props = 'flow', 'numeric'
+input_size_field, input_size_props = 'input_size', 'integer'
+speed_field, speed_props = 'speed', 'numeric'
+readings_pk = f'{site_field}, {time_field}, {channel_column}'
+
+readings_columns = ', '.join([site_field, time_field, channel_column, type_column,
+                              flow_field, input_size_field, speed_field])
+staging_table = 'readings_staging'
+
+unique_violation = '23505'  # the SQLSTATE of a duplicate key
+
+# The fields of the records with the site and the time of the readings,
+# the readings are read with the fields of the packed layout, see `packed_xml`
+site_key = 'measurementSiteReference'
+time_key = 'measurementTimeDefault'
+
+# The paths of the values in the readings' `data_field`, in the order of the value columns
+value_paths = tuple(path for _, paths in reading_types for path in paths)
+no_values = [None] * len(value_paths)
+
+# The partitions known to exist, shared by the threads and the warm invocations
+known_partitions = set()
+known_partitions_lock = threading.Lock()
+
+
+def create_readings_table(connection):
+    cur = connection.cursor()
+    cur.execute(
+        f"CREATE TABLE IF NOT EXISTS {readings_table} ("
+        f"{site_field} {site_props},"
+        f"{time_field} {time_props},"
+        f"{channel_column} {channel_props},"
+        f"{type_column} {type_props},"
+        f"{flow_field} {flow_props},"
+        f"{input_size_field} {input_size_props},"
+        f"{speed_field} {speed_props},"
+        f"PRIMARY KEY ({readings_pk})) "
+        f"PARTITION BY RANGE ({time_field});")
+
+    connection.commit()
+
+
+def partition_name(day):
+    """
+    :param day: a day, e.g., ``2017-12-31``
+    :type day: str
+    :return: the name of the day's partition, e.g., ``readings_20171231``
+    """
+    return f'{readings_table}_{day.replace("-", "")}'
+
+
+def create_partition(connection, day):
+    """
+    Creates the partition of a day, unless it exists.
+
+    :param connection: a connection to the database
+    :param day: the day, e.g., ``2017-12-31``
+    :type day: str
+    """
+    with known_partitions_lock:
+        if day in known_partitions:
+            return
+
+    next_day = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+    cur = connection.cursor()
+    try:
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {partition_name(day)} PARTITION OF {readings_table} "
+                    f"FOR VALUES FROM ('{day}') TO ('{next_day}');")
+        connection.commit()
+    except Exception:
+        # Another Lambda may have created it meanwhile
+        connection.rollback()
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (partition_name(day),))
+        exists = cur.fetchone()[0]
+        connection.commit()
+        if not exists:
+            raise
+
+    with known_partitions_lock:
+        known_partitions.add(day)
+
+
+def missing_fields(fields):
+    """
+    Checks that the records of a schema have the fields the rows are made of.
+
+    :param fields: the compiled entries by the paths of the records' fields, see :func:`schemas_xml.record_fields`
+    :type fields: dict
+    :return: the fields the records don't have
+    :type: list
+    """
+    return [key for key in (site_key, time_key) if (key,) not in fields] + packed_xml.missing_fields(fields)
+
+
+def record_readings(record):
+    """
+    Flattens the readings of a record, without the site and the time repeated in every row.
+    The placeholders of the missing and broken values become NULLs.
+
+    :param record: a record extracted with the traffic schema
+    :type record: dict
+    :return: the site, the time, the rows in the order of the columns after the time in ``readings_columns``,
+            and the number of readings left out, without a site, a valid time, or a channel,
+            in the form ``(site, time, rows, skipped)``
+    :type: tuple
+    """
+    site = record.get(site_key)
+    measured = record.get(time_key)
+    readings = record.get(readings_field)
+    if readings.__class__ is not list:
+        return site, measured, [], 1
+    # An empty site or time, e.g., of an empty node, would fail the whole batch
+    if site.__class__ is not str or site[:1] in ('', '<') or measured.__class__ is not str or measured[:1] in ('', '<'):
+        return site, measured, [], len(readings)
+
+    rows = []
+    skipped = 0
+
+    # `get_path` inlined, it's called for every value
+    for reading in readings:
+        channel = reading.get(channel_field) if reading.__class__ is dict else None
+        if channel.__class__ is not int:
+            skipped += 1
+            continue
+
+        data = reading.get(data_field)
+        if data.__class__ is not dict:
+            rows.append([channel, None] + no_values)
+            continue
+
+        reading_type = data.get(type_field)
+        row = [channel, reading_type if reading_type.__class__ is str and not reading_type.startswith('<') else None]
+        for path in value_paths:
+            value = data
+            for field in path:
+                value = value.get(field) if value.__class__ is dict else None
+            row.append(value if value.__class__ is not str else None)
+
+        rows.append(row)
+
+    return site, measured, rows, skipped
+
+
+def reading_rows(record):
+    """
+    Flattens the readings of a record into whole rows, see :func:`record_readings`.
+
+    :return: the rows, in the order of ``readings_columns``, and the number of readings left out
+    :type: tuple
+    """
+    site, measured, rows, skipped = record_readings(record)
+
+    return [[site, measured] + row for row in rows], skipped
+
+
+def csv_field(text):
+    """
+    :return: a text value as a CSV field, quoted if it has to be, e.g., an empty string, which is NULL unquoted
+    :type: str
+    """
+    if not text or '"' in text or ',' in text or '\n' in text or '\r' in text:
+        return '"' + text.replace('"', '""') + '"'
+
+    return text
+
+
+class ReadingsSink(Sink):
+    """
+    Writes the channel readings of the records into the ``readings`` table with ``COPY``,
+    in transactions of at least ``batch_rows`` rows, the readings already there are skipped.
+    The readings that can't be placed, without a site, a valid time, or a channel, are counted in ``skipped``.
+
+    :param connection: a connection to the database, used by this sink only
+    :param batch_rows: the rows buffered before they're copied
+    :type batch_rows: int
+    :param release: called with the connection when the sink is closed, e.g., to return it to a pool
+    """
+    name = 'readings'
+
+    def __init__(self, connection, batch_rows=50000, release=None):
+        super().__init__()
+        self.connection = connection
+        self.batch_rows = batch_rows
+        self.release = release
+
+        self.rows = 0  # the rows copied
+        self.duplicates = 0  # the rows copied before, e.g., from a file sent twice
+        self.skipped = 0
+
+        # The CSV lines of each record in the buffer, with the key of its first row, in the form
+        # `(site, time, channel, lines)`, they're copied in the order of the key, see `_copy`
+        self.buffer = []
+        self.type_fields = {None: ''}  # the reading types as CSV fields
+        self.buffered = 0  # the records in the buffer
+        self.buffered_rows = 0
+        self.days = set()
+        self.staging = False  # whether the readings go through the staging table
+
+        create_readings_table(connection)
+
+        cur = connection.cursor()
+        cur.execute(f"CREATE TEMPORARY TABLE IF NOT EXISTS {staging_table} "
+                    f"(LIKE {readings_table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;")
+        connection.commit()
+
+    def put_records(self, records):
+        type_fields = self.type_fields
+
+        for record in records:
+            site, measured, rows, skipped = record_readings(record)
+            self.skipped += skipped
+            self.buffered += 1
+            if not rows:
+                continue
+
+            self.buffered_rows += len(rows)
+            self.days.add(measured[:10])
+
+            # The CSV is formatted here rather than with `csv.writer`, the site and the time once per record,
+            # the values follow `readings_columns`
+            prefix = f'{csv_field(site)},{csv_field(measured)},'
+            lines = []
+            for channel, reading_type, flow, input_size, speed in rows:
+                type_text = type_fields.get(reading_type)
+                if type_text is None:
+                    type_text = type_fields[reading_type] = csv_field(reading_type)
+
+                lines.append(f'{prefix}{channel},{type_text},{"" if flow is None else flow},'
+                             f'{"" if input_size is None else input_size},{"" if speed is None else speed}\n')
+
+            self.buffer.append((site, measured, rows[0][0], ''.join(lines)))
+
+        if self.buffered_rows >= self.batch_rows:
+            self._copy()
+
+    def flush(self):
+        if self.buffered > 0:
+            self._copy()
+
+    def close(self):
+        if self.release is not None:
+            self.release(self.connection)
+            self.release = None
+
+    def report(self):
+        return (f'{self.name}: {self.written} records, {self.rows} rows, '
+                f'{self.duplicates} already there, {self.skipped} readings skipped')
+
+    def _copy(self):
+        # In the order of the key, the index of the table is appended to rather than updated all over,
+        # which takes about a fifth off the `COPY`
+        self.buffer.sort(key=itemgetter(0, 1, 2))
+        data = io.StringIO(''.join(lines for _, _, _, lines in self.buffer))
+
+        cur = self.connection.cursor()
+        try:
+            for day in sorted(self.days):
+                create_partition(self.connection, day)
+
+            # A file sent again has its first reading in the table already, it goes to the staging table
+            # straight away instead of failing a `COPY` of the whole batch first
+            if not self.staging and self.buffer:
+                cur.execute(f"SELECT EXISTS (SELECT 1 FROM {readings_table} "
+                            f"WHERE {site_field} = %s AND {time_field} = %s AND {channel_column} = %s);",
+                            self.buffer[0][:3])
+                self.staging = cur.fetchone()[0]
+
+            duplicates = 0
+            if not self.staging:
+                try:
+                    cur.copy_expert(f"COPY {readings_table} ({readings_columns}) FROM STDIN WITH (FORMAT csv);",
+                                    data)
+                    self.connection.commit()
+                except Exception as ex:
+                    self.connection.rollback()
+                    if getattr(ex, 'pgcode', None) != unique_violation:
+                        raise
+
+                    # Some of the readings were written before, e.g., by an earlier invocation with the same file,
+                    # this and the following batches go through the staging table to skip them
+                    self.staging = True
+                    data.seek(0)
+
+            if self.staging:
+                cur.copy_expert(f"COPY {staging_table} ({readings_columns}) FROM STDIN WITH (FORMAT csv);", data)
+                cur.execute(f"INSERT INTO {readings_table} ({readings_columns}) "
+                            f"SELECT {readings_columns} FROM {staging_table} "
+                            f"ON CONFLICT DO NOTHING;")
+                duplicates = self.buffered_rows - cur.rowcount
+                self.connection.commit()
+        except Exception as ex:
+            self.connection.rollback()
+            raise SinkError(f'{self.name}: {type(ex).__name__}: {ex}')
+
+        self.written += self.buffered
+        self.rows += self.buffered_rows - duplicates
+        self.duplicates += duplicates
+
+        self.buffer = []
+        self.buffered = 0
+        self.buffered_rows = 0
+        self.days = set()
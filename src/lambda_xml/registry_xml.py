@@ -0,0 +1,80 @@
+#
+# The table of the data files that were processed, to recognize the duplicates before downloading them:
+# the same version of an object delivered again, or the same object under another key
+#
+
+xml_processed_table = 'xml_processed'
+key_field, key_props = 'file', 'text'
+etag_field, etag_props = 'etag', 'text'
+time_field, time_props = 'date_time_utc', 'timestamp without time zone'
+xml_processed_pk = f'{key_field}, {etag_field}'
+
+
+def create_processed_table(connection):
+    cur = connection.cursor()
+    cur.execute(
+        f"CREATE TABLE IF NOT EXISTS {xml_processed_table} ("
+        f"{key_field} {key_props},"
+        f"{etag_field} {etag_props},"
+        f"{time_field} {time_props},"
+        f"PRIMARY KEY ({xml_processed_pk}));")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {xml_processed_table}_{etag_field}_idx "
+                f"ON {xml_processed_table} ({etag_field});")
+
+    connection.commit()
+
+
+def is_processed(connection, object_key, etag):
+    """
+    :param connection: a connection to the database
+    :param object_key: the file's key in S3
+    :type object_key: str
+    :param etag: the file's ETag
+    :type etag: str
+    :return: whether this version of the file was processed
+    :type: bool
+    """
+    create_processed_table(connection)
+
+    cur = connection.cursor()
+    cur.execute(f"SELECT 1 FROM {xml_processed_table} WHERE {key_field} = %s AND {etag_field} = %s;",
+                (object_key, etag))
+
+    found = cur.fetchone() is not None
+    connection.commit()
+
+    return found
+
+
+def find_etag(connection, etag):
+    """
+    The ETag of an object is a hash of its contents (and of its part sizes, for a multipart upload),
+    so an object with the same ETag under another key,
+    e.g., a file copied or uploaded again as it was, is a duplicate that can be recognized before downloading it.
+
+    :param etag: the file's ETag
+    :type etag: str
+    :return: the key of a processed file with the same ETag, or ``None``
+    :type: str
+    """
+    cur = connection.cursor()
+    cur.execute(f"SELECT {key_field} FROM {xml_processed_table} WHERE {etag_field} = %s LIMIT 1;", (etag,))
+
+    row = cur.fetchone()
+    connection.commit()
+
+    return row[0] if row is not None else None
+
+
+def register_processed(connection, object_key, etag):
+    """
+    Records that a version of a file was processed, or that it's a duplicate of one that was.
+    """
+    cur = connection.cursor()
+    cur.execute(
+        f"INSERT INTO {xml_processed_table} ({key_field}, {etag_field}, {time_field}) "
+        f"VALUES (%s, %s, now() at time zone 'utc') "
+        f"ON CONFLICT DO NOTHING;",
+        (object_key, etag))
+
+    connection.commit()
@@ -0,0 +1,278 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from schemas_xml import xml_schemas_table, file_pattern_field, schema_time_field, proc_schema_field, find_schema
+
+#
+# A cache of the compiled schemas, so that the data files don't query the database for their schema.
+# The schemas are keyed on their file pattern and version timestamp, and a stored schema never changes,
+# so only the list of the known schemas can go stale. It's checked against the database
+# (the latest version timestamp and the number of schemas) at most once per `check_interval`.
+#
+# There are two levels:
+#   * the compiled schemas of the recently used versions, in memory
+#   * the processing schemas and the list of the known schemas, in files under `cache_dir`,
+#     which outlive the process if the Lambda's runtime restarts it in a warm container
+#
+
+cache_dir = os.environ.get('SCHEMA_CACHE_DIR', '/tmp/xml_schemas')
+check_interval = float(os.environ.get('SCHEMA_CHECK_INTERVAL', 300))  # seconds
+cache_size = 16  # the number of compiled schemas kept in memory
+
+index_file = 'index.json'
+
+timestamp_pattern = re.compile(r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?')
+
+
+def parse_timestamp(text):
+    """
+    Parses an ISO 8601 timestamp. The time zone, if any, is ignored,
+    like Postgres ignores it when comparing with a ``timestamp without time zone``.
+
+    :param text: the timestamp, e.g., ``2017-12-31T23:00:42.006Z``
+    :type text: str
+    :return: the timestamp, or ``None`` if it's not in the ISO 8601 format
+    :type: datetime
+    """
+    match = timestamp_pattern.match(text)
+    if match is None:
+        return None
+
+    fraction = (match.group(7) or '0')[:6].ljust(6, '0')
+    return datetime(*(int(group) for group in match.groups()[:6]), int(fraction))
+
+
+def like_pattern(pattern):
+    """
+    Translates an SQL ``LIKE`` pattern into a regular expression.
+
+    :param pattern: the pattern, e.g., ``%Trafficspeed.xml``
+    :type pattern: str
+    :return: the compiled regular expression matching the whole string
+    """
+    parts = []
+    escaped = False
+
+    for char in pattern:
+        if escaped:
+            parts.append(re.escape(char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '%':
+            parts.append('.*')
+        elif char == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+
+    return re.compile(''.join(parts) + r'\Z', re.DOTALL)
+
+
+class SchemaCache:
+    """
+    Finds the schemas for the data files, and compiles each schema version once.
+    Safe to use from several threads, each with its own connection.
+
+    :param compile: compiles a processing schema, its result is what :meth:`load` returns
+    :param directory: the directory for the files of the cache
+    :type directory: str
+    :param size: the number of compiled schemas kept in memory
+    :type size: int
+    :param interval: how long the list of the known schemas is used without checking the database, in seconds
+    :type interval: float
+    """
+    def __init__(self, compile, directory=cache_dir, size=cache_size, interval=check_interval):
+        self.compile = compile
+        self.directory = directory
+        self.size = size
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.token = None  # the version of the schemas table the index is for
+        self.index = []  # the known schemas as `(file pattern, LIKE pattern regex, version)`, the latest first
+        self.checked = None  # when the index was last checked against the database
+        self.compiled = OrderedDict()  # the compiled schemas, the most recently used last
+
+    def invalidate(self):
+        """
+        Makes the next lookup check the list of the known schemas against the database,
+        e.g., after adding a schema.
+        """
+        with self.lock:
+            self.checked = None
+
+    def find(self, object_key, date, connection):
+        """
+        Finds the schema for a data file, the one matching the file's name with the latest timestamp
+        before the file's publication time, see :func:`schemas_xml.find_schema`.
+
+        :param object_key: the file's name
+        :type object_key: str
+        :param date: the file's publication time
+        :type date: str
+        :param connection: a connection to the database
+        :return: the schema's key in the form ``(file pattern, version)``, or ``None`` if none match
+        :type: tuple
+        """
+        moment = parse_timestamp(date)
+        if moment is None:  # let Postgres make sense of it
+            schema = find_schema(object_key, date, connection)
+            return (schema[0], schema[1]) if schema is not None else None
+
+        refreshed = self.refresh(connection)
+        key = self.match(object_key, moment)
+
+        # A schema could have been added since the last check
+        if key is None and not refreshed:
+            self.refresh(connection, force=True)
+            key = self.match(object_key, moment)
+
+        return key
+
+    def load(self, key, connection):
+        """
+        Loads a schema and compiles it, or takes the compiled schema from the cache.
+
+        :param key: the schema's key, see :meth:`find`
+        :type key: tuple
+        :param connection: a connection to the database, only used if the schema isn't in the cache's files
+        :return: the compiled schema
+        """
+        with self.lock:
+            compiled = self.compiled.get(key)
+            if compiled is not None:
+                self.compiled.move_to_end(key)
+                return compiled
+
+        processing = self.read_schema(key)
+        if processing is None:
+            cur = connection.cursor()
+            cur.execute(f'SELECT {proc_schema_field} FROM {xml_schemas_table} '
+                        f'WHERE {file_pattern_field} = %s AND {schema_time_field} = %s;', key)
+
+            row = cur.fetchone()
+            if row is None:
+                raise KeyError(f'No schema for `{key[0]}` from {key[1]}')
+
+            processing = row[0]
+            self.write_schema(key, processing)
+
+        compiled = self.compile(processing)
+
+        with self.lock:
+            self.compiled[key] = compiled
+            while len(self.compiled) > self.size:
+                self.compiled.popitem(last=False)
+
+        return compiled
+
+    def match(self, object_key, moment):
+        for pattern, regex, version in self.index:  # replaced as a whole by `set_index`, never changed in place
+            if version <= moment and regex.match(object_key):
+                return pattern, version
+
+        return None
+
+    def refresh(self, connection, force=False):
+        """
+        Checks the version of the schemas table, and reloads the list of the known schemas if it changed.
+        The lock isn't held while the database is queried, the other threads use the current list meanwhile.
+
+        :return: whether the database was queried
+        :type: bool
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            if self.token is None:  # a new process, the index could be in the files
+                self.read_index()
+
+            checked = self.checked
+            if not force and checked is not None and now - checked < self.interval:
+                return False
+
+            self.checked = now  # the other threads don't check it again meanwhile
+            known = self.token
+
+        try:
+            cur = connection.cursor()
+            cur.execute(f'SELECT max({schema_time_field}), count(*) FROM {xml_schemas_table};')
+            latest, count = cur.fetchone()
+            token = [latest.isoformat() if latest is not None else None, count]
+
+            schemas = None
+            if token != known:
+                cur.execute(f'SELECT {file_pattern_field}, {schema_time_field} FROM {xml_schemas_table} '
+                            f'ORDER BY {schema_time_field} DESC;')
+                schemas = cur.fetchall()
+        except Exception:
+            with self.lock:
+                if self.checked == now:  # the next lookup checks it again
+                    self.checked = checked
+            raise
+
+        if schemas is not None:
+            with self.lock:
+                self.set_index(token, schemas)
+                self.write_index()
+
+        return True
+
+    def set_index(self, token, schemas):
+        self.token = token
+        self.index = [(pattern, like_pattern(pattern), version) for pattern, version in schemas]
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def schema_file(self, key):
+        digest = hashlib.sha1(json.dumps([key[0], key[1].isoformat()]).encode()).hexdigest()
+        return self.path(f'{digest}.json')
+
+    def read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_json(self, path, contents):
+        """
+        Writes a file of the cache, the file is replaced at once, so a reader never sees it half-written.
+        The cache works without its files if they can't be written.
+        """
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump(contents, f)
+            os.replace(temp_path, path)
+        except OSError:
+            pass
+
+    def read_index(self):
+        contents = self.read_json(self.path(index_file))
+        if contents is not None:
+            self.set_index(contents['token'],
+                           [(pattern, parse_timestamp(version)) for pattern, version in contents['schemas']])
+
+    def write_index(self):
+        self.write_json(self.path(index_file),
+                        {'token': self.token,
+                         'schemas': [[pattern, version.isoformat()] for pattern, _, version in self.index]})
+
+    def read_schema(self, key):
+        contents = self.read_json(self.schema_file(key))
+        if contents is None or contents['key'] != [key[0], key[1].isoformat()]:
+            return None
+        return contents['processing']
+
+    def write_schema(self, key, processing):
+        self.write_json(self.schema_file(key), {'key': [key[0], key[1].isoformat()], 'processing': processing})
@@ -1,6 +1,10 @@
 import json
-from datetime import datetime
-from decimal import Decimal
+import re
+from collections import namedtuple
+from types import MappingProxyType
+
+from converters_xml import validate_timestamp, share_string, to_number
+from logs import ExtractionError, wrong_format, missing_value, no_node
 
 #
 # The table for storing known schemas
@@ -49,7 +53,10 @@ def add_schema(schema, connection):
     file_pattern = schema['meta']['files']
     time = schema['meta']['version']
     description = schema['meta']['description']
-    processing_schema = json.dumps(schema['processing'])
+    processing = dict(schema['processing'])
+    if 'sinks' in schema['meta']:
+        processing['sinks'] = schema['meta']['sinks']  # stored with the processing schema, see `sinks_xml`
+    processing_schema = json.dumps(processing)
 
     cur = connection.cursor()
     cur.execute(
@@ -108,23 +115,33 @@ def expand_prefix(tag, prefixes):
     return tag
 
 
+converters = {
+    'int': int,
+    'timestamp': validate_timestamp,
+    'float': to_number,
+    'bool': bool,
+}
+
+
+def get_converter(val_type):
+    """
+    Finds the function converting raw values of a schema type.
+
+    :param val_type: the type from the schema, e.g., ``int`` or ``timestamp``
+    :type val_type: str
+    :return: a function taking the raw value as a single argument
+    """
+    return converters.get(val_type, share_string)
+
+
 def parse_val(raw_val, val_type):
-    if val_type == 'int':
-        return int(raw_val)
-    elif val_type == 'timestamp':
-        datetime.strptime(raw_val, '%Y-%m-%dT%H:%M:%SZ')  # Just for validating the format
-        return raw_val
-    elif val_type == 'float':
-        return Decimal(raw_val)
-    elif val_type == 'bool':
-        return bool(raw_val)
-    else:
-        return raw_val
+    return get_converter(val_type)(raw_val)
 
 
-def extract_data(root, data_sch, pref, log):  # Todo: ideally, replace with XSLT
+def interpret_data(root, data_sch, pref, log):
     """
-    Parses an XML document following a schema.
+    Parses an XML document following a schema, interpreting the schema on every node.
+    This is the reference implementation for :func:`extract_data`, which runs a compiled schema instead.
     
     :param root: the root node of the XML document
     :type root: xml.etree.Element
@@ -193,7 +210,7 @@ def extract_data(root, data_sch, pref, log):  # Todo: ideally, replace with XSLT
             for node in matching_nodes:
                 # 1. map entry - extract the data from the current node using the map as a schema
                 if isinstance(data_sch[entry], dict):
-                    sub_rec = extract_data(node, data_sch[entry], pref, log)
+                    sub_rec = interpret_data(node, data_sch[entry], pref, log)
                     sub_records.append(sub_rec)
 
                 # 2. list entry - use the list elements as options for the schema of the current node
@@ -206,12 +223,10 @@ def extract_data(root, data_sch, pref, log):  # Todo: ideally, replace with XSLT
                         match = node.find(pattern1, pref)
                         
                         if match is not None:
-                            del option['_']
+                            sub_sch = {k: v for k, v in option.items() if k != '_'}
 
-                            sub_rec = extract_data(match, option, pref, log)
+                            sub_rec = interpret_data(match, sub_sch, pref, log)
                             sub_records.append(sub_rec)
-
-                            option['_'] = pattern1
                             break
 
                     continue
@@ -275,3 +290,439 @@ def extract_data(root, data_sch, pref, log):  # Todo: ideally, replace with XSLT
                 record[field_name] = sub_records
 
     return record
+
+
+#
+# Compiled schemas
+#
+
+# An attribute of the current node, e.g., `_.id: str, measurementSiteReference`
+AttribEntry = namedtuple('AttribEntry', 'entry field attrib convert')
+
+# The non-attribute entries locate their nodes relative to the current node
+# along one of the axes below, using `steps`, the tags on the way to the node.
+# The last of the steps is the entry's `tag`.
+DESCENDANT = 'descendant'  # `ns1.tag` or `//ns1.tag`, any node in the subtree, including the current one
+CHILD = 'child'  # `/ns1.tag`, a direct child
+PATH = 'path'  # `/ns1.parent/ns1.tag`, a fixed path of children
+
+# A node's value, taken either from the node's text or from an attribute (when `attrib` isn't `None`),
+# e.g., `ns1.measurementTimeDefault: text, timestamp, measurementTimeDefault`
+ValueEntry = namedtuple('ValueEntry', 'entry field tag axis steps is_array attrib convert')
+
+# A node with its own schema, e.g., `ns1.siteMeasurements[]: {...}`
+MapEntry = namedtuple('MapEntry', 'entry field tag axis steps is_array entries')
+
+# A node with alternative schemas, e.g., `ns1.basicData: [...]`
+# When all the alternatives test the same attribute for different values,
+# `dispatch` is a pair `(attribute, {value: option})`, otherwise it's `None`
+ListEntry = namedtuple('ListEntry', 'entry field tag axis steps is_array options dispatch')
+
+# One of the alternatives of a list entry,
+# `match` takes a node and returns the node to extract the record from, or `None`,
+# `test` is the attribute and the value the pattern tests for, see `parse_pattern`
+Option = namedtuple('Option', 'pattern match test entries')
+
+# Patterns testing the node's own attribute, `.[@attr]` and `.[@attr="value"]`
+attrib_pattern = re.compile(r'''^\.\[@([\w.:-]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'))?\]$''')
+
+
+def parse_pattern(pattern, pref):
+    """
+    Recognizes the patterns that only test the node's own attribute.
+
+    :param pattern: an XPath expression relative to the node, e.g., ``.[@xsi:type="TrafficFlow"]``
+    :type pattern: str
+    :param pref: the mapping of namespace prefixes
+    :type pref: dict
+    :return: the attribute and the value it should have (``None`` if it only has to exist),
+            or ``None`` for other patterns
+    :type: tuple
+    """
+    parsed = attrib_pattern.match(pattern.strip())
+    if parsed is None:
+        return None
+
+    value = parsed.group(2) if parsed.group(2) is not None else parsed.group(3)
+    return expand_prefix(parsed.group(1), pref), value
+
+
+def compile_pattern(pattern, pref):
+    """
+    Precompiles an alternative's pattern (the ``_`` key of a list entry), e.g., ``.[@index]``.
+    Attribute tests become direct attribute lookups, other patterns are run as XPath queries.
+
+    :param pattern: an XPath expression relative to the node
+    :type pattern: str
+    :param pref: the mapping of namespace prefixes
+    :type pref: dict
+    :return: a function that takes a node and returns the first match or ``None``
+    """
+    parsed = parse_pattern(pattern, pref)
+
+    if parsed is None:
+        def match(node):
+            return node.find(pattern, pref)
+
+    elif parsed[1] is None:
+        attrib = parsed[0]
+
+        def match(node):
+            return node if node.get(attrib) is not None else None
+
+    else:
+        attrib, value = parsed
+
+        def match(node):
+            return node if node.get(attrib) == value else None
+
+    return match
+
+
+def compile_dispatch(options):
+    """
+    Builds a lookup table for the alternatives that all test the same attribute for different values.
+
+    :param options: the compiled alternatives
+    :type options: tuple
+    :return: the attribute and a read-only mapping from its values to the alternatives,
+            or ``None`` if the alternatives don't fit a table
+    :type: tuple
+    """
+    parsed = [option.test for option in options]
+
+    if not parsed or any(p is None or p[1] is None for p in parsed) or len({p[0] for p in parsed}) > 1:
+        return None
+
+    table = {}
+    for (_, value), option in zip(parsed, options):
+        table.setdefault(value, option)  # the first alternative wins, like when trying them in order
+
+    return parsed[0][0], MappingProxyType(table)
+
+
+def compile_path(name, pref):
+    """
+    Resolves the location of an entry's nodes.
+
+    :param name: the entry's name with namespace prefixes, e.g., ``/ns1:measuredValue/ns1:basicData``
+    :type name: str
+    :param pref: the mapping of namespace prefixes
+    :type pref: dict
+    :return: the axis and the tags along the way, in the form ``(axis, steps)``
+    :type: tuple
+    """
+    if name.startswith('//') or not name.startswith('/'):
+        return DESCENDANT, (expand_prefix(name.lstrip('/'), pref),)
+
+    steps = tuple(expand_prefix(step, pref) for step in name[1:].split('/'))
+    return (CHILD if len(steps) == 1 else PATH), steps
+
+
+def compile_schema(data_sch, pref):
+    """
+    Compiles a schema for extracting fields into a plan for :func:`run_plan`.
+    All the tags in the plan are in the Clark notation, and the value converters are already resolved,
+    so that the schema isn't re-interpreted for every node.
+
+    An entry's name can start with ``/`` to look up direct children (``/ns1.tag``)
+    or a fixed path of them (``/ns1.parent/ns1.tag``) instead of the whole subtree.
+    Names without a slash, or starting with ``//``, match any node in the subtree.
+
+    :param data_sch: the schema for extracting fields
+    :type data_sch: dict
+    :param pref: the mapping of namespace prefixes
+    :type pref: dict
+    :return: the compiled entries
+    :type: tuple
+    """
+    entries = []
+
+    for entry in data_sch:
+        is_array = entry.strip().endswith('[]')
+        name = entry.strip().replace('.', ':').replace('[]', '')
+        sub_sch = data_sch[entry]
+
+        # Attribute entry
+        if name.startswith('_'):
+            attrib_props = sub_sch.split(',')
+
+            entries.append(AttribEntry(entry=entry,
+                                       field=attrib_props[1].strip(),
+                                       attrib=expand_prefix(name.strip('_:'), pref),
+                                       convert=get_converter(attrib_props[0].strip())))
+
+        # Map entry
+        elif isinstance(sub_sch, dict):
+            axis, steps = compile_path(name, pref)
+            entries.append(MapEntry(entry=entry,
+                                    field=name.split('/')[-1],
+                                    tag=steps[-1],
+                                    axis=axis,
+                                    steps=steps,
+                                    is_array=is_array,
+                                    entries=compile_schema(sub_sch, pref)))
+
+        # List entry
+        elif isinstance(sub_sch, list):
+            axis, steps = compile_path(name, pref)
+            options = tuple(
+                Option(pattern=option['_'],
+                       match=compile_pattern(option['_'], pref),
+                       test=parse_pattern(option['_'], pref),
+                       entries=compile_schema({k: v for k, v in option.items() if k != '_'}, pref))
+                for option in sub_sch
+            )
+
+            entries.append(ListEntry(entry=entry,
+                                     field=name.split('/')[-1],
+                                     tag=steps[-1],
+                                     axis=axis,
+                                     steps=steps,
+                                     is_array=is_array,
+                                     options=options,
+                                     dispatch=compile_dispatch(options)))
+
+        # Entry without children
+        else:
+            node_props = sub_sch.split(',')
+            getter = node_props[0].strip()  # has one of the two forms: `_.<attribute name>` or `text`
+            axis, steps = compile_path(name, pref)
+
+            entries.append(ValueEntry(entry=entry,
+                                      field=node_props[2].strip(),
+                                      tag=steps[-1],
+                                      axis=axis,
+                                      steps=steps,
+                                      is_array=is_array,
+                                      attrib=(expand_prefix(getter.split('.')[1].strip(), pref)
+                                              if getter.startswith('_') else None),
+                                      convert=get_converter(node_props[1].strip())))
+
+    return tuple(entries)
+
+
+def convert_val(raw_val, entry, root, log):
+    """
+    Converts a raw value following a compiled entry, substituting placeholders for broken values.
+    The problems are reported to the logger as :class:`logs.ExtractionError`.
+    """
+    try:
+        return entry.convert(raw_val)
+    except ValueError:
+        log(ExtractionError(entry.entry, wrong_format, root))
+        return '<parsing error (0)>' if isinstance(entry, AttribEntry) else '<parsing error (2)>'
+    except TypeError:
+        log(ExtractionError(entry.entry, missing_value, root))
+        return '<missing>'
+
+
+def select_option(entry, node):
+    """
+    Finds the first alternative of a list entry that matches a node.
+
+    :param entry: the compiled list entry
+    :param node: the node to match
+    :type node: xml.etree.Element
+    :return: the alternative and the node to extract the record from, or ``(None, None)`` if none match
+    :type: tuple
+    """
+    if entry.dispatch is not None:
+        attrib, table = entry.dispatch
+        option = table.get(node.get(attrib))
+
+        return (option, node) if option is not None else (None, None)
+
+    for option in entry.options:
+        match = option.match(node)
+
+        if match is not None:
+            return option, match
+
+    return None, None
+
+
+def extract_option(entry, node, log):
+    """
+    Extracts a record from a node using the first matching alternative.
+
+    :param entry: the compiled list entry
+    :param node: the node to extract the record from
+    :type node: xml.etree.Element
+    :param log: a logger function that takes a string as a single argument
+    :return: the record, or ``None`` if none of the alternatives match the node
+    """
+    option, match = select_option(entry, node)
+
+    return run_plan(option.entries, match, log) if option is not None else None
+
+
+def yields_record(entry, node):
+    """
+    :return: whether :func:`extract_node` extracts a value from a node, without extracting it,
+            e.g., to skip the records written before a checkpoint
+    :type: bool
+    """
+    return not isinstance(entry, ListEntry) or select_option(entry, node)[0] is not None
+
+
+def extract_node(entry, node, log):
+    """
+    Extracts a value from a single node matching a compiled non-attribute entry.
+
+    :return: the value, or ``None`` if it's a list entry, and none of the alternatives match the node
+    """
+    if isinstance(entry, MapEntry):
+        return run_plan(entry.entries, node, log)
+    elif isinstance(entry, ListEntry):
+        return extract_option(entry, node, log)
+    else:
+        raw_val = node.get(entry.attrib) if entry.attrib is not None else node.text
+        return convert_val(raw_val, entry, node, log)
+
+
+def walk_path(node, steps):
+    """
+    Finds the nodes at the end of a fixed path of children, visiting no other nodes.
+    """
+    nodes = node.findall(steps[0])
+
+    for tag in steps[1:]:
+        nodes = [child for parent in nodes for child in parent.findall(tag)]
+
+    return nodes
+
+
+def first_on_path(node, steps):
+    """
+    Finds the first node at the end of a fixed path of children, following the first child with each tag,
+    and only walking the whole path when that branch ends early.
+    """
+    found = node
+
+    for tag in steps:
+        found = found.find(tag)
+
+        if found is None:
+            return walk_path(node, steps)[:1]
+
+    return (found,)
+
+
+def find_nodes(entry, root):
+    """
+    Iterates over the nodes matching a compiled non-attribute entry.
+    For the child and path axes of non-array entries, only the first matching node is looked up.
+
+    :param entry: the compiled entry
+    :param root: the node to start the search from
+    :type root: xml.etree.Element
+    :return: an iterable over the matching nodes, in the document order
+    """
+    if entry.axis == DESCENDANT:
+        return root.iter(entry.tag)
+    elif entry.axis == CHILD:
+        if entry.is_array:
+            return root.findall(entry.tag)  # a plain tag is matched against the children without the XPath machinery
+
+        node = root.find(entry.tag)
+        return (node,) if node is not None else ()
+    elif entry.is_array:
+        return walk_path(root, entry.steps)
+    else:
+        return first_on_path(root, entry.steps)
+
+
+def record_fields(entry):
+    """
+    Lists the fields of the records extracted with a compiled map or list entry, including the nested records' fields,
+    e.g., to check that a schema's records have the fields an encoding relies on.
+
+    :param entry: the compiled entry, e.g., the top-level array entry for the streamed records
+    :return: the compiled entries by the paths of their fields in the records,
+            e.g., ``('ns1:measuredValue', 'Channel')``, the items of the arrays are skipped over
+    :type: dict
+    """
+    fields = {}
+    alternatives = [entry.entries] if isinstance(entry, MapEntry) else [option.entries for option in entry.options]
+
+    for entries in alternatives:
+        for sub_entry in entries:
+            fields.setdefault((sub_entry.field,), sub_entry)
+
+            if isinstance(sub_entry, (MapEntry, ListEntry)):
+                for path, nested in record_fields(sub_entry).items():
+                    fields.setdefault((sub_entry.field,) + path, nested)
+
+    return fields
+
+
+def missing_field(entry):
+    """
+    :return: the key of the ``'<missing>'`` placeholder when no node matches a non-array entry,
+            the tag as named in the schema (e.g., ``ns1:speed``) like in :func:`interpret_data`,
+            rather than the output key of a value entry
+    :type: str
+    """
+    return entry.entry.strip().replace('.', ':').replace('[]', '').split('/')[-1]
+
+
+def run_plan(plan, root, log):
+    """
+    Parses an XML node following a compiled schema.
+
+    :param plan: the compiled schema, see :func:`compile_schema`
+    :type plan: tuple
+    :param root: the node to extract the data from
+    :type root: xml.etree.Element
+    :param log: a logger function that takes a string as a single argument
+
+    :return: the extracted record
+    :type: dict
+    """
+    record = {}
+
+    for entry in plan:
+        if isinstance(entry, AttribEntry):
+            record[entry.field] = convert_val(root.get(entry.attrib), entry, root, log)
+            continue
+
+        sub_records = []
+
+        for node in find_nodes(entry, root):
+            sub_rec = extract_node(entry, node, log)
+
+            if sub_rec is not None or not isinstance(entry, ListEntry):
+                sub_records.append(sub_rec)
+
+                # If the entry isn't an array, we can stop after processing the first matching node
+                if not entry.is_array:
+                    break
+
+        if entry.is_array:
+            record[entry.field] = sub_records
+        elif len(sub_records) > 0:
+            record[entry.field] = sub_records[0]
+        else:
+            record[missing_field(entry)] = '<missing>'
+            log(ExtractionError(entry.entry, no_node, root))
+
+    return record
+
+
+def extract_data(root, data_sch, pref, log):
+    """
+    Parses an XML document following a schema.
+
+    :param root: the root node of the XML document
+    :type root: xml.etree.Element
+    :param data_sch: the schema for extracting fields
+    :type data_sch: dict
+    :param pref: the mapping of namespace prefixes
+    :type pref: dict
+    :param log: a logger function that takes a string as a single argument
+
+    :return:
+    :type: dict
+    """
+    return run_plan(compile_schema(data_sch, pref), root, log)
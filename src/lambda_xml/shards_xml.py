@@ -0,0 +1,171 @@
+import os
+import random
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from dynamo_xml import error_code, key_value, throttling_codes
+
+#
+# Write sharding for the access patterns keyed on the measurement time, e.g., a GSI of all the sites at a minute.
+# All the items of a data file share their time and are written in a burst, so keyed on the time alone,
+# they would all go to a single partition, which takes only so many writes per second.
+# Instead, each item gets a shard attribute, `timeShard`, combining the time with a shard of the site:
+#   * `hash:<count>`, e.g., `2017-12-31T22:59:00Z#7`, the shards are a hash of the site modulo the count
+#   * `prefix:<length>`, e.g., `2017-12-31T22:59:00Z#PZH01`, the shards are the first characters of the site,
+#     for the prefixes listed in `SHARD_PREFIXES`, the sites with other prefixes share the shard `*`
+# A read of a time queries every shard, see `query_shards`.
+#
+
+shard_field = 'timeShard'
+site_field = 'measurementSiteReference'
+time_field = 'measurementTimeDefault'
+
+max_queries = 10  # how many times a throttled query is retried
+
+other_prefixes = '*'  # the shard of the sites whose prefixes aren't listed
+
+
+class HashShards:
+    """
+    Spreads the sites of a time over ``count`` shards, by the CRC-32 of the site.
+    """
+    def __init__(self, count):
+        self.count = count
+
+    def shard_key(self, site, timestamp):
+        return f'{timestamp}#{zlib.crc32(site.encode()) % self.count}'
+
+    def shard_keys(self, timestamp):
+        """
+        :return: the keys of all the shards of a time
+        :type: list
+        """
+        return [f'{timestamp}#{shard}' for shard in range(self.count)]
+
+
+class PrefixShards:
+    """
+    Groups the sites of a time into shards by their first ``length`` characters,
+    e.g., the road authority of the NDW sites. With the ``prefixes`` listed, the sites with other prefixes
+    share a shard, ``*``, and all the shards of a time can be read. Without them, the shards are unknown.
+    """
+    def __init__(self, length, prefixes=()):
+        self.length = length
+        self.prefixes = set(prefixes)
+
+    def shard_key(self, site, timestamp):
+        prefix = site[:self.length]
+        if self.prefixes and prefix not in self.prefixes:
+            prefix = other_prefixes
+        return f'{timestamp}#{prefix}'
+
+    def shard_keys(self, timestamp):
+        if not self.prefixes:
+            raise ValueError('The site prefixes have to be listed, with `SHARD_PREFIXES`, to read all the shards')
+
+        return [f'{timestamp}#{prefix}' for prefix in sorted(self.prefixes)] + [f'{timestamp}#{other_prefixes}']
+
+
+def parse_scheme(spec, prefixes=()):
+    """
+    :param spec: the key scheme, e.g., ``hash:16`` or ``prefix:5``, or an empty string for no sharding
+    :type spec: str
+    :param prefixes: the site prefixes of the ``prefix`` scheme, which get a shard each
+    :return: the key scheme, or ``None``
+    """
+    if not spec:
+        return None
+
+    kind, _, size = spec.partition(':')
+    if kind in ('hash', 'prefix') and size.isdigit() and int(size) > 0:
+        if kind == 'hash':
+            return HashShards(int(size))
+
+        prefixes = list(prefixes)
+        mismatched = [prefix for prefix in prefixes if len(prefix) != int(size)]
+        if mismatched:
+            raise ValueError(f'The site prefixes have to be {size} characters long, not {", ".join(mismatched)}')
+        return PrefixShards(int(size), prefixes)
+
+    raise ValueError(f'Unknown key scheme `{spec}`, e.g., `hash:16` or `prefix:5`')
+
+
+def configured_scheme(environ=os.environ):
+    """
+    :param environ: the environment variables, ``SHARD_SCHEME``, e.g., ``prefix:5``,
+            and for the ``prefix`` scheme, the comma-separated ``SHARD_PREFIXES``, e.g., ``PZH01,RWS01,GEO01``
+    :type environ: dict
+    :return: the key scheme the items are written with, or ``None``
+    """
+    prefixes = [prefix.strip() for prefix in environ.get('SHARD_PREFIXES', '').split(',') if prefix.strip()]
+    return parse_scheme(environ.get('SHARD_SCHEME', ''), prefixes)
+
+
+def shard_encoder(encode, scheme):
+    """
+    Wraps an encoder of the records as DynamoDB items, to add the shard attribute to the items.
+
+    :param encode: the encoder of the items, see :func:`dynamo_xml.compile_encoder`
+    :param scheme: the key scheme, see :func:`parse_scheme`
+    :return: a function taking a record, and returning the item
+    """
+    def encode_sharded(record):
+        item = encode(record)
+        item[shard_field] = {'S': scheme.shard_key(str(record[site_field]), str(record[time_field]))}
+        return item
+
+    return encode_sharded
+
+
+def query_shard(client, shard_key, **kwargs):
+    """
+    :return: all the items of a shard, following the pages of the query, and retrying it while it's throttled
+    :type: list
+    """
+    request = dict(kwargs, KeyConditionExpression='#shard = :shard',
+                   ExpressionAttributeNames={'#shard': shard_field},
+                   ExpressionAttributeValues={':shard': {'S': shard_key}})
+    items = []
+    attempt = 0
+
+    while True:
+        try:
+            response = client.query(**request)
+        except Exception as ex:
+            attempt += 1
+            if error_code(ex) not in throttling_codes or attempt >= max_queries:
+                raise
+
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+            continue
+
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def query_shards(client, table_name, index_name, shard_keys, workers=8):
+    """
+    Reads the items of a time from all its shards, with concurrent queries.
+
+    :param client: a DynamoDB client
+    :param table_name: the table
+    :type table_name: str
+    :param index_name: the index keyed on the shard attribute
+    :type index_name: str
+    :param shard_keys: the keys of the shards, e.g., ``scheme.shard_keys('2017-12-31T22:59:00Z')``
+    :type shard_keys: list
+    :param workers: the most queries in flight
+    :type workers: int
+    :return: the items in the wire format, in the order of their sites
+    :type: list
+    """
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(shard_keys)))) as executor:
+        shards = executor.map(lambda shard_key: query_shard(client, shard_key, TableName=table_name,
+                                                            IndexName=index_name), shard_keys)
+        items = [item for shard in shards for item in shard]
+
+    items.sort(key=lambda item: key_value(item[site_field]))
+    return items
@@ -0,0 +1,415 @@
+import gzip
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from decimal import Decimal
+
+#
+# The outputs of the extracted records. A sink takes the records in batches, in the file's order,
+# and the records of a file can go to several sinks at once, e.g., DynamoDB for the readers
+# and compressed JSON files in S3 as an archive, from a single pass over the XML.
+#
+# The sinks of a schema are listed in its `meta` section, e.g.:
+#   sinks:
+#     - dynamodb
+#     - type: ndjson
+#       prefix: archive/
+#       max_bytes: 67108864
+#     - postgres
+#     - type: readings
+#       batch_rows: 100000
+# The sinks are `dynamodb` (the default), `ndjson`, `postgres`, and `readings`,
+# see the classes below and `readings_xml.ReadingsSink` for their options.
+#
+
+default_sinks = [{'type': 'dynamodb'}]
+
+
+class SinkError(Exception):
+    """
+    Some of the records couldn't be written.
+    """
+
+
+def sink_configs(sinks):
+    """
+    :param sinks: the sinks from a schema's ``meta`` section, names or dictionaries with a ``type`` and options
+    :type sinks: list
+    :return: the sinks' configurations, each a dictionary with a ``type``
+    :type: list
+    """
+    if not sinks:
+        return default_sinks
+
+    configs = []
+    for sink in sinks:
+        config = {'type': sink} if isinstance(sink, str) else dict(sink)
+        if config.get('type') not in ('dynamodb', 'ndjson', 'postgres', 'readings'):
+            raise ValueError(f'Unknown sink `{config.get("type")}`')
+        configs.append(config)
+
+    return configs
+
+
+class Sink:
+    """
+    The interface of the sinks. Use as a context manager: the records passed to :meth:`put_records`
+    are only guaranteed to be written after :meth:`flush`, or at the end of the ``with`` block.
+    """
+    name = 'sink'
+
+    def __init__(self):
+        self.written = 0  # the records written
+
+    def put_records(self, records):
+        """
+        Writes a batch of records, or queues them for writing.
+        Raises :class:`SinkError` (or the sink's own error) if some of the earlier records couldn't be written.
+
+        :param records: the records, as extracted
+        :type records: list
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Waits until all the records are written.
+        """
+
+    def close(self):
+        """
+        Releases the sink's resources, the records that weren't flushed may be lost.
+        """
+
+    def report(self):
+        """
+        :return: a log message about the records written
+        :type: str
+        """
+        return f'{self.name}: {self.written} records'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.close()
+
+
+class DynamoDBSink(Sink):
+    """
+    Writes the records as DynamoDB items.
+
+    :param writer: the writer of the items, e.g., a :class:`dynamo_xml.ParallelWriter`
+    :param encoder: the encoder of the records as items, see :func:`dynamo_xml.compile_encoder`
+    """
+    name = 'dynamodb'
+
+    def __init__(self, writer, encoder):
+        super().__init__()
+        self.writer = writer
+        self.encoder = encoder
+
+    def put_records(self, records):
+        self.writer.put_items(map(self.encoder, records))
+        self.written = self.writer.stats.items
+
+    def flush(self):
+        self.writer.flush()
+        self.written = self.writer.stats.items
+
+    def close(self):
+        self.writer.close()
+
+    def report(self):
+        return f'{self.name}: {self.writer.report()}'
+
+    def __exit__(self, *exc):
+        self.writer.__exit__(*exc)  # the writer drops its queue if the writes were abandoned
+        self.written = self.writer.stats.items
+
+
+def json_number(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class NDJSONSink(Sink):
+    """
+    Writes the records as newline-delimited JSON, into gzip-compressed parts of at most ``max_bytes`` of JSON.
+    A part is written to a temporary file, and passed to ``upload`` when it's complete, or when the sink is flushed.
+    The parts are named after the file and their first record, e.g., ``data.xml.0000001000.ndjson.gz``,
+    so writing the same records again replaces the same parts.
+
+    :param upload: a function taking the path of a part and its name, e.g., uploading it to S3
+    :param name: the name of the data file
+    :type name: str
+    :param first_record: the index of the first record in the data file, when continuing from a checkpoint
+    :type first_record: int
+    :param max_bytes: the largest part, in bytes of JSON before the compression
+    :type max_bytes: int
+    """
+    name = 'ndjson'
+
+    def __init__(self, upload, name, first_record=0, max_bytes=64 * 2 ** 20, compresslevel=6):
+        super().__init__()
+        self.upload = upload
+        self.file_name = name
+        self.position = first_record
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+
+        self.parts = 0
+        self.compressed = 0
+
+        # The open part
+        self.path = None
+        self.file = None
+        self.gzip = None
+        self.first = 0
+        self.size = 0
+
+    def put_records(self, records):
+        for record in records:
+            if self.path is None:
+                fd, self.path = tempfile.mkstemp(suffix='.ndjson.gz')
+                self.file = os.fdopen(fd, 'wb')
+                self.gzip = gzip.GzipFile(fileobj=self.file, mode='wb', compresslevel=self.compresslevel)
+                self.first = self.position
+                self.size = 0
+
+            line = json.dumps(record, default=json_number, separators=(',', ':')).encode() + b'\n'
+            self.gzip.write(line)
+            self.size += len(line)
+            self.position += 1
+
+            if self.size >= self.max_bytes:
+                self._finish_part()
+
+    def flush(self):
+        if self.path is not None:
+            self._finish_part()
+
+    def close(self):
+        if self.path is not None:
+            self.file.close()
+            os.remove(self.path)
+            self.path = None
+
+    def report(self):
+        return f'{self.name}: {self.written} records in {self.parts} parts, {self.compressed} bytes compressed'
+
+    def _finish_part(self):
+        path = self.path
+        self.path = None
+
+        self.gzip.close()
+        self.file.close()
+
+        try:
+            self.compressed += os.path.getsize(path)
+            self.upload(path, f'{self.file_name}.{self.first:010d}.ndjson.gz')
+        except Exception as ex:
+            raise SinkError(f'{self.name}: {type(ex).__name__}: {ex}')
+        finally:
+            os.remove(path)
+
+        self.parts += 1
+        self.written += self.position - self.first
+
+
+#
+# The table of the `postgres` sink, the records as JSON, keyed on the file and the record's index in it
+#
+
+xml_records_table = 'xml_records'
+file_field, file_props = 'file', 'text'
+index_field, index_props = 'record_index', 'bigint'
+record_field, record_props = 'record', 'jsonb NOT NULL'
+xml_records_pk = f'{file_field}, {index_field}'
+
+
+def create_records_table(connection):
+    cur = connection.cursor()
+    cur.execute(
+        f"CREATE TABLE IF NOT EXISTS {xml_records_table} ("
+        f"{file_field} {file_props},"
+        f"{index_field} {index_props},"
+        f"{record_field} {record_props},"
+        f"PRIMARY KEY ({xml_records_pk}));")
+
+    connection.commit()
+
+
+class PostgresSink(Sink):
+    """
+    Writes the records as JSON into the ``xml_records`` table, a transaction per batch.
+    The records written again, e.g., after a checkpoint, replace the earlier ones.
+
+    :param connection: a connection to the database, used by this sink only
+    :param name: the name of the data file
+    :type name: str
+    :param first_record: the index of the first record in the data file, when continuing from a checkpoint
+    :type first_record: int
+    :param release: called with the connection when the sink is closed, e.g., to return it to a pool
+    """
+    name = 'postgres'
+
+    def __init__(self, connection, name, first_record=0, release=None):
+        from psycopg2.extras import execute_values
+
+        super().__init__()
+        self.execute_values = execute_values
+        self.connection = connection
+        self.release = release
+        self.file_name = name
+        self.position = first_record
+
+        create_records_table(connection)
+
+    def put_records(self, records):
+        rows = [(self.file_name, self.position + i, json.dumps(record, default=json_number))
+                for i, record in enumerate(records)]
+
+        cur = self.connection.cursor()
+        try:
+            self.execute_values(
+                cur,
+                f"INSERT INTO {xml_records_table} ({file_field}, {index_field}, {record_field}) VALUES %s "
+                f"ON CONFLICT ({xml_records_pk}) DO UPDATE SET {record_field} = EXCLUDED.{record_field};",
+                rows, page_size=1000)
+            self.connection.commit()
+        except Exception as ex:
+            self.connection.rollback()
+            raise SinkError(f'{type(ex).__name__}: {ex}')
+
+        self.position += len(rows)
+        self.written += len(rows)
+
+    def close(self):
+        if self.release is not None:
+            self.release(self.connection)
+            self.release = None
+
+
+class ThreadedSink(Sink):
+    """
+    Runs a sink in its own thread, taking the batches through a queue of at most ``depth`` batches,
+    so that several sinks can write at once. The sink's errors are raised by the next call.
+    """
+    def __init__(self, sink, depth=4):
+        super().__init__()
+        self.sink = sink
+        self.name = sink.name
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.work = 0.0  # the time spent writing
+        self.blocked = 0.0  # the time waiting for room in the queue
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put_records(self, records):
+        self._check()
+
+        started = time.perf_counter()
+        self.queue.put(records)
+        self.blocked += time.perf_counter() - started
+
+    def flush(self):
+        self.queue.join()
+        self._check()
+
+        self.sink.flush()
+        self.written = self.sink.written
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.sink.close()
+
+    def report(self):
+        return f'{self.sink.report()}, busy {self.work:.2f} s, the others waited {self.blocked:.2f} s for it'
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self.error = self.error or SinkError(f'{self.name}: the writes were abandoned')  # skip the queue
+
+        self.queue.put(None)
+        self.thread.join()
+
+        error = self.error if exc_type is None else None
+        if error is not None:
+            self.sink.__exit__(type(error), error, None)
+        else:
+            self.sink.__exit__(exc_type, *exc)
+
+        self.written = self.sink.written
+        if error is not None:
+            raise error
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            records = self.queue.get()
+            try:
+                if records is None:
+                    return
+
+                if self.error is None:
+                    started = time.perf_counter()
+                    self.sink.put_records(records)
+                    self.work += time.perf_counter() - started
+            except Exception as ex:
+                self.error = ex if isinstance(ex, SinkError) else SinkError(f'{self.name}: {type(ex).__name__}: {ex}')
+            finally:
+                self.queue.task_done()
+
+
+class FanOut(Sink):
+    """
+    Writes the records to several sinks at once, each in its own thread, see :class:`ThreadedSink`.
+    A record is written once it's written by all the sinks.
+    """
+    name = 'fan-out'
+
+    def __init__(self, sinks, depth=4):
+        super().__init__()
+        self.sinks = [ThreadedSink(sink, depth) for sink in sinks]
+
+    def put_records(self, records):
+        for sink in self.sinks:
+            sink.put_records(records)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+        self.written = min(sink.written for sink in self.sinks)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def report(self):
+        return '; '.join(sink.report() for sink in self.sinks)
+
+    def __exit__(self, exc_type, *exc):
+        errors = []
+        for sink in self.sinks:
+            try:
+                sink.__exit__(exc_type, *exc)
+            except Exception as ex:
+                errors.append(ex)
+
+        self.written = min(sink.written for sink in self.sinks)
+        if errors and exc_type is None:
+            raise errors[0]
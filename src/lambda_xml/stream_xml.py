@@ -0,0 +1,527 @@
+import gzip
+import queue
+import resource
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+from xml.etree.ElementTree import iterparse, XMLPullParser
+
+from schemas_xml import AttribEntry, extract_node, yields_record
+
+
+class CountingReader:
+    """
+    A binary file object wrapping a stream (e.g., S3's ``StreamingBody``),
+    that counts the bytes read from the stream.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read() if size is None or size < 0 else self.stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class ReplayReader(CountingReader):
+    """
+    A binary file object that remembers the beginning of a stream,
+    so that the stream can be read again from the start after a look at its head.
+    """
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.head = bytearray()
+        self.recording = True
+        self.offset = None  # the read position in the head while replaying
+
+    def read(self, size=-1):
+        if self.offset is not None:
+            if size is None or size < 0:
+                data = bytes(self.head[self.offset:]) + super().read()
+            else:
+                data = bytes(self.head[self.offset:self.offset + size])
+
+            self.offset += len(data)
+            if self.offset >= len(self.head):
+                # The head is used up, no need to keep it
+                self.head = bytearray()
+                self.offset = None
+
+            if data:
+                return data
+
+        data = super().read(size)
+        if self.recording:
+            self.head += data
+        return data
+
+    def replay(self):
+        """
+        Rewinds to the start of the stream and stops remembering the data that is read.
+        """
+        self.recording = False
+        self.offset = 0 if self.head else None
+
+
+def open_body(body, compressed):
+    """
+    Wraps a binary stream with the data file, decompressing it on the fly if necessary.
+    The result can be passed to the XML parser directly,
+    so the file never has to be held in memory in full.
+
+    :param body: the binary stream, e.g., the ``Body`` of an S3 object
+    :param compressed: whether the stream is GZIP-compressed
+    :type compressed: bool
+    :return: the decompressed stream, which can be rewound with ``replay()`` after reading its head,
+            and the counter of raw (compressed) bytes read
+    :type: tuple
+    """
+    raw = CountingReader(body)
+    stream = gzip.GzipFile(fileobj=raw, mode='rb') if compressed else raw
+
+    return ReplayReader(stream), raw
+
+
+def peak_rss():
+    """
+    :return: the peak resident set size of the process so far, in MiB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def array_entry(plan):
+    """
+    Finds the top-level array entry of a compiled schema, e.g., the one for ``ns1.siteMeasurements[]``.
+
+    :param plan: the compiled schema, see :func:`schemas_xml.compile_schema`
+    :type plan: tuple
+    :return: the compiled entry
+    """
+    if len(plan) != 1 or isinstance(plan[0], AttribEntry) or not plan[0].is_array:
+        raise ValueError('Streaming requires a single top-level array entry in the schema')
+
+    return plan[0]
+
+
+def scan_header(source, tag, limit=64 * 1024, chunk_size=4 * 1024):
+    """
+    Reads the head of an XML document until the first node with the given tag is closed.
+    At most ``limit`` bytes are read, so a document without the node isn't parsed in full.
+
+    :param source: a binary file object with the XML document
+    :param tag: the node's tag in the Clark notation, e.g., ``{http://datex2.eu/schema/2/2_0}publicationTime``
+    :type tag: str
+    :param limit: the maximum number of bytes to read
+    :type limit: int
+    :param chunk_size: the number of bytes to read at a time
+    :type chunk_size: int
+    :return: the node's text, or ``None`` if the node isn't in the head of the document
+    """
+    parser = XMLPullParser(events=('end',))
+    bytes_read = 0
+
+    while bytes_read < limit:
+        data = source.read(chunk_size)
+        if not data:
+            break
+
+        bytes_read += len(data)
+        parser.feed(data)
+
+        for _, elem in parser.read_events():
+            if elem.tag == tag:
+                return elem.text
+
+    return None
+
+
+class StageStats:
+    """
+    What a stage of a pipeline did: how long it worked, how long it was held up by the next stage,
+    and how full its output queue was when the next stage took from it.
+
+    ``work`` is the wall time of the stage's loop, including the time it waited for the previous stage,
+    which is that stage's ``starved``, see :meth:`Pipeline.report`.
+    """
+    def __init__(self, name, depth=0):
+        self.name = name
+        self.depth = depth  # the capacity of the output queue, 0 for the last stage
+        self.items = 0  # the items put into the output queue
+        self.work = 0.0
+        self.blocked = 0.0  # the time waiting for room in the output queue
+        self.starved = 0.0  # the time the next stage waited for items from the output queue
+        self.depth_total = 0
+        self.depth_max = 0
+        self.gets = 0
+
+    def sample_depth(self, depth):
+        self.gets += 1
+        self.depth_total += depth
+        self.depth_max = max(self.depth_max, depth)
+
+    @contextmanager
+    def working(self):
+        """
+        Adds the time spent in the ``with`` block to the stage's work.
+        """
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.work += time.perf_counter() - started
+
+
+class Pipeline:
+    """
+    The stages of processing a file, from the download to the writes, in order.
+    Each stage but the last one runs in its own thread and passes its output on through a bounded queue,
+    so a stage that falls behind holds up the stages before it.
+    """
+    def __init__(self):
+        self.stages = []
+
+    def stage(self, name):
+        """
+        Adds a stage, see :class:`Prefetcher` for running it.
+
+        :return: the stage's counters
+        :type: StageStats
+        """
+        stats = StageStats(name)
+        self.stages.append(stats)
+        return stats
+
+    def busy(self):
+        """
+        :return: the time each stage spent on its own work, in seconds, not waiting for the other stages
+        :type: OrderedDict
+        """
+        busy = OrderedDict()
+        previous = None
+
+        for stats in self.stages:
+            busy[stats.name] = stats.work - (previous.starved if previous is not None else 0.0)
+            previous = stats
+
+        return busy
+
+    def report(self):
+        """
+        :return: a line per stage, and one naming the stage that took the longest
+        :type: list
+        """
+        busy = self.busy()
+        lines = []
+
+        for stats in self.stages:
+            line = f'{stats.name}: busy {busy[stats.name]:.2f} s'
+            if stats.depth > 0:
+                line += (f', blocked by the next stage {stats.blocked:.2f} s, {stats.items} items, '
+                         f'queue depth {stats.depth_total / max(stats.gets, 1):.1f} on average, '
+                         f'{stats.depth_max} at most, of {stats.depth}')
+            lines.append(line)
+
+        if busy:
+            lines.append(f'Bottleneck: {max(busy, key=busy.get)}')
+
+        return lines
+
+
+class PrefetchClosed(Exception):
+    """
+    The prefetcher was closed while a thread was waiting for its items, e.g., a parser reading ahead of the writes.
+    """
+
+
+class PrefetchTimeout(Exception):
+    """
+    The consumer gave up waiting for the next item, see the ``give_up`` of :class:`Prefetcher`.
+    """
+
+
+class Prefetcher:
+    """
+    Runs a producer in a background thread, passing its items on through a queue of at most ``depth`` items.
+    The producer's exceptions are re-raised in the consuming thread.
+    While the consumer waits for an item, ``give_up`` is called every 0.1 s, if given,
+    and :class:`PrefetchTimeout` is raised once it returns true, e.g., when the time is running out.
+
+    Use as a context manager, so the thread stops when the items aren't needed anymore.
+    Neither the producer nor the consumer waits on the queue past :meth:`close`,
+    the threads of a file stopped early, e.g., at a checkpoint, don't outlive it.
+    """
+    def __init__(self, depth, stats=None, give_up=None):
+        self.queue = queue.Queue(maxsize=depth)
+        self.give_up = give_up
+        self.stats = stats if stats is not None else StageStats(type(self).__name__)
+        self.stats.depth = depth
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _produce(self):
+        raise NotImplementedError
+
+    def _run(self):
+        try:
+            self._produce()
+        except Exception as ex:
+            self._put(ex)  # re-raised in the reading thread
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+            self.stats.items += 1
+            return
+        except queue.Full:
+            pass
+
+        started = time.perf_counter()
+        try:
+            while not self.closed.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    self.stats.items += 1
+                    return
+                except queue.Full:
+                    pass
+        finally:
+            self.stats.blocked += time.perf_counter() - started
+
+    def _get(self):
+        self.stats.sample_depth(self.queue.qsize())
+
+        started = time.perf_counter()
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    if self.closed.is_set():
+                        raise PrefetchClosed(f'{self.stats.name} was closed')
+                    if self.give_up is not None and self.give_up():
+                        raise PrefetchTimeout(f'Gave up waiting for {self.stats.name}')
+        finally:
+            self.stats.starved += time.perf_counter() - started
+
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.closed.set()
+
+        # Drop what's queued, the producer stops at its next item
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PrefetchReader(Prefetcher):
+    """
+    A binary file object that reads a stream ahead in a background thread,
+    so that downloading and decompressing overlap with whatever the reader is doing,
+    e.g., resolving the schema or parsing.
+    At most ``depth`` chunks are read ahead.
+    """
+    def __init__(self, stream, chunk_size=64 * 1024, depth=16, stats=None):
+        super().__init__(depth, stats)
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = b''
+        self.eof = False
+        self.bytes_read = 0  # the bytes read ahead, including those not consumed yet
+
+        self.thread.start()
+
+    def _produce(self):
+        while not self.closed.is_set():
+            started = time.perf_counter()
+            data = self.stream.read(self.chunk_size)
+            self.stats.work += time.perf_counter() - started
+
+            self.bytes_read += len(data)
+            self._put(data)
+
+            if not data:
+                return
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(64 * 1024), b''))
+
+        if not self.buffer and not self.eof:
+            try:
+                self.buffer = self._get()
+            except Exception:
+                self.eof = True
+                raise
+
+            self.eof = not self.buffer
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class PrefetchIterator(Prefetcher):
+    """
+    An iterator that runs another one ahead in a background thread, at most ``depth`` items ahead,
+    e.g., parsing and extracting chunks of records while the previous chunks are being written.
+    """
+    _end = object()
+
+    def __init__(self, iterable, depth=4, stats=None, give_up=None):
+        super().__init__(depth, stats, give_up)
+        self.iterable = iterable
+        self.done = False
+
+        self.thread.start()
+
+    def _produce(self):
+        iterator = iter(self.iterable)
+
+        try:
+            while not self.closed.is_set():
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    item = self._end
+                finally:
+                    self.stats.work += time.perf_counter() - started
+
+                self._put(item)
+
+                if item is self._end:
+                    return
+        finally:
+            # A generator left early cleans up right away, e.g., stops the worker processes of a parallel extraction
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+
+        try:
+            item = self._get()
+        except Exception:
+            self.done = True
+            raise
+
+        if item is self._end:
+            self.done = True
+            raise StopIteration
+
+        return item
+
+    def exhausted(self):
+        """
+        :return: whether the items are known to have run out, without waiting for the next one
+        :type: bool
+        """
+        if self.done:
+            return True
+
+        with self.queue.mutex:
+            return bool(self.queue.queue) and self.queue.queue[0] is self._end
+
+
+def stream_nodes(source, tag):
+    """
+    Parses an XML document incrementally, yielding every node with the given tag once it's complete.
+    Every node is discarded as soon as the consumer moves on to the next one,
+    so the memory use is bounded by a single node's subtree rather than by the whole document.
+
+    Nested nodes with the same tag are yielded as a part of the outermost one only.
+
+    :param source: a file name or a binary file object with the XML document
+    :param tag: the nodes' tag in the Clark notation
+    :type tag: str
+    :return: an iterator over the nodes
+    """
+    parents = []  # the currently open nodes
+    depth = 0  # how many nodes with the tag are currently open
+
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            if elem.tag == tag:
+                depth += 1
+            continue
+
+        parents.pop()
+
+        if elem.tag != tag:
+            continue
+
+        depth -= 1
+        if depth > 0:
+            continue
+
+        yield elem
+
+        # Detach the processed node, so the tree doesn't grow with the document
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+
+
+def stream_data(source, plan, log, skip=0):
+    """
+    Parses an XML document incrementally, yielding one record per node that matches
+    the schema's top-level array entry, see :func:`stream_nodes`.
+
+    :param source: a file name or a binary file object with the XML document
+    :param plan: the compiled schema with a single top-level array entry, see :func:`schemas_xml.compile_schema`
+    :type plan: tuple
+    :param log: a logger function that takes a string as a single argument
+    :param skip: the number of records to pass over without extracting them, e.g., those written before a checkpoint
+    :type skip: int
+
+    :return: an iterator over the extracted records
+    """
+    entry = array_entry(plan)
+
+    for elem in stream_nodes(source, entry.tag):
+        if skip > 0:
+            if yields_record(entry, elem):
+                skip -= 1
+            continue
+
+        record = extract_node(entry, elem, log)
+
+        if record is not None:
+            yield record
+
+
+def chunks(iterable, size):
+    """
+    Splits an iterable into lists of at most ``size`` items.
+
+    :param iterable: the items to split
+    :param size: the maximum number of items in a chunk
+    :type size: int
+    :return: an iterator over the chunks
+    """
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
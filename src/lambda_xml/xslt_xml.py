@@ -0,0 +1,274 @@
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+from xml.sax.saxutils import quoteattr
+
+from logs import ExtractionError, no_node
+from schemas_xml import AttribEntry, MapEntry, ListEntry, DESCENDANT, CHILD, convert_val, missing_field
+from stream_xml import array_entry
+
+try:
+    from lxml import etree
+except ImportError:  # lxml is optional, the XSLT engine is only available with it
+    etree = None
+
+#
+# An extraction engine that runs the compiled schema as an XSLT stylesheet.
+# The stylesheet copies the raw values into a small XML document that mirrors the plan:
+#
+#   <o i="...">  a record (a map entry, or the alternative number `i` of a list entry),
+#                with a child for every entry of the plan, in the plan's order
+#   <a>          an array entry's list of items
+#   <v>          a value
+#   <n/>         a value that isn't there (a missing attribute, or a node without text)
+#   <m/>         a non-array entry without a matching node
+#
+# The values are then converted in Python with the same converters as the other engines.
+#
+
+xsl_namespace = 'http://www.w3.org/1999/XSL/Transform'
+
+transform_cache_size = 16
+
+# The compiled stylesheets by the ids of the plans (which can't be hashed), in the order they were added.
+# The plans are kept with them, so that their ids aren't reused, and each schema version is compiled into a plan once,
+# see `schema_cache_xml`, so the stylesheet isn't generated again for every file
+transforms = OrderedDict()
+transforms_lock = threading.Lock()
+
+
+class Namespaces:
+    """
+    Assigns prefixes to the namespaces of the Clark notation tags for the stylesheet.
+    """
+    def __init__(self):
+        self.prefixes = {}
+
+    def qname(self, clark):
+        if not clark.startswith('{'):
+            return clark
+
+        uri, local = clark[1:].split('}')
+        prefix = self.prefixes.get(uri)
+        if prefix is None:
+            prefix = self.prefixes[uri] = f'n{len(self.prefixes)}'
+
+        return f'{prefix}:{local}'
+
+    def declarations(self):
+        return ' '.join(f'xmlns:{prefix}={quoteattr(uri)}' for uri, prefix in self.prefixes.items())
+
+
+def xpath_literal(value):
+    """
+    :return: the XPath string for a value, XPath 1.0 has no escapes in strings,
+            so a value with both kinds of quotes is joined with ``concat()``
+    """
+    if "'" not in value:
+        return f"'{value}'"
+    if '"' not in value:
+        return f'"{value}"'
+    return 'concat(' + ', "\'", '.join(f"'{part}'" for part in value.split("'")) + ')'
+
+
+def option_test(option, ns):
+    """
+    :return: the XPath condition for an alternative, relative to the node
+    """
+    if option.test is None:
+        raise ValueError(f'The XSLT engine only supports alternatives testing attributes, not `{option.pattern}`')
+
+    attrib, value = option.test
+    if value is None:
+        return f'@{ns.qname(attrib)}'
+    return f'@{ns.qname(attrib)}={xpath_literal(value)}'
+
+
+def entry_select(entry, ns):
+    """
+    :return: the XPath selecting the entry's nodes relative to the current node
+    """
+    if entry.axis == DESCENDANT:
+        select = f'descendant-or-self::{ns.qname(entry.tag)}'
+    elif entry.axis == CHILD:
+        select = ns.qname(entry.tag)
+    else:
+        select = '/'.join(ns.qname(step) for step in entry.steps)
+
+    # The nodes matching none of the alternatives are skipped
+    if isinstance(entry, ListEntry):
+        select += '[' + ' or '.join(option_test(option, ns) for option in entry.options) + ']'
+
+    return select
+
+
+def value_xslt(entry, ns, out):
+    """
+    Generates the XSLT copying a value from the current node.
+    """
+    source = f'@{ns.qname(entry.attrib)}' if entry.attrib is not None else 'node()[1][self::text()]'
+
+    out.append(f'<xsl:choose><xsl:when test={quoteattr(source)}>'
+               f'<v><xsl:value-of select={quoteattr(source)}/></v>'
+               f'</xsl:when><xsl:otherwise><n/></xsl:otherwise></xsl:choose>')
+
+
+def item_xslt(entry, ns, out):
+    """
+    Generates the XSLT extracting an item of a non-attribute entry from the current node.
+    """
+    if isinstance(entry, MapEntry):
+        out.append('<o>')
+        entries_xslt(entry.entries, ns, out)
+        out.append('</o>')
+
+    elif isinstance(entry, ListEntry):
+        out.append('<xsl:choose>')
+        for i, option in enumerate(entry.options):
+            out.append(f'<xsl:when test={quoteattr(option_test(option, ns))}><o i="{i}">')
+            entries_xslt(option.entries, ns, out)
+            out.append('</o></xsl:when>')
+        out.append('</xsl:choose>')
+
+    else:
+        value_xslt(entry, ns, out)
+
+
+def entries_xslt(entries, ns, out):
+    """
+    Generates the XSLT extracting compiled entries from the current node.
+    """
+    for entry in entries:
+        if isinstance(entry, AttribEntry):
+            value_xslt(entry, ns, out)
+            continue
+
+        select = entry_select(entry, ns)
+
+        if entry.is_array:
+            out.append(f'<a><xsl:for-each select={quoteattr(select)}>')
+            item_xslt(entry, ns, out)
+            out.append('</xsl:for-each></a>')
+        else:
+            out.append(f'<xsl:choose><xsl:when test={quoteattr(select)}>'
+                       f'<xsl:for-each select={quoteattr("(" + select + ")[1]")}>')
+            item_xslt(entry, ns, out)
+            out.append('</xsl:for-each></xsl:when><xsl:otherwise><m/></xsl:otherwise></xsl:choose>')
+
+
+def generate_xslt(plan):
+    """
+    Generates an XSLT stylesheet extracting the records with a compiled schema.
+
+    :param plan: the compiled schema with a single top-level array entry, see :func:`schemas_xml.compile_schema`
+    :type plan: tuple
+    :return: the stylesheet
+    :type: str
+    """
+    entry = array_entry(plan)
+    ns = Namespaces()
+    out = []
+
+    # Only the outermost nodes are records, like with the streaming engines
+    tag = ns.qname(entry.tag)
+    select = f'//{tag}[not(ancestor::{tag})]'
+    if isinstance(entry, ListEntry):
+        select += '[' + ' or '.join(option_test(option, ns) for option in entry.options) + ']'
+
+    item_xslt(entry, ns, out)
+
+    return (f'<xsl:stylesheet version="1.0" xmlns:xsl="{xsl_namespace}" {ns.declarations()}>'
+            '<xsl:output method="xml" encoding="utf-8"/>'
+            f'<xsl:template match="/"><records><xsl:for-each select={quoteattr(select)}>'
+            + ''.join(out) +
+            '</xsl:for-each></records></xsl:template>'
+            '</xsl:stylesheet>')
+
+
+@lru_cache(maxsize=transform_cache_size)
+def compile_xslt(stylesheet):
+    """
+    Compiles a stylesheet with lxml, each distinct stylesheet (i.e., schema version) is compiled once.
+    """
+    if etree is None:
+        raise ImportError('The XSLT engine requires lxml')
+
+    return etree.XSLT(etree.XML(stylesheet.encode()))
+
+
+def plan_transform(plan):
+    """
+    :return: the compiled stylesheet for a plan, generated once for each plan object
+    """
+    with transforms_lock:
+        cached = transforms.get(id(plan))
+    if cached is not None and cached[0] is plan:
+        return cached[1]
+
+    transform = compile_xslt(generate_xslt(plan))
+
+    with transforms_lock:
+        transforms[id(plan)] = plan, transform
+        while len(transforms) > transform_cache_size:
+            transforms.popitem(last=False)
+
+    return transform
+
+
+def read_value(entry, out, log):
+    raw_val = (out.text or '') if out.tag == 'v' else None
+    return convert_val(raw_val, entry, out, log)
+
+
+def read_item(entry, out, log):
+    if isinstance(entry, MapEntry):
+        return read_entries(entry.entries, out, log)
+    elif isinstance(entry, ListEntry):
+        return read_entries(entry.options[int(out.get('i'))].entries, out, log)
+    else:
+        return read_value(entry, out, log)
+
+
+def read_entries(entries, out, log):
+    """
+    Converts the transform's output for compiled entries into a record.
+    """
+    record = {}
+
+    for entry, child in zip(entries, out):
+        if isinstance(entry, AttribEntry):
+            record[entry.field] = read_value(entry, child, log)
+        elif entry.is_array:
+            record[entry.field] = [read_item(entry, item, log) for item in child]
+        elif child.tag == 'm':
+            record[missing_field(entry)] = '<missing>'
+            log(ExtractionError(entry.entry, no_node, child))
+        else:
+            record[entry.field] = read_item(entry, child, log)
+
+    return record
+
+
+def stream_data(source, plan, log, skip=0):
+    """
+    Extracts the records from an XML document with an XSLT transform.
+    Produces the same records as :func:`stream_xml.stream_data`,
+    but the whole document is parsed into memory first.
+
+    :param source: a file name or a binary file object with the XML document
+    :param plan: the compiled schema with a single top-level array entry, see :func:`schemas_xml.compile_schema`
+    :type plan: tuple
+    :param log: a logger function that takes a string as a single argument
+    :param skip: the number of records to pass over without reading them, e.g., those written before a checkpoint
+    :type skip: int
+
+    :return: an iterator over the extracted records
+    """
+    transform = plan_transform(plan)
+    entry = array_entry(plan)
+
+    result = transform(etree.parse(source)).getroot()
+
+    for out in islice(result, skip, None):
+        yield read_item(entry, out, log)
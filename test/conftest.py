@@ -0,0 +1,8 @@
+import os
+import sys
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The Lambda's modules import each other by their names, and the tests share the benchmarks' helpers and stand-ins
+sys.path.append(os.path.join(root_dir, 'src', 'lambda_xml'))
+sys.path.append(os.path.join(root_dir, 'bench'))
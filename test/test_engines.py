@@ -0,0 +1,107 @@
+import re
+from io import BytesIO
+from xml.etree.ElementTree import fromstring
+
+import pytest
+
+from sample import load_schema, read_sample
+
+import expat_xml
+import parallel_xml
+import schemas_xml
+import stream_xml
+
+part_size = 16 * 1024  # several parts of the sample
+
+
+def damaged_sample():
+    """
+    :return: the sample without a few speeds and its first site reference, for the missing nodes
+    """
+    contents = re.sub(rb'<ns1:speed>[^<]*</ns1:speed>', b'', read_sample(), count=3)
+    return re.sub(rb'<ns1:measurementSiteReference[^>]*/>', b'', contents, count=1)
+
+
+@pytest.fixture(scope='module')
+def schema():
+    return load_schema()
+
+
+@pytest.fixture(scope='module')
+def plan(schema):
+    return schemas_xml.compile_schema(*schema)
+
+
+@pytest.fixture(scope='module')
+def workers():
+    # Forked before the tests start any thread, like at the Lambda's cold start
+    if not parallel_xml.idle_workers:
+        parallel_xml.start_workers(2)
+    return parallel_xml.idle_workers
+
+
+def reference(contents, schema, plan):
+    """
+    :return: the records extracted by interpreting the schema on the whole document
+    """
+    data = schemas_xml.interpret_data(fromstring(contents), *schema, lambda _: None)
+    return data[stream_xml.array_entry(plan).field]
+
+
+def engines():
+    names = [stream_xml, expat_xml]
+    try:
+        import xslt_xml
+    except ImportError:
+        pass
+    else:
+        if xslt_xml.etree is not None:
+            names.append(xslt_xml)
+    return names
+
+
+@pytest.mark.parametrize('make_contents', [read_sample, damaged_sample])
+@pytest.mark.parametrize('engine', engines(), ids=lambda module: module.__name__)
+def test_engine(engine, make_contents, schema, plan):
+    contents = make_contents()
+    expected = reference(contents, schema, plan)
+
+    assert len(expected) == 200
+    assert list(engine.stream_data(BytesIO(contents), plan, lambda _: None)) == expected
+    assert list(engine.stream_data(BytesIO(contents), plan, lambda _: None, skip=150)) == expected[150:]
+
+
+@pytest.mark.parametrize('make_contents', [read_sample, damaged_sample])
+@pytest.mark.parametrize('engine', [module.__name__ for module in engines()])
+def test_parallel(engine, make_contents, schema, plan, workers):
+    contents = make_contents()
+    expected = reference(contents, schema, plan)
+    engine = {'stream_xml': 'etree', 'expat_xml': 'expat', 'xslt_xml': 'xslt'}[engine]
+
+    records = parallel_xml.stream_parallel(BytesIO(contents), plan, schema, lambda _: None,
+                                           engine=engine, processes=2, size=part_size)
+    assert list(records) == expected
+
+    records = parallel_xml.stream_parallel(BytesIO(contents), plan, schema, lambda _: None, skip=150,
+                                           engine=engine, processes=2, size=part_size)
+    assert list(records) == expected[150:]
+
+
+def test_parallel_early_stop(schema, plan, workers):
+    records = parallel_xml.stream_parallel(BytesIO(read_sample()), plan, schema, lambda _: None, size=part_size)
+    next(records)
+    records.close()
+
+    # The workers are back, and still running
+    assert len(parallel_xml.idle_workers) == 2
+    assert all(process.is_alive() for process, _, _ in parallel_xml.idle_workers)
+
+
+def test_parallel_parse_error(schema, plan, workers):
+    contents = read_sample()
+    broken = contents[:len(contents) // 2] + b'<<' + contents[len(contents) // 2:]
+
+    with pytest.raises(SyntaxError):  # `ParseError`, from a worker, or the splitting
+        list(parallel_xml.stream_parallel(BytesIO(broken), plan, schema, lambda _: None, size=part_size))
+
+    assert len(parallel_xml.idle_workers) == 2
@@ -0,0 +1,96 @@
+from decimal import Decimal
+from io import BytesIO
+
+import pytest
+
+from sample import load_schema, read_sample
+
+import dynamo_xml
+import packed_xml
+import schemas_xml
+import stream_xml
+
+
+def flow(channel, value):
+    return {'Channel': channel, 'ns1:basicData': {'Type': 'TrafficFlow', 'Flow': value}}
+
+
+def speed(channel, input_size, value):
+    return {'Channel': channel,
+            'ns1:basicData': {'Type': 'TrafficSpeed',
+                              'ns1:averageVehicleSpeed': {'InputSize': input_size, 'Speed': value}}}
+
+
+@pytest.fixture(scope='module')
+def records():
+    plan = schemas_xml.compile_schema(*load_schema())
+    return list(stream_xml.stream_data(BytesIO(read_sample()), plan, lambda _: None))
+
+
+def test_sample_round_trip(records):
+    for record in records:
+        readings = record['ns1:measuredValue']
+        assert packed_xml.unpack_readings(packed_xml.pack_readings(readings)) == readings
+
+
+@pytest.mark.parametrize('readings', [
+    [],
+    [flow(0, 0), flow(1, 60), flow(300, 12345)],
+    [speed(1, 1, 59), speed(2, 0, Decimal('-1')), speed(3, 7, Decimal('87.25'))],
+    [flow(1, -60), flow(2, Decimal('-0.01')), speed(3, -3, Decimal('-120.5'))],
+    [flow(1, '<missing>'), speed(2, '<missing>', 59), speed(3, 1, '<missing>'), speed(4, '<missing>', '<missing>')],
+])
+def test_round_trip(readings):
+    packed = packed_xml.pack_readings(readings)
+
+    assert packed_xml.unpack_readings(packed) == readings
+
+
+def test_missing_flags():
+    # The type code with the flag of the first value, the channel, and only the second value, zigzagged
+    expected = bytearray(packed_xml.header.pack(packed_xml.version, 1))
+    expected += bytes([0x10 | packed_xml.type_codes['TrafficSpeed'], 2])
+    packed_xml.write_varint(expected, 5900 << 1)
+
+    assert packed_xml.pack_readings([speed(2, '<missing>', 59)]) == bytes(expected)
+
+
+def test_values():
+    values = [0, 1, -1, 63, -64, 64, -65, Decimal('0.5'), Decimal('-0.5'), Decimal('-12.34'), 2 ** 40, -2 ** 40]
+    readings = [flow(channel, value) for channel, value in enumerate(values)]
+
+    unpacked = packed_xml.unpack_readings(packed_xml.pack_readings(readings))
+
+    assert [reading['ns1:basicData']['Flow'] for reading in unpacked] == values
+    assert all(reading['ns1:basicData']['Flow'].__class__ is int for reading in unpacked[:7])
+
+
+@pytest.mark.parametrize('readings', [
+    None,
+    [flow(1, Decimal('0.005'))],  # more decimals than the layout keeps
+    [flow(1, Decimal('NaN'))],
+    [flow(1, '<wrong format>')],
+    [flow(-1, 60)],
+    [{'Channel': 1, 'ns1:basicData': {'Type': 'TrafficConcentration', 'Flow': 60}}],
+    [{'Channel': 1}],
+])
+def test_unpackable(readings):
+    with pytest.raises(packed_xml.PackingError):
+        packed_xml.pack_readings(readings)
+
+
+def test_packed_encoder(records):
+    plan = schemas_xml.compile_schema(*load_schema())
+    encode = packed_xml.packed_encoder(dynamo_xml.compile_encoder(plan))
+    record = records[0]
+
+    item = encode(record)
+    assert 'ns1:measuredValue' not in item
+    plain = {field: dynamo_xml.decode_value(value) for field, value in item.items()}
+    assert packed_xml.unpack_item(plain) == record
+
+    # A reading that doesn't fit the layout, the item is written in the plain encoding
+    broken = dict(record, **{'ns1:measuredValue': [flow(1, Decimal('0.005'))]})
+    item = encode(broken)
+    assert packed_xml.packed_field not in item
+    assert packed_xml.unpack_item({field: dynamo_xml.decode_value(value) for field, value in item.items()}) == broken
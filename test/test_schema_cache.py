@@ -0,0 +1,29 @@
+import pytest
+
+from schema_cache_xml import like_pattern
+
+
+@pytest.mark.parametrize('pattern, text, matches', [
+    ('%Trafficspeed.xml', 'Trafficspeed.xml', True),
+    ('%Trafficspeed.xml', '2017/12/31/2300_Trafficspeed.xml', True),
+    ('%Trafficspeed.xml', 'Trafficspeed.xml.gz', False),
+    ('%Trafficspeed.xml', 'Trafficspeedxxml', False),  # `.` is not a wildcard
+    ('%Trafficspeed%', 'a/Trafficspeed.xml.gz', True),
+    ('%', '', True),
+    ('%', 'line\nbreak', True),
+    ('_', 'a', True),
+    ('_', '', False),
+    ('_', 'ab', False),
+    ('a_c', 'abc', True),
+    ('a_c', 'a\nc', True),
+    (r'a\_c', 'a_c', True),
+    (r'a\_c', 'abc', False),
+    (r'100\%', '100%', True),
+    (r'100\%', '1000', False),
+    (r'a\\b', 'a\\b', True),
+    ('(a+)[b]{2}$^', '(a+)[b]{2}$^', True),
+    ('(a+)[b]{2}$^', 'aab', False),
+    ('Trafficspeed', 'trafficspeed', False),  # `LIKE` is case-sensitive
+])
+def test_like_pattern(pattern, text, matches):
+    assert bool(like_pattern(pattern).match(text)) == matches
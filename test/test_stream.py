@@ -0,0 +1,73 @@
+import gzip
+from io import BytesIO
+
+import pytest
+
+import stream_xml
+
+publication_time = '{http://datex2.eu/schema/2/2_0}publicationTime'
+header_limit = 64 * 1024
+
+
+def document(padding):
+    """
+    :return: the head of a document up to the end of its publication time, after ``padding`` bytes of a comment,
+            and the whole document
+    """
+    head = (b'<?xml version="1.0" encoding="UTF-8"?>'
+            b'<d2LogicalModel xmlns="http://datex2.eu/schema/2/2_0"><!--' + b' ' * padding + b'-->'
+            b'<publicationTime>2017-12-31T23:00:42.006Z</publicationTime>')
+    return head, head + b'<payloadPublication/></d2LogicalModel>'
+
+
+def padding_for(size):
+    """
+    :return: the padding that makes the head of the document ``size`` bytes long
+    """
+    head, _ = document(0)
+    return size - len(head)
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+@pytest.mark.parametrize('size, found', [(1000, True), (header_limit, True), (header_limit + 1, False)])
+def test_scan_header(size, found, compressed):
+    head, contents = document(padding_for(size))
+    assert len(head) == size
+
+    body = BytesIO(gzip.compress(contents) if compressed else contents)
+    source, raw = stream_xml.open_body(body, compressed)
+
+    date = stream_xml.scan_header(source, publication_time, limit=header_limit)
+
+    assert date == ('2017-12-31T23:00:42.006Z' if found else None)
+    assert source.bytes_read <= header_limit  # a document without the node isn't read in full
+
+    # The document is read again from its start
+    source.replay()
+    assert source.read() == contents
+
+
+@pytest.mark.parametrize('size', [1, 1000, 4096, 5000])
+def test_replay_reads(size):
+    head, contents = document(padding_for(header_limit))
+    source, _ = stream_xml.open_body(BytesIO(contents), False)
+
+    assert stream_xml.scan_header(source, publication_time, limit=header_limit) is not None
+    source.replay()
+
+    chunks = list(iter(lambda: source.read(size), b''))
+    assert b''.join(chunks) == contents
+    assert all(len(chunk) <= size for chunk in chunks)
+
+    # The head isn't kept after it's read again
+    assert not source.head and not source.recording
+
+
+def test_replay_unread_head():
+    _, contents = document(100)
+    source, _ = stream_xml.open_body(BytesIO(contents), False)
+
+    assert source.read(10) == contents[:10]
+    source.replay()
+    assert source.read(4) == contents[:4]
+    assert source.read() == contents[4:]
@@ -0,0 +1,108 @@
+from io import BytesIO
+
+import pytest
+
+from bench_writer import LocalDynamoDB, Throttled, key_fields
+from sample import load_schema, make_copies
+
+import dynamo_xml
+import schemas_xml
+import stream_xml
+
+
+@pytest.fixture(scope='module')
+def items():
+    plan = schemas_xml.compile_schema(*load_schema())
+    records = list(stream_xml.stream_data(BytesIO(make_copies(5)), plan, lambda _: None))
+
+    # The copies repeat the sites, give each copy its own time so the keys differ
+    for i, record in enumerate(records):
+        record['measurementTimeDefault'] = f'{i // 200}/{record["measurementTimeDefault"]}'
+
+    return list(map(dynamo_xml.compile_encoder(plan), records))
+
+
+def write(writer, items):
+    with writer:
+        for chunk in stream_xml.chunks(items, 500):
+            writer.put_items(chunk)
+
+
+def test_write(items):
+    table = LocalDynamoDB('TrafficSpeed', latency=0.001)
+    writer = dynamo_xml.ParallelWriter(table, 'TrafficSpeed', key_fields, streams=4)
+
+    write(writer, items)
+
+    assert len(table.items) == len(items) == writer.stats.items
+    assert writer.stats.requests == -(-len(items) // dynamo_xml.max_batch)
+    assert writer.stats.retries == writer.stats.throttled == writer.stats.unprocessed == 0
+    assert writer.limit == 4
+
+
+def test_write_throttled(items):
+    table = LocalDynamoDB('TrafficSpeed', latency=0.001, capacity=2000)
+    writer = dynamo_xml.ParallelWriter(table, 'TrafficSpeed', key_fields, streams=8, base_delay=0.01)
+
+    write(writer, items)
+
+    # Every item is written once the throttled and unprocessed items are retried
+    assert len(table.items) == len(items) == writer.stats.items
+    assert writer.stats.throttled + writer.stats.unprocessed > 0
+    assert writer.stats.retries > 0
+    assert writer.stats.requests > -(-len(items) // dynamo_xml.max_batch)
+
+
+def test_retries_exhausted(items):
+    table = LocalDynamoDB('TrafficSpeed', latency=0.001, capacity=0.5)  # not enough for a single item
+    writer = dynamo_xml.ParallelWriter(table, 'TrafficSpeed', key_fields, streams=2, max_retries=2,
+                                       base_delay=0.001)
+
+    with pytest.raises(dynamo_xml.WriteError, match='still throttled after 2 retries'):
+        write(writer, items[:10])
+
+    assert not table.items
+    assert writer.stats.throttled == 3  # the request, and its 2 retries
+
+
+def test_other_errors(items):
+    class Failing(LocalDynamoDB):
+        def batch_write_item(self, RequestItems, ReturnConsumedCapacity='NONE'):
+            raise Throttled('ValidationException')
+
+    writer = dynamo_xml.ParallelWriter(Failing('TrafficSpeed'), 'TrafficSpeed', key_fields, streams=2)
+
+    with pytest.raises(dynamo_xml.WriteError, match='ValidationException'):
+        write(writer, items[:10])
+
+    assert writer.stats.retries == 0
+
+
+def test_limit():
+    writer = dynamo_xml.ParallelWriter(LocalDynamoDB('TrafficSpeed'), 'TrafficSpeed', key_fields, streams=8,
+                                       base_delay=60)
+    with writer:
+        # Multiplicative decrease: the requests throttled at once halve the limit once
+        for _ in range(3):
+            writer._acquire()
+        writer._release(throttled=True)
+        writer._release(throttled=True)
+        assert writer.limit == 4
+
+        writer.decreased = 0.0  # a later burst
+        writer._release(throttled=True)
+        assert writer.limit == 2
+
+        # Additive increase: a request more after as many requests without throttling as the limit
+        for expected in (2, 3):
+            for _ in range(expected):
+                assert writer.limit == expected
+                writer._acquire()
+                writer._release(throttled=False)
+        assert writer.limit == 4
+
+        writer.limit = writer.max_streams
+        for _ in range(20):
+            writer._acquire()
+            writer._release(throttled=False)
+        assert writer.limit == 8  # never above `streams`